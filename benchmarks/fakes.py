@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+""" In-process stand-ins for the Docker Engine API and the Nuvla REST API
+
+Both speak just enough of the real protocols for the Docker SDK and the Nuvla API client
+to work unchanged against them, with configurable latency and failure rates.
+"""
+
+import json
+import os
+import queue
+import random
+import re
+import socketserver
+import ssl
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FaultInjector(object):
+    """ Adds latency and random failures to the fake services """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self._random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return "fake-client"
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send(self, status, body=b"", content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+#
+# Docker
+#
+
+def multiplex(stream, data):
+    """ Frames data the way the Docker API does for non-TTY container logs """
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, "big") + data
+
+
+class FakeDockerState(object):
+    """ Containers known to the fake Docker daemon, and the subscribers of its events stream """
+
+    def __init__(self, faults, container_logs=b"MJPG Streamer Version: fake\n"):
+        self.faults = faults
+        self.container_logs = container_logs
+        self.containers = {}
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.calls = {}
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+    def find(self, ref):
+        with self.lock:
+            if ref in self.containers:
+                return self.containers[ref]
+            for c in self.containers.values():
+                if c["Name"] == "/" + ref or c["Id"].startswith(ref):
+                    return c
+        return None
+
+    def publish(self, action, container):
+        event = {"Type": "container", "Action": action, "status": action, "id": container["Id"],
+                 "Actor": {"ID": container["Id"],
+                           "Attributes": dict(container["Config"]["Labels"], name=container["Name"][1:])},
+                 "time": int(time.time()), "timeNano": time.time_ns()}
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+class FakeDockerHandler(QuietHandler):
+    server_version = "FakeDocker/1.0"
+
+    api_version = "1.41"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def route(self):
+        url = urlparse(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        return path, {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+    def handle_any(self, method):
+        path, query = self.route()
+        body = self.read_body()
+        self.state.count("{} {}".format(method, re.sub(r"/containers/(?!create$|json$)[^/]+", "/containers/{id}", path)))
+
+        if path in ("/_ping", "/version", "/events"):
+            return getattr(self, "do_" + path.strip("/").replace("_", ""))(query)
+
+        if self.state.faults.delay():
+            return self.send(500, {"message": "injected failure"})
+
+        m = re.match(r"^/containers/([^/]+)(/[a-z]+)?$", path)
+        if path == "/containers/json" and method == "GET":
+            return self.list_containers(query)
+        if path == "/containers/create" and method == "POST":
+            return self.create_container(query, json.loads(body or b"{}"))
+        if m:
+            container = self.state.find(m.group(1))
+            if not container:
+                return self.send(404, {"message": "No such container: {}".format(m.group(1))})
+            action = (m.group(2) or "").strip("/")
+            if method == "GET" and action == "json":
+                return self.send(200, container)
+            if method == "POST" and action == "start":
+                container["State"]["Status"] = "running"
+                self.state.publish("start", container)
+                return self.send(204)
+            if method == "POST" and action == "update":
+                container["HostConfig"].update(json.loads(body or b"{}"))
+                self.state.publish("update", container)
+                return self.send(200, {"Warnings": []})
+            if method == "GET" and action == "logs":
+                return self.logs(container, query)
+            if method == "DELETE" and not action:
+                with self.state.lock:
+                    self.state.containers.pop(container["Id"], None)
+                self.state.publish("destroy", container)
+                return self.send(204)
+
+        if path == "/images/create" and method == "POST":
+            return self.pull_image(query)
+        if path.startswith("/images/") and path.endswith("/json"):
+            return self.send(200, {"Id": "sha256:" + "1" * 64, "RepoDigests": ["image@sha256:" + "0" * 64]})
+
+        return self.send(404, {"message": "page not found: {} {}".format(method, path)})
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+    def do_ping(self, query):
+        self.send(200, b"OK", "text/plain", headers={"Api-Version": self.api_version})
+
+    def do_version(self, query):
+        self.send(200, {"ApiVersion": self.api_version, "MinAPIVersion": "1.12", "Version": "fake",
+                        "Os": "linux", "Arch": "amd64"})
+
+    def do_events(self, query):
+        events = queue.Queue()
+        with self.state.lock:
+            self.state.subscribers.append(events)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while True:
+                data = json.dumps(events.get()).encode() + b"\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.state.lock:
+                self.state.subscribers.remove(events)
+            self.close_connection = True
+
+    def logs(self, container, query):
+        data = multiplex(1, self.state.container_logs)
+        if query.get("follow") not in ("1", "true", "True"):
+            return self.send(200, data, "application/vnd.docker.raw-stream")
+
+        # like the real thing, a followed stream only ends when the container stops
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+            while self.state.find(container["Id"]) is container and container["State"]["Status"] == "running":
+                time.sleep(0.05)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def pull_image(self, query):
+        progress = [{"status": "Pulling from {}".format(query.get("fromImage")), "id": query.get("tag")},
+                    {"status": "Downloading", "id": "layer", "progressDetail": {"current": 512, "total": 1024}},
+                    {"status": "Download complete", "id": "layer", "progressDetail": {}},
+                    {"status": "Digest: sha256:{}".format("0" * 64)},
+                    {"status": "Status: Image is up to date"}]
+
+        # streamed like the real thing, one JSON message per chunk
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for message in progress:
+            data = json.dumps(message).encode() + b"\r\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def list_containers(self, query):
+        label = None
+        if query.get("filters"):
+            labels = json.loads(query["filters"]).get("label", [])
+            label = labels[0].split("=")[0] if labels else None
+        with self.state.lock:
+            containers = [{"Id": c["Id"], "Names": [c["Name"]], "Labels": c["Config"]["Labels"],
+                           "State": c["State"]["Status"]}
+                          for c in self.state.containers.values()
+                          if not label or label in c["Config"]["Labels"]]
+        self.send(200, containers)
+
+    def create_container(self, query, spec):
+        name = query.get("name") or uuid.uuid4().hex[:12]
+        if self.state.find(name):
+            return self.send(409, {"message": "Conflict. The container name \"/{}\" is already in use".format(name)})
+
+        container = {"Id": uuid.uuid4().hex + uuid.uuid4().hex,
+                     "Name": "/" + name,
+                     "Image": spec.get("Image"),
+                     "Config": {"Env": spec.get("Env") or [], "Labels": spec.get("Labels") or {},
+                                "Cmd": spec.get("Cmd"), "Tty": False, "Image": spec.get("Image")},
+                     "HostConfig": spec.get("HostConfig") or {},
+                     "State": {"Status": "created", "Running": False},
+                     "NetworkSettings": {"Networks": {}}}
+        with self.state.lock:
+            self.state.containers[container["Id"]] = container
+        self.state.publish("create", container)
+        self.send(201, {"Id": container["Id"], "Warnings": []})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        return request, ("fake-client", 0)
+
+
+class FakeDocker(object):
+    """ Fake Docker daemon listening on a UNIX socket """
+
+    def __init__(self, socket_path, faults=None):
+        self.socket_path = socket_path
+        self.state = FakeDockerState(faults or FaultInjector())
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.server = UnixHTTPServer(socket_path, FakeDockerHandler)
+        self.server.state = self.state
+
+    @property
+    def url(self):
+        return "unix://" + self.socket_path
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-docker").start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+#
+# Nuvla
+#
+
+class FakeNuvlaHandler(QuietHandler):
+    server_version = "FakeNuvla/1.0"
+
+    def do_POST(self):
+        self.read_body()
+        self.server.count("POST " + urlparse(self.path).path)
+        if self.server.faults.delay():
+            return self.send(500, {"message": "injected failure"})
+        if urlparse(self.path).path == "/api/session":
+            expires = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 86400))
+            return self.send(201, {"status": 201, "resource-id": "session/fake"},
+                             headers={"Set-Cookie": "com.sixsq.nuvla.cookie=fake; Path=/; Expires={}".format(expires)})
+        self.send(404, {"message": "not found"})
+
+    def do_PUT(self):
+        body = json.loads(self.read_body() or b"{}")
+        self.server.count("PUT")
+        if self.server.faults.delay():
+            return self.send(500, {"message": "injected failure"})
+        if "com.sixsq.nuvla.cookie" not in (self.headers.get("Cookie") or ""):
+            return self.send(401, {"message": "unauthorized"})
+        self.send(200, dict(body, id=urlparse(self.path).path[len("/api/"):]))
+
+    def do_GET(self):
+        self.server.count("GET")
+        self.send(200, {"count": 0, "resources": []})
+
+
+class FakeNuvla(object):
+    """ Fake Nuvla REST API, over HTTPS """
+
+    def __init__(self, certfile, keyfile, faults=None, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), FakeNuvlaHandler)
+        self.server.daemon_threads = True
+        self.server.faults = faults or FaultInjector()
+        self.server.calls = {}
+        self.server.count = lambda call: self.server.calls.__setitem__(call, self.server.calls.get(call, 0) + 1)
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        # the handshake happens in the request thread, not in the accept loop
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True,
+                                                 do_handshake_on_connect=False)
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return "{}:{}".format(host, port)
+
+    @property
+    def calls(self):
+        return dict(self.server.calls)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-nuvla").start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
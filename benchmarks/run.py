@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmark and load-test suite for the NuvlaBox Management API
+
+Runs the real Flask app under gunicorn, with mutual TLS, against in-process fakes of the Docker
+daemon and of Nuvla, drives a mix of traffic at it, and reports throughput, latency percentiles
+and peak RSS. Results are saved as JSON, so that runs can be compared with --compare.
+
+Example:
+    python benchmarks/run.py --scenario mixed --concurrency 8 --duration 30 --output results.json
+    python benchmarks/run.py --threads 8 --compare results.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from fakes import FakeDocker, FakeNuvla, FaultInjector
+
+here = os.path.dirname(os.path.abspath(__file__))
+code_folder = os.path.join(os.path.dirname(here), "code")
+
+scenarios = {
+    "discovery": {"discovery": 1},
+    "ssh-keys": {"add-ssh-key": 1, "revoke-ssh-key": 1},
+    "mjpg": {"enable": 2, "disable": 1, "restart": 1},
+    "mixed": {"discovery": 10, "add-ssh-key": 2, "revoke-ssh-key": 2, "enable": 2, "disable": 1, "restart": 1},
+}
+
+
+def openssl(*args, cwd):
+    subprocess.run(["openssl"] + list(args), cwd=cwd, check=True, capture_output=True)
+
+
+def generate_certificates(folder, key_type="ec"):
+    """ CA, server and client credentials, named the way the management API expects them """
+    newkey = ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"] if key_type == "ec" \
+        else ["-newkey", "rsa:2048"]
+
+    openssl("req", "-x509", *newkey, "-nodes", "-keyout", "ca-key.pem", "-out", "ca.pem", "-days", "2",
+            "-subj", "/CN=benchmark-ca", cwd=folder)
+    for name, cn, ext in (("server", "localhost", "subjectAltName=DNS:localhost,IP:127.0.0.1"),
+                          ("client", "benchmark-client", "extendedKeyUsage=clientAuth")):
+        with open(os.path.join(folder, name + ".ext"), "w") as f:
+            f.write(ext + "\n")
+        openssl("req", *newkey, "-nodes", "-keyout", name + "-key.pem", "-out", name + ".csr",
+                "-subj", "/CN=" + cn, cwd=folder)
+        openssl("x509", "-req", "-in", name + ".csr", "-CA", "ca.pem", "-CAkey", "ca-key.pem", "-CAcreateserial",
+                "-out", name + "-cert.pem", "-days", "2", "-extfile", name + ".ext", cwd=folder)
+
+
+def random_pubkey(rng):
+    return "ssh-ed25519 {} bench-{}".format(base64.b64encode(rng.getrandbits(256).to_bytes(32, "big")).decode(),
+                                            rng.getrandbits(32))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Environment(object):
+    """ Temporary data volume, SSH folder, credentials and fake services for one run """
+
+    def __init__(self, args):
+        self.args = args
+        self.root = tempfile.mkdtemp(prefix="management-api-bench-")
+        self.data = os.path.join(self.root, "data")
+        self.ssh = os.path.join(self.root, "ssh")
+        self.dev = os.path.join(self.root, "dev")
+        os.makedirs(self.data)
+        os.makedirs(self.ssh)
+        os.makedirs(self.dev)
+        # no video devices are visible, like when /dev is not mounted, so the MJPG requests are not checked
+
+        generate_certificates(self.data, args.key_type)
+
+        rng = random.Random(args.seed)
+        self.seed_keys = [random_pubkey(rng) for _ in range(args.authorized_keys)]
+        with open(os.path.join(self.ssh, "authorized_keys"), "w") as ak:
+            ak.write("\n".join(self.seed_keys) + "\n")
+
+        self.docker = FakeDocker(os.path.join(self.root, "docker.sock"),
+                                 FaultInjector(args.docker_latency, args.docker_jitter, args.docker_failure_rate,
+                                               args.seed)).start()
+        self.nuvla = FakeNuvla(os.path.join(self.data, "server-cert.pem"), os.path.join(self.data, "server-key.pem"),
+                               FaultInjector(args.nuvla_latency, args.nuvla_jitter, args.nuvla_failure_rate,
+                                             args.seed)).start()
+
+        with open(os.path.join(self.data, ".nuvla-configuration"), "w") as conf:
+            conf.write("NUVLA_ENDPOINT={}\nNUVLA_ENDPOINT_INSECURE=True\n".format(self.nuvla.endpoint))
+        with open(os.path.join(self.data, ".activated"), "w") as activated:
+            json.dump({"api-key": "credential/benchmark", "secret-key": "secret"}, activated)
+
+        self.port = free_port()
+        self.url = "https://127.0.0.1:{}".format(self.port)
+        self.process = None
+
+    def server_env(self):
+        # CA bundles from the environment would override the "insecure" Nuvla endpoint setting
+        env = {k: v for k, v in os.environ.items() if k not in ("REQUESTS_CA_BUNDLE", "CURL_CA_BUNDLE")}
+        env.update(NUVLABOX_DATA_VOLUME=self.data,
+                   HOST_SSH_FOLDER=self.ssh,
+                   DOCKER_HOST=self.docker.url,
+                   HOME=self.root,
+                   MANAGEMENT_API_CONFIG=os.path.join(self.root, "management-api.conf"),
+                   MANAGEMENT_API_BIND="127.0.0.1:{}".format(self.port),
+                   MANAGEMENT_API_HEALTH_SOCKET=os.path.join(self.root, "management-api.sock"),
+                   VIDEO_DEVICES_FOLDER=self.dev)
+        for name, value in (("WORKERS", self.args.workers), ("THREADS", self.args.threads),
+                            ("WORKER_CLASS", self.args.worker_class), ("KEEPALIVE", self.args.keepalive)):
+            if value is not None:
+                env["MANAGEMENT_API_" + name] = str(value)
+        return env
+
+    def start_server(self):
+        env = self.server_env()
+        sys.path.insert(0, code_folder)
+        from management_api import server
+
+        self.settings = server.load_settings(path=env["MANAGEMENT_API_CONFIG"], environ=env)
+        cmd = server.gunicorn_command(self.settings,
+                                      os.path.join(self.data, "server-key.pem"),
+                                      os.path.join(self.data, "server-cert.pem"),
+                                      os.path.join(self.data, "ca.pem"))
+        self.log = open(os.path.join(self.root, "gunicorn.log"), "w")
+        self.process = subprocess.Popen(cmd, cwd=code_folder, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+        session = self.session()
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            try:
+                if session.get(self.url + "/api/ready", timeout=2).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.2)
+
+        raise RuntimeError("management API did not start. See {}".format(self.log.name))
+
+    def session(self):
+        session = requests.Session()
+        # REQUESTS_CA_BUNDLE and proxies from the environment would otherwise take precedence
+        session.trust_env = False
+        session.cert = (os.path.join(self.data, "client-cert.pem"), os.path.join(self.data, "client-key.pem"))
+        session.verify = os.path.join(self.data, "ca.pem")
+        return session
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.docker.stop()
+        self.nuvla.stop()
+        if not self.args.keep:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+class RSSSampler(object):
+    """ Samples the resident memory of the gunicorn master and its workers """
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _status(pid, field):
+        try:
+            with open("/proc/{}/status".format(pid)) as status:
+                for line in status:
+                    if line.startswith(field + ":"):
+                        return int(line.split()[1]) * 1024
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+        return 0
+
+    def processes(self):
+        pids = [self.pid]
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/{}/stat".format(entry)) as stat:
+                    if int(stat.read().rsplit(")", 1)[1].split()[1]) == self.pid:
+                        pids.append(int(entry))
+            except (FileNotFoundError, ProcessLookupError, IndexError, ValueError):
+                continue
+        return pids
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, sum(self._status(pid, "VmRSS") for pid in self.processes()))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak_rss
+
+
+class LoadGenerator(object):
+    """ Drives a weighted mix of operations at the API from a pool of client threads """
+
+    def __init__(self, env, mix, args):
+        self.env = env
+        self.args = args
+        self.operations = list(mix)
+        self.weights = [mix[op] for op in self.operations]
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.lock = threading.Lock()
+        self.keys_added = []
+
+    def record(self, operation, latency, ok, rejected=False):
+        with self.lock:
+            self.latencies[operation].append(latency)
+            if rejected:
+                # turned down by the admission control, with a Retry-After
+                self.rejected[operation] += 1
+            elif not ok:
+                self.errors[operation] += 1
+
+    def timed(self, operation, func):
+        start = time.perf_counter()
+        try:
+            response = func()
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        rejected = response is not None and response.status_code in (429, 503) and "Retry-After" in response.headers
+        self.record(operation, time.perf_counter() - start, ok, rejected)
+        return response
+
+    def wait_for_job(self, session, operation, response):
+        """ Polls the job until it finishes, and records the time to completion """
+        if response is None or response.status_code != 202:
+            return
+        start = time.perf_counter()
+        job_url = self.env.url + response.json()["job"]
+        while time.perf_counter() - start < 60:
+            job = session.get(job_url).json()
+            if job.get("state") in ("SUCCESS", "FAILED"):
+                self.record("job:" + operation, time.perf_counter() - start, job["state"] == "SUCCESS")
+                return
+            time.sleep(0.02)
+        self.record("job:" + operation, time.perf_counter() - start, False)
+
+    def run_operation(self, session, operation, rng):
+        url = self.env.url
+        camera = "nuvlabox-peripheral/bench-camera-{}".format(rng.randrange(self.args.cameras))
+        if operation == "discovery":
+            self.timed(operation, lambda: session.get(url + "/api"))
+        elif operation == "add-ssh-key":
+            key = random_pubkey(rng)
+            self.timed(operation, lambda: session.post(url + "/api/add-ssh-key", data=key))
+            with self.lock:
+                self.keys_added.append(key)
+        elif operation == "revoke-ssh-key":
+            with self.lock:
+                key = self.keys_added.pop() if self.keys_added else rng.choice(self.env.seed_keys)
+            self.timed(operation, lambda: session.post(url + "/api/revoke-ssh-key", data=key))
+        elif operation in ("enable", "disable", "restart"):
+            payload = {"id": camera, "video-device": "/dev/video0", "resolution": "640x480", "fps": 10}
+            response = self.timed(operation, lambda: session.post(url + "/api/data-source-mjpg/" + operation,
+                                                                  data=json.dumps(payload)))
+            if self.args.wait_jobs:
+                self.wait_for_job(session, operation, response)
+
+    def client(self, index, deadline, counter):
+        rng = random.Random((self.args.seed or 0) + index)
+        session = self.env.session()
+        while time.time() < deadline:
+            with self.lock:
+                if self.args.requests and counter[0] >= self.args.requests:
+                    return
+                counter[0] += 1
+            self.run_operation(session, rng.choices(self.operations, self.weights)[0], rng)
+
+    def run(self):
+        counter = [0]
+        deadline = time.time() + self.args.duration
+        threads = [threading.Thread(target=self.client, args=(i, deadline, counter))
+                   for i in range(self.args.concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(latencies, errors, rejected, elapsed):
+    summary = {}
+    for operation, values in sorted(latencies.items()):
+        summary[operation] = {"count": len(values),
+                              "errors": errors.get(operation, 0),
+                              "rejected": rejected.get(operation, 0),
+                              "throughput": len(values) / elapsed if elapsed else 0,
+                              "mean": sum(values) / len(values),
+                              "p50": percentile(values, 50),
+                              "p95": percentile(values, 95),
+                              "p99": percentile(values, 99),
+                              "max": max(values)}
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(name, args):
+    env = Environment(args)
+    try:
+        env.start_server()
+        sampler = RSSSampler(env.process.pid).start()
+        generator = LoadGenerator(env, scenarios[name], args)
+        elapsed = generator.run()
+        peak_rss = sampler.stop()
+
+        requests_total = sum(len(v) for k, v in generator.latencies.items() if not k.startswith("job:"))
+        return {"elapsed": elapsed,
+                "requests": requests_total,
+                "throughput": requests_total / elapsed if elapsed else 0,
+                "peak-rss-bytes": peak_rss,
+                "operations": summarize(generator.latencies, generator.errors, generator.rejected, elapsed),
+                "docker-calls": dict(env.docker.state.calls),
+                "nuvla-calls": env.nuvla.calls,
+                "server-settings": env.settings}
+    finally:
+        env.stop()
+
+
+def print_report(results, baseline=None):
+    for name, scenario in results["scenarios"].items():
+        base = (baseline or {}).get("scenarios", {}).get(name, {})
+        print("\n== {}: {:.1f} req/s, peak RSS {:.1f} MiB".format(name, scenario["throughput"],
+                                                                  scenario["peak-rss-bytes"] / 2 ** 20))
+        if base:
+            print("   baseline: {:.1f} req/s, peak RSS {:.1f} MiB".format(base["throughput"],
+                                                                         base["peak-rss-bytes"] / 2 ** 20))
+        print("   {:<22} {:>7} {:>6} {:>8} {:>9} {:>9} {:>9}".format("operation", "count", "errors", "rejected",
+                                                                     "p50 ms", "p95 ms", "p99 ms"))
+        for operation, stats in scenario["operations"].items():
+            line = "   {:<22} {:>7} {:>6} {:>8} {:>9.1f} {:>9.1f} {:>9.1f}".format(operation, stats["count"],
+                                                                                  stats["errors"],
+                                                                                  stats.get("rejected", 0),
+                                                                                  stats["p50"] * 1000,
+                                                                                  stats["p95"] * 1000,
+                                                                                  stats["p99"] * 1000)
+            base_stats = base.get("operations", {}).get(operation)
+            if base_stats:
+                line += "   p95 {:+.1f}%".format(100.0 * (stats["p95"] - base_stats["p95"]) / base_stats["p95"])
+            print(line)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(scenarios) + ["all"], default="mixed")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of client threads")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0: no limit)")
+    parser.add_argument("--cameras", type=int, default=8, help="number of distinct MJPG peripherals")
+    parser.add_argument("--authorized-keys", type=int, default=500, help="keys pre-seeded in authorized_keys")
+    parser.add_argument("--wait-jobs", action="store_true", help="also measure the time until MJPG jobs finish")
+    parser.add_argument("--key-type", choices=("ec", "rsa"), default="ec", help="TLS key type")
+    parser.add_argument("--docker-latency", type=float, default=0.01)
+    parser.add_argument("--docker-jitter", type=float, default=0.0)
+    parser.add_argument("--docker-failure-rate", type=float, default=0.0)
+    parser.add_argument("--nuvla-latency", type=float, default=0.05)
+    parser.add_argument("--nuvla-jitter", type=float, default=0.0)
+    parser.add_argument("--nuvla-failure-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, help="MANAGEMENT_API_WORKERS for the server")
+    parser.add_argument("--threads", type=int, help="MANAGEMENT_API_THREADS for the server")
+    parser.add_argument("--worker-class", help="MANAGEMENT_API_WORKER_CLASS for the server")
+    parser.add_argument("--keepalive", type=int, help="MANAGEMENT_API_KEEPALIVE for the server")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary files, for debugging")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    names = sorted(scenarios) if args.scenario == "all" else [args.scenario]
+
+    results = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                        "commit": git_commit(),
+                        "machine": platform.machine(),
+                        "cpus": os.cpu_count(),
+                        "python": platform.python_version(),
+                        "arguments": vars(args)},
+               "scenarios": {}}
+
+    for name in names:
+        results["scenarios"][name] = run_scenario(name, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,17 +10,25 @@ Arguments:
 
 """
 
+import time
+import_started = time.perf_counter()
+
+import functools
+import hashlib
 import logging
 import os
+import signal
 import subprocess
 import multiprocessing
-import time
 import json
-import nuvla
-from flask import Flask, redirect, request, jsonify, url_for
+import uuid
+from flask import Flask, Response, g, redirect, request, jsonify, stream_with_context, url_for
 from management_api.common import utils
-from management_api import Manage
-from threading import Thread
+from management_api import Manage, admission, budget, certificates, container_logs, docker_client, jobs, metrics, nuvla_session, \
+    health, idempotency, images, logs, outbox, reconciler, server, snapshots, ssh_keys, startup, streamers, \
+    tls, video_devices
+from threading import Lock, Thread
+from concurrent.futures import ThreadPoolExecutor
 
 
 __copyright__ = "Copyright (C) 2020 SixSq"
@@ -29,43 +37,114 @@ __email__ = "support@sixsq.com"
 app = Flask(__name__)
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-logging.basicConfig(format='%(levelname)s - %(funcName)s - %(message)s', level='INFO')
+logs.setup()
 log = logging.getLogger(__name__)
-
-
-def check_authorized_keys_file():
-    """ Makes the initial checks for SSH key management
-    Checks if the authorized keys file exists and gives back its content and path
-
-    :returns authorized_keys_file_content, authorized_keys_file_path: content and path of the authorized keys file"""
-
-    authorized_keys_file = "{}/authorized_keys".format(utils.host_ssh_folder)
-
-    if os.path.isfile(authorized_keys_file):
-        with open(authorized_keys_file) as akr:
-            authorized_keys = akr.read()
-    else:
-        authorized_keys = ''
-
-    return authorized_keys, authorized_keys_file
-
-
-def add_ssh_key(pubkey):
+access_log = logging.getLogger("management_api.access")
+
+# time every management action, including the ones added in the future
+metrics.instrument_module(Manage)
+
+nuvla_session_events = metrics.registry.counter("management_api_nuvla_session_events_total",
+                                                "Nuvla session reuses, logins and re-logins", ("event",))
+jobs_pending = metrics.registry.gauge("management_api_jobs_pending", "Jobs queued or running")
+nuvla_outbox_pending = metrics.registry.gauge("management_api_nuvla_outbox_pending",
+                                              "Nuvla peripheral updates waiting to be delivered")
+nuvla_outbox_events = metrics.registry.counter("management_api_nuvla_outbox_events_total",
+                                               "Nuvla peripheral updates queued, coalesced, delivered, retried "
+                                               "and rejected", ("event",))
+images_ready = metrics.registry.gauge("management_api_image_ready",
+                                      "Whether a data gateway image is available locally", ("image",))
+reconciler_events = metrics.registry.counter("management_api_reconciler_events_total",
+                                             "Reconciliation rounds, repairs, repair failures and orphan "
+                                             "containers found", ("event",))
+tls_sessions = metrics.registry.counter("management_api_tls_sessions_total",
+                                        "TLS handshakes on the API listener, and how many resumed a session",
+                                        ("event",))
+streaming_level = metrics.registry.gauge("management_api_streaming_level",
+                                         "Notches the video settings of the MJPG streamers are below the requested ones")
+admission_in_flight = metrics.registry.gauge("management_api_admission_in_flight",
+                                             "Admitted requests running, per endpoint class", ("lane",))
+admission_waiting = metrics.registry.gauge("management_api_admission_waiting",
+                                           "Requests waiting to be admitted, per endpoint class", ("lane",))
+admission_events = metrics.registry.counter("management_api_admission_events_total",
+                                            "Requests admitted, queued and rejected, per endpoint class",
+                                            ("lane", "event"))
+snapshot_events = metrics.registry.counter("management_api_snapshot_events_total",
+                                          "MJPG streamer snapshots served from cache, grabbed, shared, evicted and failed",
+                                          ("event",))
+raw_samples_pushed = metrics.registry.counter("management_api_raw_samples_pushed_total",
+                                              "Snapshots queued for Nuvla as raw data samples")
+video_devices_count = metrics.registry.gauge("management_api_video_devices",
+                                            "Video devices found on the host")
+log_records_dropped = metrics.registry.counter("management_api_log_records_dropped_total",
+                                               "Log records dropped because the log queue was full")
+
+
+def collect_metrics():
+    """ Refreshes the metrics that are kept outside of the metrics registry """
+    for event, value in nuvla_session.session.get_stats().items():
+        nuvla_session_events.set_total(value, event=event)
+    jobs_pending.set(jobs.queue.depth())
+    nuvla_outbox_pending.set(outbox.outbox.depth())
+    for event, value in outbox.outbox.get_stats().items():
+        nuvla_outbox_events.set_total(value, event=event)
+    for image in images.warmer.status():
+        images_ready.set(int(image["ready"]), image=image["image"])
+    for event, value in reconciler.reconciler.get_stats().items():
+        reconciler_events.set_total(value, event=event)
+    log_records_dropped.set_total(logs.get_stats()["dropped"])
+    for event, value in tls.get_stats().items():
+        tls_sessions.set_total(value, event=event)
+    streaming_level.set(budget.policy.level)
+    video_devices_count.set(video_devices.inventory.get_stats()["devices"])
+    snapshot_stats = snapshots.cache.get_stats()
+    for event in ("hits", "grabs", "shared", "evictions", "errors"):
+        snapshot_events.set_total(snapshot_stats.get(event, 0), event=event)
+    raw_samples_pushed.set_total(snapshots.pusher.get_stats().get("pushed", 0))
+    for lane, stats in admission.controller.get_stats()["lanes"].items():
+        admission_in_flight.set(stats.pop("in-flight"), lane=lane)
+        admission_waiting.set(stats.pop("waiting"), lane=lane)
+        for event in ("admitted", "queued", "rejected-queue-full", "rejected-busy", "rejected-timeout"):
+            admission_events.set_total(stats.get(event, 0), lane=lane, event=event)
+
+
+metrics.registry.add_collector(collect_metrics)
+
+
+def start_background_services():
+    """ Starts the background threads of the worker process that serves the API """
+    startup.require("background-services", "docker")
+    with startup.phase("background-services"):
+        docker_client.registry.add_listener(track_docker_readiness)
+        docker_client.registry.add_listener(snapshots.on_container_event)
+        docker_client.registry.start()
+        images.warmer.start(Manage.data_gateway_images.values())
+        outbox.outbox.start()
+        reconciler.reconciler.start()
+        budget.policy.start()
+        video_devices.inventory.start()
+        health.serve()
+    startup.set_check("background-services", True)
+
+
+def track_docker_readiness(action, name, container):
+    """ Container registry listener. We're ready to serve once the containers have been loaded from Docker """
+    if action == "refreshed":
+        startup.set_check("docker", True)
+
+
+def add_ssh_key(pubkey, managed=True):
     """ Adds a public SSH key to the host's root authorized keys
 
     :param pubkey: string containing the full public key
+    :param managed: whether the key can later be removed by an SSH key sync
     """
 
-    authorized_keys, authorized_keys_file = check_authorized_keys_file()
-
-    with open(authorized_keys_file, 'a+') as ak:
-        keys = pubkey.replace('\\n', '\n').splitlines()
-        for key in keys:
-            if key not in authorized_keys:
-                ak.write("\n{}\n".format(key))
-                log.info("SSH public key added to host user {}: {}".format(utils.ssh_user, key))
-            else:
-                log.info("SSH public key {} already added to host. Skipping it".format(key))
+    added, skipped = ssh_keys.store.add(pubkey, managed=managed)
+    for key in added:
+        log.info("SSH public key added to host user %s: %s", utils.ssh_user, key.describe())
+    for key in skipped:
+        log.info("SSH public key %s already added to host. Skipping it", key.describe())
 
 
 def remove_ssh_key(pubkey):
@@ -74,21 +153,14 @@ def remove_ssh_key(pubkey):
     :param pubkey: string containing the full public key
     """
 
-    authorized_keys, authorized_keys_file = check_authorized_keys_file()
-
-    # in case the passed value has more than 1 public SSH key
-    revoke_keys = pubkey.replace('\\n', '\n').splitlines()
-    final_keys = authorized_keys.splitlines()
-    for key in revoke_keys:
-        if key in final_keys:
-            final_keys.remove(key)
+    removed = ssh_keys.store.remove(pubkey)
 
-    if final_keys != authorized_keys.splitlines():
-        with open(authorized_keys_file, 'w') as ak:
-            ak.write("\n".join(final_keys))
-        log.info("SSH public key removed from host user {}: {}".format(utils.ssh_user, pubkey))
+    if removed:
+        log.info("SSH public key removed from host user %s: %s", utils.ssh_user,
+                 ", ".join(key.describe() for key in removed))
     else:
-        log.info("The provided SSH public key {} is not in the host's authorized keys. Nothing to do".format(pubkey))
+        log.info("The provided SSH public key %s is not in the host's authorized keys. Nothing to do",
+                 logs.Lazy(ssh_keys.describe, pubkey))
 
 
 def default_ssh_key():
@@ -97,8 +169,9 @@ def default_ssh_key():
     """
 
     if utils.provided_pubkey:
-        log.info("Environment variable NUVLABOX_SSH_PUB_KEY found. Adding key to host user {}".format(utils.ssh_user))
-        add_ssh_key(utils.provided_pubkey)
+        log.info("Environment variable NUVLABOX_SSH_PUB_KEY found. Adding key to host user %s", utils.ssh_user)
+        # not managed: a sync from Nuvla must not remove the key the NuvlaBox was installed with
+        add_ssh_key(utils.provided_pubkey, managed=False)
 
 
 def wait_for_certificates():
@@ -107,46 +180,184 @@ def wait_for_certificates():
     log.info("Re-using compute-api SSL certificates for NuvlaBox Management API")
     log.info("Waiting for compute-api to generate SSL certificates...")
 
-    while not os.path.exists("{}/{}".format(utils.nuvlabox_api_certs_folder, utils.server_cert_file)) or \
-            not os.path.exists("{}/{}".format(utils.nuvlabox_api_certs_folder, utils.server_key_file)) or \
-            not os.path.exists("{}/{}".format(utils.nuvlabox_api_certs_folder, utils.ca_file)):
+    certificates.watcher.wait_until_ready()
+
 
-        time.sleep(3)
+def get_container_logs(container):
+    """ Fetches the last lines of the logs of a container, capped in size
+
+    :param container: docker Container object
+    :returns logs, as a string
+    """
+    return container_logs.bounded_logs(container)
 
 
 def request_stop_mjpg_streamer_container(name, nuvla_resource_id):
-    log.info("Stopping container {}".format(name))
+    log.info("Stopping container %s", name)
     Manage.stop_container_data_source_mjpg(name)
-    try:
-        log.info("Updating {} in Nuvla".format(nuvla_resource_id))
-        Manage.update_peripheral_resource(nuvla_resource_id, data_gateway_enabled=False)
-    except nuvla.api.api.NuvlaError as e:
-        if e.response.status_code == 404:
-            log.warning("Peripheral {} has already been delete in Nuvla. Nothing to do".format(nuvla_resource_id))
-            # this action was triggered by the deletion of the peripheral,
-            # so it's normal that it does not exist anymore
-            pass
-        else:
-            log.exception("Could not update {} in Nuvla. Trying a second time...".format(nuvla_resource_id))
-            # try again. If still fails, then raise the exception
-            Manage.update_peripheral_resource(nuvla_resource_id, data_gateway_enabled=False)
+
+    log.info("Queuing update of %s in Nuvla", nuvla_resource_id)
+    # delivered in the background, and retried if Nuvla can't be reached.
+    # A missing peripheral is fine: this action might have been triggered by its deletion
+    outbox.outbox.send(nuvla_resource_id, data_gateway_enabled=False)
 
 
 def request_start_mjpg_streamer_container(name, nuvla_resource_id, device, resolution, fps):
-    log.info("Launching MJPG streamer container {} for {}".format(name, device))
+    log.info("Launching MJPG streamer container %s for %s", name, device)
     local_data_gateway_endpoint, container = Manage.start_container_data_source_mjpg(name,
                                                                                      device,
                                                                                      resolution,
                                                                                      fps)
+    streamers.store.update(name,
+                           id=nuvla_resource_id,
+                           endpoint=local_data_gateway_endpoint,
+                           status=container.status,
+                           resolution=resolution,
+                           fps=int(fps),
+                           **{"video-device": device})
+
     if container.status.lower() == 'created':
-        log.info("MJPG streamer {} successfully created. Updating {} in Nuvla".format(name, nuvla_resource_id))
+        log.info("MJPG streamer %s successfully created. Queuing update of %s in Nuvla", name, nuvla_resource_id)
 
-        Manage.update_peripheral_resource(nuvla_resource_id, local_data_gateway_endpoint=local_data_gateway_endpoint)
-        return True, container.logs().decode('utf-8')
+        outbox.outbox.send(nuvla_resource_id, local_data_gateway_endpoint=local_data_gateway_endpoint,
+                           **budget.nuvla_update(container))
+        return True, get_container_logs(container)
     else:
-        log.error("MJPG streamer {} could not be started: {}".format(name, container.status))
+        log.error("MJPG streamer %s could not be started: %s", name, container.status)
+
+        return False, get_container_logs(container)
+
+
+PUBKEY_SCHEMA = {"content-type": "text/plain",
+                 "description": "one or more public SSH keys, one per line"}
 
-        return False, container.logs().decode('utf-8')
+MJPG_SCHEMA = {"content-type": "application/json",
+               "type": "object",
+               "required": ["id", "video-device"],
+               "properties": {"id": {"type": "string", "description": "Nuvla peripheral resource id"},
+                              "video-device": {"type": "string", "description": "i.e. /dev/video0"},
+                              "resolution": {"type": "string", "default": "1280x720"},
+                              "fps": {"type": "integer", "default": 15}}}
+
+
+def payload_schema(schema):
+    """ Documents the payload expected by an endpoint, in the self-discovery document.
+    Must be placed below @app.route
+
+    :param schema: JSON schema-like description of the payload
+    """
+    def decorator(func):
+        func.payload_schema = schema
+        return func
+    return decorator
+
+
+def admitted(lane):
+    """ Limits how many requests of an expensive class of endpoints run at once, failing fast when saturated.
+    Must be placed below @app.route
+
+    :param lane: admission lane of the endpoint
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not admission.enabled:
+                return func(*args, **kwargs)
+
+            try:
+                ticket = admission.controller.acquire(lane)
+            except admission.Rejected as e:
+                response = jsonify(dict(utils.return_429 if e.status == 429 else utils.return_503, message=str(e)))
+                response.status_code = e.status
+                response.headers["Retry-After"] = str(e.retry_after)
+                return response
+
+            try:
+                response = app.make_response(func(*args, **kwargs))
+            except BaseException:
+                ticket.release()
+                raise
+
+            if response.is_streamed:
+                # i.e. logs: the request is only done once the whole response is sent
+                response.call_on_close(ticket.release)
+            else:
+                ticket.release()
+            return response
+
+        return wrapper
+    return decorator
+
+
+def idempotent(func):
+    """ Replays the original response to requests re-sent with the same Idempotency-Key header.
+    Must be placed below @app.route
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(idempotency.header)
+        if not key:
+            return func(*args, **kwargs)
+
+        def run():
+            response = app.make_response(func(*args, **kwargs))
+            return response.get_data(), response.status_code, response.mimetype
+
+        try:
+            (body, status, mimetype), replayed = idempotency.cache.run(key,
+                                                                      idempotency.fingerprint(request.method,
+                                                                                              request.path,
+                                                                                              request.get_data()),
+                                                                      run)
+        except idempotency.KeyReused as e:
+            return jsonify(dict(utils.return_409, message=str(e))), utils.return_409['status']
+
+        response = Response(body, status=status, mimetype=mimetype)
+        if replayed:
+            log.info("Replaying response for %s %s", idempotency.header, key)
+            response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    return wrapper
+
+
+def metrics_route():
+    # bounded set of label values: the route rule, not the actual path
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.metrics_route = metrics_route()
+    metrics.http_requests_in_flight.inc(route=g.metrics_route)
+    health.worker_pool.started()
+
+    # the caller's request id, if it has one, so that the logs can be correlated
+    g.request_id = request.headers.get("X-Request-Id", "")[:64] or uuid.uuid4().hex[:16]
+    logs.bind(request_id=g.request_id)
+
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start" in g:
+        duration = time.perf_counter() - g.request_start
+        labels = dict(route=g.metrics_route, method=request.method, status=str(response.status_code))
+        metrics.http_requests.inc(**labels)
+        metrics.http_request_duration.observe(duration, **labels)
+        access_log.info("%s %s %s", request.method, request.path, response.status_code,
+                        extra={"duration": round(duration, 4), "status": response.status_code})
+    if "request_id" in g:
+        response.headers["X-Request-Id"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exc):
+    if "metrics_route" in g:
+        metrics.http_requests_in_flight.dec(route=g.metrics_route)
+        health.worker_pool.finished()
+    logs.clear()
 
 
 @app.errorhandler(404)
@@ -167,18 +378,118 @@ def root():
     return redirect("/api", code=302)
 
 
-@app.route("/api")
-def self_discovery():
-    # return a list of all api endpoints
+def build_self_discovery():
+    """ Builds the self-discovery document, with the methods and expected payload of every endpoint
+
+    :returns (serialized JSON body, ETag)
+    """
     links = []
+    endpoints = {}
     for rule in app.url_map.iter_rules():
         if rule.endpoint != 'static':
-            url = url_for(rule.endpoint, **(rule.defaults or {}))
+            if rule.arguments - set(rule.defaults or {}):
+                # parameterized endpoint, like /api/jobs/<job_id>
+                url = rule.rule
+            else:
+                url = url_for(rule.endpoint, **(rule.defaults or {}))
             links.append(url)
-    return jsonify({"nuvlabox-api-endpoints": links}), 200
+            endpoints[url] = {"methods": sorted(rule.methods - {"HEAD", "OPTIONS"}),
+                              "payload": getattr(app.view_functions[rule.endpoint], "payload_schema", None)}
+
+    body = json.dumps({"nuvlabox-api-endpoints": links, "nuvlabox-api": endpoints}, sort_keys=True)
+    return body, hashlib.sha256(body.encode()).hexdigest()[:32]
+
+
+self_discovery_cache = {}
+self_discovery_lock = Lock()
+
+
+@app.route("/api")
+def self_discovery():
+    # return a list of all api endpoints.
+    # The routes don't change after startup, so the document is built once, on the first request
+    if not self_discovery_cache:
+        with self_discovery_lock:
+            if not self_discovery_cache:
+                self_discovery_cache["body"], self_discovery_cache["etag"] = build_self_discovery()
+
+    etag = self_discovery_cache["etag"]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(self_discovery_cache["body"], mimetype="application/json")
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "max-age=3600"
+    return response
+
+
+@app.route("/api/live")
+def liveness():
+    # the process is up and serving requests. Says nothing about whether it's ready
+    return jsonify(dict(utils.return_200, message="alive")), utils.return_200['status']
+
+
+@app.route("/api/ready")
+def readiness():
+    # whether the startup has completed and the Docker state is loaded
+    startup.set_check("docker", docker_client.registry.synced)
+    if not startup.is_ready():
+        return jsonify(dict(utils.return_503, message="not ready", checks=startup.report()["checks"])), \
+               utils.return_503['status']
+
+    return jsonify(dict(utils.return_200, message="ready")), utils.return_200['status']
+
+
+@app.route("/api/health")
+def get_health():
+    # status of the dependencies. Cached for a few seconds, so it's cheap to probe
+    report = health.checker.report()
+    if not report["healthy"]:
+        return jsonify(dict(utils.return_503, message="unhealthy", **report)), utils.return_503['status']
+
+    return jsonify(dict(utils.return_200, message="healthy", **report)), utils.return_200['status']
+
+
+@app.route("/api/status")
+def get_status():
+    # startup phases and timings, readiness and uptime
+    startup.set_check("docker", docker_client.registry.synced)
+    return jsonify(dict(startup.report(),
+                        pid=os.getpid(),
+                        images=images.warmer.all_ready(),
+                        tls=tls.get_stats(),
+                        admission=admission.controller.get_stats(),
+                        streaming=budget.policy.get_stats(),
+                        reconciler=dict(reconciler.reconciler.get_stats(), orphans=reconciler.reconciler.orphans()),
+                        snapshots=dict(snapshots.cache.get_stats(), samples=snapshots.pusher.get_stats()),
+                        **{"video-devices": video_devices.inventory.get_stats()},
+                        **{"jobs-pending": jobs.queue.depth(),
+                           "nuvla-updates-pending": outbox.outbox.depth()})), utils.return_200['status']
+
+
+@app.route("/api/metrics")
+def get_metrics():
+    # request, management action and external call metrics, in the Prometheus text format
+    return Response(metrics.registry.render(), content_type=metrics.content_type), utils.return_200['status']
+
+
+@app.route("/api/images")
+def get_images():
+    # reports on the background pull of the data gateway images
+    return jsonify({"ready": images.warmer.all_ready(),
+                    "images": images.warmer.status()}), utils.return_200['status']
+
+
+@app.route("/api/video-devices")
+def get_video_devices():
+    # video devices of the host, with the formats, resolutions and frame rates they can capture
+    return jsonify(dict(video_devices.inventory.get_stats(),
+                        **{"video-devices": video_devices.inventory.list()})), utils.return_200['status']
 
 
 @app.route("/api/reboot", methods=['POST'])
+@admitted("reboot")
 def reboot():
     # reboot the host
 
@@ -189,12 +500,14 @@ def reboot():
 
 
 @app.route("/api/add-ssh-key", methods=['POST'])
+@payload_schema(PUBKEY_SCHEMA)
+@admitted("ssh-keys")
 def accept_new_ssh_key():
     # adds an SSH key into the host's authorized keys
     # the payload is the public key is, raw
     payload = request.data.decode('UTF-8')
 
-    log.info("Received request to add public SSH key to host: {}".format(payload))
+    log.info("Received request to add public SSH key to host: %s", logs.Lazy(ssh_keys.describe, payload))
 
     if not payload or not isinstance(payload, str):
         return jsonify(dict(utils.return_400, message="Payload should match a valid public SSH key. Recevied: %s" %
@@ -205,8 +518,10 @@ def accept_new_ssh_key():
         add_ssh_key(payload)
         return jsonify(dict(utils.return_200, message="Added public SSH key to host: {}".format(payload))), \
                utils.return_200['status']
+    except ValueError as e:
+        return jsonify(dict(utils.return_400, message=str(e))), utils.return_400['status']
     except Exception as e:
-        log.exception("Cannot add public SSH key to host: {}".format(e))
+        log.exception("Cannot add public SSH key to host: %s", e)
         if e.status_code:
             return jsonify(dict(utils.return_500, message=str(e), status=e.status_code)), e.status_code
         else:
@@ -214,12 +529,14 @@ def accept_new_ssh_key():
 
 
 @app.route("/api/revoke-ssh-key", methods=['POST'])
+@payload_schema(PUBKEY_SCHEMA)
+@admitted("ssh-keys")
 def revoke_ssh_key():
     # removes the SSH public key passed in the payload,
     # from the host's authorized keys
     payload = request.data.decode('UTF-8')
 
-    log.info("Received request to revoke public SSH key from host: {}".format(payload))
+    log.info("Received request to revoke public SSH key from host: %s", logs.Lazy(ssh_keys.describe, payload))
 
     if not payload or not isinstance(payload, str):
         return jsonify(dict(utils.return_400, message="Payload should match a valid public SSH key. Recevied: %s" %
@@ -231,16 +548,182 @@ def revoke_ssh_key():
         return jsonify(dict(utils.return_200, message="Removed SSH key from host: {}".format(payload))), \
                utils.return_200['status']
     except Exception as e:
-        log.exception("Cannot revoke public SSH key from host: {}".format(e))
+        log.exception("Cannot revoke public SSH key from host: %s", e)
         if e.status_code:
             return jsonify(dict(utils.return_500, message=str(e), status=e.status_code)), e.status_code
         else:
             return jsonify(dict(utils.return_500, message=str(e))), utils.return_500['status']
 
 
+@app.route("/api/ssh-keys/sync", methods=['POST'])
+@payload_schema({"content-type": "application/json",
+                 "type": "object",
+                 "required": ["keys"],
+                 "properties": {"keys": {"type": "array", "items": {"type": "string"},
+                                         "description": "all the public SSH keys that should be authorized"}}})
+@admitted("ssh-keys")
+def sync_ssh_keys():
+    # makes the SSH keys managed by this API match the ones in the payload, in a single write.
+    # Keys that were not added through this API are left untouched
+    #
+    # payload looks like:
+    # { "keys": [str] }
+    # or the raw public keys, one per line
+    #
+    # an empty set of keys removes all the managed keys, so it's only taken as { "keys": [] },
+    # never from an empty or garbled payload
+    explicit = False
+    try:
+        text = request.data.decode('UTF-8')
+    except UnicodeDecodeError:
+        text = None
+
+    if not text or not text.strip():
+        desired = None
+    else:
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            desired = ssh_keys.split_keys(text)
+        else:
+            explicit = isinstance(payload, dict) and "keys" in payload
+            desired = payload.get("keys") if isinstance(payload, dict) else payload
+
+    if not isinstance(desired, list) or not all(isinstance(k, str) for k in desired):
+        return jsonify(dict(utils.return_400, message="Payload should contain a list of public SSH keys")), \
+               utils.return_400['status']
+
+    if not desired and not explicit:
+        return jsonify(dict(utils.return_400, message='No public SSH keys in payload. To remove all the managed '
+                                                      'keys, send {"keys": []}')), \
+               utils.return_400['status']
+
+    log.info("Received request to sync %d public SSH keys", len(desired))
+
+    try:
+        added, removed, unchanged = ssh_keys.store.sync(desired)
+    except ValueError as e:
+        return jsonify(dict(utils.return_400, message=str(e))), utils.return_400['status']
+    except Exception as e:
+        log.exception("Cannot sync public SSH keys in host: %s", e)
+        return jsonify(dict(utils.return_500, message=str(e))), utils.return_500['status']
+
+    log.info("SSH keys synced for host user %s: %d added, %d removed", utils.ssh_user, len(added), len(removed))
+
+    return jsonify(dict(utils.return_200,
+                        message="SSH keys synced: {} added, {} removed".format(len(added), len(removed)),
+                        added=[str(k) for k in added],
+                        removed=[str(k) for k in removed],
+                        unchanged=[str(k) for k in unchanged])), utils.return_200['status']
+
+
+def enable_data_source_mjpg_job(job, name, nuvla_resource_id, device, resolution, fps):
+    """ Job for starting an MJPG streamer
+
+    :param job: the Job object running this function
+    :returns job result message
+    """
+    if Manage.data_source_mjpg_matches(name, device, resolution, fps):
+        streamers.store.update(name, id=nuvla_resource_id)
+        return "MJPG streamer already running"
+
+    job.set_progress(10, "launching MJPG streamer container")
+    success, logs = request_start_mjpg_streamer_container(name, nuvla_resource_id, device, resolution, fps)
+    job.logs = logs
+
+    if not success:
+        raise Exception("MJPG streamer {} could not be started".format(name))
+
+    return "MJPG streamer started!"
+
+
+def disable_data_source_mjpg_job(job, name, nuvla_resource_id):
+    """ Job for stopping an MJPG streamer
+
+    :param job: the Job object running this function
+    :returns job result message
+    """
+    job.set_progress(10, "stopping MJPG streamer container")
+    request_stop_mjpg_streamer_container(name, nuvla_resource_id)
+    streamers.store.remove(name)
+
+    return "MJPG streamer stopped for %s" % nuvla_resource_id
+
+
+def restart_data_source_mjpg_job(job, name, nuvla_resource_id, device):
+    """ Job for restarting an MJPG streamer, re-using its previous resolution and fps
+
+    :param job: the Job object running this function
+    :returns job result message
+    """
+    streamer = streamers.store.get(name)
+    if streamer and "resolution" in streamer and "fps" in streamer:
+        resolution = streamer["resolution"]
+        fps = streamer["fps"]
+    else:
+        # not managed by this service yet. Fall back to the container configuration
+        get_env = Manage.find_container_env_vars(name, keys=["RESOLUTION", "FPS", "REQUESTED_RESOLUTION",
+                                                             "REQUESTED_FPS"])
+        resolution = get_env.get("REQUESTED_RESOLUTION", get_env.get("RESOLUTION", "1280x720"))
+        fps = get_env.get("REQUESTED_FPS", get_env.get("FPS", 15))
+
+    # before stopping the current streamer, in case the new one can't be started
+    video_devices.inventory.validate(device, resolution)
+
+    job.set_progress(10, "stopping MJPG streamer container")
+    try:
+        request_stop_mjpg_streamer_container(name, nuvla_resource_id)
+    except Exception:
+        log.exception("Cannot restart stream (old streamer might be in a faulty state)")
+        raise
+
+    job.set_progress(50, "launching MJPG streamer container")
+    success, logs = request_start_mjpg_streamer_container(name, nuvla_resource_id, device, resolution, fps)
+    job.logs = logs
+
+    if not success:
+        raise Exception("MJPG streamer {} could not be restarted".format(name))
+
+    return "MJPG streamer restarted!"
+
+
+def submit_job(action, name, func, *args):
+    """ Submits a job to the job queue and builds the respective HTTP response
+
+    :param action: name of the action
+    :param name: name of the container the job acts upon
+    :param func: job function
+    :returns Flask response tuple
+    """
+    try:
+        job = jobs.queue.submit(action, name, func, name, *args)
+    except jobs.QueueFull as e:
+        return jsonify(dict(utils.return_503, message=str(e))), utils.return_503['status']
+
+    return jsonify(dict(utils.return_202,
+                        message="{} accepted for {}".format(action, name),
+                        **{"job-id": job.id,
+                           "job": url_for("get_job", job_id=job.id)})), utils.return_202['status']
+
+
+@app.route("/api/jobs/<job_id>")
+def get_job(job_id):
+    # reports on the state, progress, result and logs of an asynchronous job
+    job = jobs.queue.get(job_id)
+
+    if not job:
+        return jsonify(dict(utils.return_404, message="Job {} not found".format(job_id))), \
+               utils.return_404['status']
+
+    return jsonify(job.to_dict()), utils.return_200['status']
+
+
 @app.route("/api/data-source-mjpg/enable", methods=['POST'])
+@payload_schema(MJPG_SCHEMA)
+@admitted("data-source-mjpg")
+@idempotent
 def enable_data_source_mjpg():
-    # enable data gateway for mjpg
+    # enable data gateway for mjpg, asynchronously
     #
     # payload looks like:
     # { "id": str, "resolution": str, "fps": int, "video-device": str }
@@ -263,29 +746,29 @@ def enable_data_source_mjpg():
     except KeyError:
         fps = 15
 
-    log.info("Received /api/data-source-mjpg/enable request with payload: {}".format(payload))
+    log.info("Received /api/data-source-mjpg/enable request with payload: %s", logs.truncated(payload))
 
     try:
-        success, container_logs = request_start_mjpg_streamer_container(name, payload['id'],
-                                                                        payload['video-device'],
-                                                                        resolution,
-                                                                        fps)
+        video_devices.inventory.validate(payload['video-device'], resolution)
+    except video_devices.InvalidVideoDevice as e:
+        return jsonify(dict(utils.return_400, message=str(e))), utils.return_400['status']
+
+    if not jobs.queue.busy(name) and Manage.data_source_mjpg_matches(name, payload['video-device'], resolution, fps):
+        # nothing to do, i.e. a retry of a request that has already been served
+        streamers.store.update(name, id=payload['id'])
+        return jsonify(dict(utils.return_200, message="MJPG streamer {} is already running".format(name))), \
+               utils.return_200['status']
 
-        if success:
-            return jsonify(dict(utils.return_200, message="MJPG streamer started!")), utils.return_200['status']
-        else:
-            return jsonify(dict(utils.return_400, message=container_logs)), utils.return_400['status']
-    except Exception as e:
-        log.exception("Cannot enable stream: {}".format(e))
-        if e.status_code:
-            return jsonify(dict(utils.return_500, message=str(e), status=e.status_code)), e.status_code
-        else:
-            return jsonify(dict(utils.return_500, message=str(e))), utils.return_500['status']
+    return submit_job("enable-data-source-mjpg", name, enable_data_source_mjpg_job,
+                      payload['id'], payload['video-device'], resolution, fps)
 
 
 @app.route("/api/data-source-mjpg/disable", methods=['POST'])
+@payload_schema(dict(MJPG_SCHEMA, required=["id"], properties={"id": MJPG_SCHEMA["properties"]["id"]}))
+@admitted("data-source-mjpg")
+@idempotent
 def disable_data_source_mjpg():
-    # disable data gateway for mjpg
+    # disable data gateway for mjpg, asynchronously
     #
     # payload looks like:
     # { "id": str }
@@ -298,24 +781,24 @@ def disable_data_source_mjpg():
 
     name = payload['id'].split("/")[-1]
 
-    log.info("Received /api/data-source-mjpg/disable request with payload: {}".format(payload))
+    log.info("Received /api/data-source-mjpg/disable request with payload: %s", logs.truncated(payload))
 
-    try:
-        request_stop_mjpg_streamer_container(name, payload['id'])
-
-        return jsonify(dict(utils.return_200, message="MJPG streamer stopped for %s" % payload['id'])), \
+    if not jobs.queue.busy(name) and not docker_client.registry.may_exist(name) and not streamers.store.get(name):
+        # no Docker work, but Nuvla might still think it's enabled (i.e. the container was removed by hand,
+        # or an earlier update was dropped). The outbox coalesces repeated updates
+        outbox.outbox.send(payload['id'], data_gateway_enabled=False)
+        return jsonify(dict(utils.return_200, message="MJPG streamer {} is already stopped".format(name))), \
                utils.return_200['status']
-    except Exception as e:
-        log.exception("Cannot disable stream: {}".format(e))
-        if e.status_code:
-            return jsonify(dict(utils.return_500, message=str(e), status=e.status_code)), e.status_code
-        else:
-            return jsonify(dict(utils.return_500, message=str(e))), utils.return_500['status']
+
+    return submit_job("disable-data-source-mjpg", name, disable_data_source_mjpg_job, payload['id'])
 
 
 @app.route("/api/data-source-mjpg/restart", methods=['POST'])
+@payload_schema(dict(MJPG_SCHEMA, properties={k: MJPG_SCHEMA["properties"][k] for k in ("id", "video-device")}))
+@admitted("data-source-mjpg")
+@idempotent
 def restart_data_source_mjpg():
-    # restart data gateway for mjpg
+    # restart data gateway for mjpg, asynchronously
     #
     # payload looks like:
     # { "id": str, "video-device": str }
@@ -328,58 +811,310 @@ def restart_data_source_mjpg():
 
     name = payload['id'].split("/")[-1]
 
-    get_env = Manage.find_container_env_vars(name, keys=["RESOLUTION", "FPS"])
-    resolution = get_env.get("RESOLUTION", "1280x720")
-    fps = get_env.get("FPS", 15)
+    log.info("Received /api/data-source-mjpg/restart request with payload: %s", logs.truncated(payload))
+
+    try:
+        # the resolution is checked by the job, once it's known
+        video_devices.inventory.validate(payload['video-device'])
+    except video_devices.InvalidVideoDevice as e:
+        return jsonify(dict(utils.return_400, message=str(e))), utils.return_400['status']
 
-    log.info("Received /api/data-source-mjpg/restart request with payload: {}".format(payload))
+    return submit_job("restart-data-source-mjpg", name, restart_data_source_mjpg_job,
+                      payload['id'], payload['video-device'])
+
+
+@app.route("/api/data-source-mjpg")
+def list_data_source_mjpg():
+    # lists the MJPG streamers managed by this service, from the local state store
+    docker_client.registry.start()
+
+    return jsonify({"streamers": streamers.store.list(),
+                    "synced": docker_client.registry.synced}), utils.return_200['status']
+
+
+@app.route("/api/data-source-mjpg/<name>/logs")
+@admitted("data-source-mjpg-logs")
+def data_source_mjpg_logs(name):
+    # streams the logs of an MJPG streamer, as they are read from Docker
+    #
+    # query parameters:
+    #   since: UNIX timestamp, in whole seconds. Only logs after this time
+    #   follow: true|false. Keep streaming new logs (default false)
+    #   tail: number of lines from the end of the logs (default all)
+    #   timestamps: true|false. Prefix the lines with their timestamp (default false)
+    #
+    # sent as Server-Sent Events if the client accepts text/event-stream, or as chunked plain text otherwise
+    from docker.errors import APIError, NotFound
+    from requests import RequestException
 
     try:
-        request_stop_mjpg_streamer_container(name, payload['id'])
-        success, container_logs = request_start_mjpg_streamer_container(name, payload['id'],
-                                                                        payload['video-device'],
-                                                                        resolution,
-                                                                        fps)
-
-        if success:
-            return jsonify(dict(utils.return_200, message="MJPG streamer restarted!")), utils.return_200['status']
-        else:
-            return jsonify(dict(utils.return_400, message=container_logs)), utils.return_400['status']
+        since = int(request.args['since']) if request.args.get('since') else None
+        tail = request.args.get('tail', 'all')
+        tail = tail if tail == 'all' else int(tail)
+    except ValueError:
+        return jsonify(dict(utils.return_400, message="since and tail must be integers")), \
+               utils.return_400['status']
+
+    if since is not None and since <= 0:
+        return jsonify(dict(utils.return_400, message="since must be a UNIX timestamp, greater than 0")), \
+               utils.return_400['status']
+
+    container = Manage.get_data_source_container(name)
+    if container is None:
+        return jsonify(dict(utils.return_404, message="MJPG streamer {} not found".format(name))), \
+               utils.return_404['status']
+
+    # opened before the response starts, so that Docker errors get a proper status
+    try:
+        chunks = container_logs.stream_logs(container,
+                                            since=since,
+                                            follow=server.to_bool(request.args.get('follow', 'false')),
+                                            tail=tail,
+                                            timestamps=server.to_bool(request.args.get('timestamps', 'false')))
+    except NotFound:
+        return jsonify(dict(utils.return_404, message="MJPG streamer {} not found".format(name))), \
+               utils.return_404['status']
+    except APIError as e:
+        log.warning("Cannot get the logs of %s: %s", name, e)
+        if e.is_client_error():
+            return jsonify(dict(utils.return_400, message=str(e.explanation or e))), utils.return_400['status']
+        return jsonify(dict(utils.return_502, message="Docker error: {}".format(e.explanation or e))), \
+               utils.return_502['status']
+    except RequestException as e:
+        log.warning("Cannot get the logs of %s: %s", name, e)
+        return jsonify(dict(utils.return_503, message="Docker is not reachable")), utils.return_503['status']
+
+    if request.accept_mimetypes.best_match(["text/plain", "text/event-stream"]) == "text/event-stream":
+        response = Response(stream_with_context(container_logs.server_sent_events(chunks)),
+                            mimetype="text/event-stream")
+    else:
+        response = Response(stream_with_context(chunks), mimetype="text/plain")
+
+    response.call_on_close(chunks.close)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/api/data-source-mjpg/<name>/snapshot")
+@admitted("data-source-mjpg-snapshot")
+def data_source_mjpg_snapshot(name):
+    # a single JPEG frame of an MJPG streamer. Frames are cached for a few seconds, and shared by all the
+    # requests for the same streamer in the meantime. Supports conditional requests, with If-None-Match
+    container = Manage.get_data_source_container(name)
+    if container is None:
+        return jsonify(dict(utils.return_404, message="MJPG streamer {} not found".format(name))), \
+               utils.return_404['status']
+
+    if container.status != "running":
+        return jsonify(dict(utils.return_409, message="MJPG streamer {} is {}".format(name, container.status))), \
+               utils.return_409['status']
+
+    try:
+        snapshot = snapshots.cache.get(name)
+    except snapshots.SnapshotError as e:
+        log.warning("%s", e)
+        return jsonify(dict(utils.return_502, message=str(e))), utils.return_502['status']
+
+    # throttled, so most snapshots are not sent
+    snapshots.pusher.push(snapshot)
+
+    if request.if_none_match.contains(snapshot.etag):
+        response = Response(status=304)
+    else:
+        response = Response(snapshot.image, mimetype="image/jpeg")
+
+    response.set_etag(snapshot.etag)
+    response.last_modified = snapshot.grabbed
+    response.headers["Cache-Control"] = "max-age={}".format(int(max(snapshots.cache.ttl - snapshot.age, 0)))
+    return response
+
+
+def run_data_source_mjpg_batch_item(item):
+    """ Starts or stops a single MJPG streamer from a batch, without updating Nuvla
+
+    :param item: validated batch entry
+    :returns (item result, pending Nuvla peripheral update or None)
+    """
+    name = item['id'].split("/")[-1]
+    result = {"id": item['id'], "action": item['action']}
+
+    try:
+        if item['action'] == 'disable':
+            Manage.stop_container_data_source_mjpg(name)
+            streamers.store.remove(name)
+            result.update(success=True, message="MJPG streamer stopped")
+            return result, {"data_gateway_enabled": False}
+
+        if Manage.data_source_mjpg_matches(name, item['video-device'], item.get('resolution', "1280x720"),
+                                           item.get('fps', 15)):
+            streamers.store.update(name, id=item['id'])
+            result.update(success=True, message="MJPG streamer already running")
+            return result, None
+
+        endpoint, container = Manage.start_container_data_source_mjpg(name,
+                                                                      item['video-device'],
+                                                                      item.get('resolution', "1280x720"),
+                                                                      int(item.get('fps', 15)))
+        streamers.store.update(name,
+                               id=item['id'],
+                               endpoint=endpoint,
+                               status=container.status,
+                               resolution=item.get('resolution', "1280x720"),
+                               fps=int(item.get('fps', 15)),
+                               **{"video-device": item['video-device']})
+        if container.status.lower() == 'created':
+            result.update(success=True, message="MJPG streamer started")
+            return result, dict(local_data_gateway_endpoint=endpoint, **budget.nuvla_update(container))
+
+        result.update(success=False, message="MJPG streamer could not be started: {}".format(container.status),
+                      logs=get_container_logs(container))
+    except video_devices.InvalidVideoDevice as e:
+        result.update(success=False, message=str(e))
     except Exception as e:
-        log.exception("Cannot restart stream (old streamer might be in a faulty state): {}".format(e))
-        if e.status_code:
-            return jsonify(dict(utils.return_500, message=str(e), status=e.status_code)), e.status_code
-        else:
-            return jsonify(dict(utils.return_500, message=str(e))), utils.return_500['status']
+        log.exception("Batch %s failed for %s", item['action'], item['id'])
+        result.update(success=False, message=str(e))
+
+    return result, None
+
+
+def data_source_mjpg_batch_job(job, items, parallelism):
+    """ Job for starting and stopping many MJPG streamers at once.
+    Containers are handled concurrently, and the Nuvla updates are handed over to the outbox at the end
+
+    :param job: the Job object running this function
+    :param items: validated batch entries
+    :param parallelism: max number of containers to handle concurrently
+    :returns list of per item results
+    """
+    job.set_progress(5, "handling {} MJPG streamers".format(len(items)))
+    with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="batch-worker") as executor:
+        outcomes = list(executor.map(run_data_source_mjpg_batch_item, items))
+
+    job.set_progress(90, "queuing peripheral updates for Nuvla")
+    results = []
+    for result, nuvla_update in outcomes:
+        if nuvla_update is not None:
+            outbox.outbox.send(result['id'], **nuvla_update)
+            result['nuvla-update'] = "queued"
+
+        results.append(result)
+
+    return results
+
+
+@app.route("/api/data-source-mjpg/batch", methods=['POST'])
+@payload_schema({"content-type": "application/json",
+                 "type": "object",
+                 "required": ["items"],
+                 "properties": {"items": {"type": "array",
+                                          "items": dict(MJPG_SCHEMA,
+                                                        required=["id"],
+                                                        properties=dict(MJPG_SCHEMA["properties"],
+                                                                        action={"type": "string",
+                                                                                "enum": ["enable", "disable"],
+                                                                                "default": "enable"}))},
+                                "parallelism": {"type": "integer", "default": utils.batch_parallelism}}})
+@admitted("data-source-mjpg")
+@idempotent
+def batch_data_source_mjpg():
+    # enable and/or disable many data gateways for mjpg at once, asynchronously
+    #
+    # payload looks like:
+    # { "items": [{ "id": str, "action": "enable"|"disable", "video-device": str, "resolution": str, "fps": int }],
+    #   "parallelism": int }
+    # where "action" defaults to "enable", and "parallelism" is optional
+    payload = json.loads(request.data)
+    if isinstance(payload, list):
+        payload = {"items": payload}
+
+    items = payload.get("items") if isinstance(payload, dict) else None
+    if not items or not isinstance(items, list):
+        return jsonify(dict(utils.return_400, message="Payload must contain a non-empty list of items")), \
+               utils.return_400['status']
+
+    names = []
+    for item in items:
+        if not isinstance(item, dict) or "id" not in item:
+            return jsonify(dict(utils.return_400, message="Missing mandatory attribute 'id' in %s" % item)), \
+                   utils.return_400['status']
+
+        item.setdefault("action", "enable")
+        if item["action"] not in ("enable", "disable"):
+            return jsonify(dict(utils.return_400, message="Unknown action %s for %s" % (item["action"],
+                                                                                        item["id"]))), \
+                   utils.return_400['status']
+
+        if item["action"] == "enable" and "video-device" not in item:
+            return jsonify(dict(utils.return_400, message="Missing mandatory attribute 'video-device' in %s" %
+                                                          item)), \
+                   utils.return_400['status']
+
+        names.append(item["id"].split("/")[-1])
+
+    if len(set(names)) != len(names):
+        return jsonify(dict(utils.return_400, message="Each peripheral can only be in the batch once")), \
+               utils.return_400['status']
+
+    try:
+        parallelism = min(int(payload.get("parallelism", utils.batch_parallelism)), utils.batch_max_parallelism)
+    except ValueError:
+        return jsonify(dict(utils.return_400, message="parallelism must be an integer")), utils.return_400['status']
+
+    log.info("Received /api/data-source-mjpg/batch request for %d streamers", len(items))
+
+    try:
+        job = jobs.queue.submit("batch-data-source-mjpg", names, data_source_mjpg_batch_job,
+                                items, max(parallelism, 1))
+    except jobs.QueueFull as e:
+        return jsonify(dict(utils.return_503, message=str(e))), utils.return_503['status']
+
+    return jsonify(dict(utils.return_202,
+                        message="batch of {} MJPG streamer actions accepted".format(len(items)),
+                        **{"job-id": job.id,
+                           "job": url_for("get_job", job_id=job.id)})), utils.return_202['status']
+
+
+startup.record("app-import", time.perf_counter() - import_started)
 
 
 if __name__ == "__main__":
     """ Main """
 
     # Check if there is an SSH key to be added to the host
-    try:
-        default_ssh_key()
-    except:
-        # it is not critical if we can't add it, for any reason
-        log.exception("Could not add NUVLABOX_SSH_PUB_KEY to the host root. Moving on and discarding the provided key")
+    with startup.phase("default-ssh-key"):
+        try:
+            default_ssh_key()
+        except:
+            # it is not critical if we can't add it, for any reason
+            log.exception("Could not add NUVLABOX_SSH_PUB_KEY to the host root. "
+                          "Moving on and discarding the provided key")
 
     # Let's re-use the certificates already generated for the compute-api
-    wait_for_certificates()
+    with startup.phase("certificates"):
+        wait_for_certificates()
 
     log.info("Starting NuvlaBox Management API!")
     try:
-        subprocess.check_output(["gunicorn", "--bind=0.0.0.0:5001", "--threads=2",
-                                 "--worker-class=gthread", "--workers=1", "--reload",
-                                 "--keyfile", "{}/{}".format(utils.nuvlabox_api_certs_folder, utils.server_key_file),
-                                 "--certfile", "{}/{}".format(utils.nuvlabox_api_certs_folder, utils.server_cert_file),
-                                 "--ca-certs", "{}/{}".format(utils.nuvlabox_api_certs_folder, utils.ca_file),
-                                 "--cert-reqs", "2", "--no-sendfile",
-                                 "wsgi:app"])
+        settings = server.load_settings()
+        log.info("Server settings: %s", settings)
+        # the one-time startup tasks are done. Gunicorn gets their timings, for the status endpoint
+        gunicorn = subprocess.Popen(server.gunicorn_command(settings,
+                                                            certificates.watcher.key,
+                                                            certificates.watcher.cert,
+                                                            certificates.watcher.ca),
+                                    env=dict(os.environ, **startup.environment()))
     except FileNotFoundError:
         log.exception("Gunicorn not available!")
         raise
-    except (OSError, subprocess.CalledProcessError):
-        log.exception("Failed start NuvlaBox Management API!")
+    except OSError:
         log.exception("Failed start NuvlaBox Management API!")
         raise
 
+    # gracefully reload the workers (and with them, the TLS credentials) when the compute-api rotates them
+    certificates.watcher.watch(lambda: gunicorn.send_signal(signal.SIGHUP))
+
+    exit_code = gunicorn.wait()
+    if exit_code != 0:
+        log.error("Failed start NuvlaBox Management API!")
+        raise subprocess.CalledProcessError(exit_code, gunicorn.args)
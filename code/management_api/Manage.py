@@ -4,11 +4,11 @@
 """ All the management functions that can be called from the API """
 
 import os
+import threading
 import time
-import docker
-import json
+from contextlib import contextmanager
 from management_api.common import utils
-from nuvla.api import Api
+from management_api import budget, docker_client, images, metrics, nuvla_session, streamers, video_devices
 
 # TODO: is there a way to avoid fixing a tag? If a new tag comes out, we need to update this microservice
 data_gateway_images = {
@@ -16,6 +16,20 @@ data_gateway_images = {
 }
 
 
+_streamer_locks = {}
+_streamer_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _streamer_lock(name):
+    """ Serializes the operations on the same streamer, whoever calls them """
+    with _streamer_locks_lock:
+        lock = _streamer_locks.setdefault(name, threading.RLock())
+
+    with lock:
+        yield
+
+
 def reboot():
     # reboot the host
     # NOTE: there's no return from this function
@@ -33,28 +47,33 @@ def start_container_data_source_mjpg(name, video_device, resolution, fps):
 
     :param name: unique name of the container and termination of the pathprefix in traefik
     :param video_device: path to video device, i.e. /dev/video0
-    :param resolution: video feed resolution (str like WxH)
-    :param fps: number of frames per second
+    :param resolution: requested video feed resolution (str like WxH). Might be lowered while the host is overloaded
+    :param fps: requested number of frames per second. Might be lowered while the host is overloaded
 
     :returns local_data_gateway_endpoint and container obj
+    :raises video_devices.InvalidVideoDevice if the video device can't stream at that resolution
     """
-    client = docker.from_env()
+    video_devices.inventory.validate(video_device, resolution)
 
-    try:
-        existing_container = client.containers.get(name)
-        if existing_container:
-            # we force kill any previous container, if there's a new request for the same streamer
-            existing_container.remove(force=True)
-    except docker.errors.NotFound:
-        # this is good, the container shouldn't exist
-        pass
-    except:
-        # better not move forward, as it can cause zombie containers
-        raise
+    with _streamer_lock(name):
+        return _start_container_data_source_mjpg(name, video_device, resolution, fps)
+
+
+def _start_container_data_source_mjpg(name, video_device, resolution, fps):
+    from docker.errors import APIError
+
+    client = docker_client.get_client()
+    docker_client.registry.start()
+
+    if docker_client.registry.may_exist(name):
+        # we force kill any previous container, if there's a new request for the same streamer
+        remove_container(name)
 
+    effective_resolution, effective_fps = budget.policy.effective(resolution, fps,
+                                                                  video_devices.inventory.resolutions(video_device))
     cmd = '--input-type input_uvc.so --device-path {} --resolution {} --fps {}'.format(video_device,
-                                                                                       resolution,
-                                                                                       fps)
+                                                                                       effective_resolution,
+                                                                                       effective_fps)
 
     path_prefix = "/video/{}".format(name)
 
@@ -72,20 +91,56 @@ def start_container_data_source_mjpg(name, video_device, resolution, fps):
               "traefik.http.middlewares.{}-mid.replacepath.path".format(name): "/"
               }
 
-    streaming_url = 'http://data-gateway' + path_prefix + '?action=stream'
-    return streaming_url, client.containers.run(data_gateway_images['data_source_mjpg'],
-                                                command=cmd,
-                                                detach=True,
-                                                name=name,
-                                                hostname=name,
-                                                devices=devices,
-                                                labels=labels,
-                                                network="nuvlabox-shared-network",
-                                                restart_policy={"Name": "always"},
-                                                environment=[f"RESOLUTION={resolution}",
-                                                             f"FPS={fps}",
-                                                             "CRON_DATAGATEWAY_HEALTHCHECK=1"]
-                                                )
+    # don't let Docker pull the image on its own, if it's already being pulled in the background
+    images.warmer.ensure(data_gateway_images['data_source_mjpg'])
+
+    streaming_url = streamers.streaming_url(name)
+    run_kwargs = dict(command=cmd,
+                      detach=True,
+                      name=name,
+                      hostname=name,
+                      devices=devices,
+                      labels=labels,
+                      network="nuvlabox-shared-network",
+                      restart_policy={"Name": "always"},
+                      environment=[f"RESOLUTION={effective_resolution}",
+                                   f"FPS={effective_fps}",
+                                   f"REQUESTED_RESOLUTION={resolution}",
+                                   f"REQUESTED_FPS={fps}",
+                                   "CRON_DATAGATEWAY_HEALTHCHECK=1"],
+                      # its share of the streaming budget, counting itself
+                      **budget.container_limits(len(set(docker_client.registry.names()) - {name}) + 1))
+    try:
+        with metrics.timed_call("docker", "containers.run"):
+            container = client.containers.run(data_gateway_images['data_source_mjpg'], **run_kwargs)
+    except APIError as e:
+        if e.status_code != 409:
+            raise
+        # name conflict: the registry has not yet seen a container that already exists
+        remove_container(name)
+        with metrics.timed_call("docker", "containers.run"):
+            container = client.containers.run(data_gateway_images['data_source_mjpg'], **run_kwargs)
+
+    docker_client.registry.put(container, action="create")
+    budget.rebalance()
+
+    return streaming_url, container
+
+
+def remove_container(name):
+    """ Force removes a container by name, without looking it up first
+
+    :param name: name of the container
+    """
+    from docker.errors import NotFound
+
+    try:
+        with metrics.timed_call("docker", "remove"):
+            docker_client.get_client().api.remove_container(name, force=True)
+    except NotFound:
+        pass
+
+    docker_client.registry.discard(name)
 
 
 def stop_container_data_source_mjpg(name):
@@ -95,45 +150,75 @@ def stop_container_data_source_mjpg(name):
 
     :returns
     """
-    client = docker.from_env()
+    docker_client.registry.start()
 
-    try:
-        client.containers.get(name).remove(force=True)
-    except docker.errors.NotFound:
-        pass
+    with _streamer_lock(name):
+        if docker_client.registry.may_exist(name):
+            remove_container(name)
+            budget.rebalance()
 
 
-def nuvla_api():
-    """ Initialize API instance """
-    if os.path.exists(utils.nuvla_configuration):
-        nuvla_endpoint_raw = nuvla_endpoint_insecure_raw = None
-        with open(utils.nuvla_configuration) as nuvla_conf:
-            for line in nuvla_conf.read().split():
-                try:
-                    if line and 'NUVLA_ENDPOINT=' in line:
-                        nuvla_endpoint_raw = line.split('=')[-1]
-                    if line and 'NUVLA_ENDPOINT_INSECURE=' in line:
-                        nuvla_endpoint_insecure_raw = bool(line.split('=')[-1])
-                except IndexError:
-                    pass
-
-        if nuvla_endpoint_raw and nuvla_endpoint_insecure_raw:
-            api = Api(endpoint='https://{}'.format(nuvla_endpoint_raw),
-                      insecure=nuvla_endpoint_insecure_raw, reauthenticate=True)
-        else:
-            raise Exception(f'Misconfigured Nuvla parameters in {utils.nuvla_configuration}. Cannot perform operation')
-    else:
-        raise Exception("NuvlaBox is not yet ready to be operated. Missing Nuvla configuration parameters")
+def data_source_mjpg_matches(name, video_device, resolution, fps):
+    """ Checks whether a streamer is already running with the given parameters, the current image, and the video
+    settings that the current host load allows. Only looks at the container registry, so there's no call to Docker
 
+    :param name: name of the streamer container
+    :param video_device: path to video device, i.e. /dev/video0
+    :param resolution: video feed resolution (str like WxH)
+    :param fps: number of frames per second
+    :returns True if there's nothing to change
+    """
+    container = docker_client.registry.get(name)
+    if container is None or container.status != "running":
+        return False
+
+    current = streamers.record_from_container(container)
     try:
-        with open(utils.activation_flag) as a:
-            user_info = json.loads(a.read())
-    except FileNotFoundError:
-        raise Exception("Cannot authenticate back with Nuvla")
+        fps = int(fps)
+    except (TypeError, ValueError):
+        return False
+
+    effective_resolution, effective_fps = budget.policy.effective(resolution, fps,
+                                                                  video_devices.inventory.resolutions(video_device))
+    return current.get("video-device") == video_device and \
+        current.get("resolution") == resolution and \
+        current.get("fps") == fps and \
+        current.get("effective-resolution") == effective_resolution and \
+        current.get("effective-fps") == effective_fps and \
+        (container.attrs.get("Config") or {}).get("Image") == data_gateway_images['data_source_mjpg']
+
+
+def get_data_source_container(name):
+    """ Looks up a data source container by name
+
+    :param name: name of the container
+    :returns docker Container object, or None if there's no such data source container
+    """
+    from docker.errors import NotFound
 
-    api.login_apikey(user_info['api-key'], user_info['secret-key'])
+    docker_client.registry.start()
 
-    return api
+    container = docker_client.registry.get(name)
+    if container is None and docker_client.registry.may_exist(name):
+        try:
+            with metrics.timed_call("docker", "containers.get"):
+                container = docker_client.get_client().containers.get(name)
+        except NotFound:
+            return None
+
+    if container is None or container.labels.get(docker_client.data_source_label) != "True":
+        return None
+
+    return container
+
+
+def nuvla_api():
+    """ Gives back the shared, authenticated Nuvla API instance
+
+    The instance is re-used across requests, and only re-authenticated when its session expires
+    or when the NuvlaBox configuration changes """
+
+    return nuvla_session.session.get()
 
 
 def find_container_env_vars(container_name, keys=None):
@@ -145,9 +230,13 @@ def find_container_env_vars(container_name, keys=None):
     :returns {key1: value1, key2: value2} - a map of the provided keys and respective values in the container env
     """
 
-    client = docker.from_env()
-
-    insp = client.api.inspect_container(container_name)
+    container = docker_client.registry.get(container_name)
+    if container is not None:
+        # the registry is kept up to date by the Docker events, so its attributes are fresh
+        insp = container.attrs
+    else:
+        with metrics.timed_call("docker", "inspect_container"):
+            insp = docker_client.get_client().api.inspect_container(container_name)
 
     try:
         env = insp['Config']['Env']
@@ -158,7 +247,7 @@ def find_container_env_vars(container_name, keys=None):
     if keys:
         for k in keys:
             try:
-                var = list(filter(lambda x: f"{k}=" in x, env))[0]
+                var = list(filter(lambda x: x.startswith(f"{k}="), env))[0]
                 env_map[var.split("=", 1)[0]] = var.split("=", 1)[1]
             except IndexError:
                 continue
@@ -169,17 +258,18 @@ def find_container_env_vars(container_name, keys=None):
     return env_map
 
 
-def update_peripheral_resource(id, local_data_gateway_endpoint=None, data_gateway_enabled=True, raw_sample=None):
+def update_peripheral_resource(id, local_data_gateway_endpoint=None, data_gateway_enabled=True, raw_sample=None,
+                               data_gateway_settings=None):
     """ sends a PUT request to Nuvla to update the peripheral resource whenever a data gateway action takes place
 
     :param id: UUID of the peripheral resource in nuvla
     :param local_data_gateway_endpoint: data gateway url for accessing the routed data
     :param data_gateway_enabled: whether data dateway is enabled or not
-    :param raw_sample: raw data sample
+    :param raw_sample: raw data sample. Kept in Nuvla until the data gateway is disabled
+    :param data_gateway_settings: effective video settings and resource limits of the data gateway
 
     :returns """
 
-    api = nuvla_api()
     kwargs = {'select': []}
 
     payload = {
@@ -193,7 +283,16 @@ def update_peripheral_resource(id, local_data_gateway_endpoint=None, data_gatewa
 
     if raw_sample:
         payload['raw-data-sample'] = raw_sample
-    else:
+    elif not data_gateway_enabled:
         kwargs['select'].append("raw-data-sample")
 
-    api._cimi_put(id, json=payload, params=kwargs)
+    if data_gateway_settings:
+        payload['data-gateway-settings'] = data_gateway_settings
+    elif not data_gateway_enabled:
+        kwargs['select'].append("data-gateway-settings")
+
+    def put(api):
+        with metrics.timed_call("nuvla", "_cimi_put"):
+            return api._cimi_put(id, json=payload, params=kwargs)
+
+    nuvla_session.session.call(put)
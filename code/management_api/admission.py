@@ -0,0 +1,181 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Admission control for the expensive endpoints
+
+Each class of expensive endpoints (lane) has a concurrency limit, and a short queue with a timeout. All
+the lanes together can only hold a share of the server threads, so that the cheap endpoints (discovery,
+health, status, metrics...) are never limited, and always find a free thread, even under a burst.
+
+When a lane is saturated, requests are turned down right away, with a Retry-After estimate:
+ - 429 when the lane's queue is full
+ - 503 when there are no threads left for the expensive endpoints, or the request waited too long in the queue
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from management_api import server
+
+log = logging.getLogger(__name__)
+
+enabled = os.getenv("ADMISSION_CONTROL", "true").strip().lower() in ("1", "true", "yes", "on")
+
+# threads kept free for the cheap endpoints
+reserved_threads = int(os.getenv("ADMISSION_RESERVED_THREADS", 1))
+max_retry_after = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", 60))
+
+# lane: (concurrency limit, queue length, queue timeout in seconds)
+default_lanes = {"data-source-mjpg": (2, 4, 5),
+                 "data-source-mjpg-logs": (4, 0, 0),
+                 "data-source-mjpg-snapshot": (2, 8, 5),
+                 "ssh-keys": (1, 4, 10),
+                 "reboot": (1, 0, 0)}
+
+
+class Rejected(Exception):
+    """ Raised when a request is not admitted """
+
+    def __init__(self, message, status, reason, retry_after):
+        super(Rejected, self).__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Lane(object):
+    """ Concurrency limit and queue of one class of endpoints """
+
+    def __init__(self, name, limit, queue, timeout):
+        self.name = name
+        self.limit = max(limit, 1)
+        self.queue = max(queue, 0)
+        self.timeout = timeout
+
+        self.in_flight = 0
+        self.waiting = 0
+        # moving average of how long the requests take, for the Retry-After estimates
+        self.duration = None
+        self.stats = Counter()
+
+    @classmethod
+    def from_environment(cls, name, limit, queue, timeout):
+        """ Lane with the defaults overridden by ADMISSION_<NAME>_LIMIT, _QUEUE and _TIMEOUT """
+        prefix = "ADMISSION_{}_".format(name.upper().replace("-", "_"))
+        return cls(name,
+                   int(os.getenv(prefix + "LIMIT", limit)),
+                   int(os.getenv(prefix + "QUEUE", queue)),
+                   float(os.getenv(prefix + "TIMEOUT", timeout)))
+
+    def retry_after(self):
+        """ Seconds until a new request has a fair chance to be admitted """
+        expected = (self.duration or 1) * (self.waiting + 1) / self.limit
+        return min(max(int(math.ceil(expected)), 1), max_retry_after)
+
+    def to_dict(self):
+        return dict(self.stats,
+                    **{"limit": self.limit,
+                       "queue": self.queue,
+                       "timeout": self.timeout,
+                       "in-flight": self.in_flight,
+                       "waiting": self.waiting})
+
+
+class Ticket(object):
+    """ An admitted request. Must be released once the request is done """
+
+    def __init__(self, controller, lane):
+        self.controller = controller
+        self.lane = lane
+        self.started = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller.release(self)
+
+
+def default_capacity():
+    """ Threads available to the limited lanes: the server threads, minus the reserved ones """
+    return max(server.concurrency(server.load_settings()) - reserved_threads, 1)
+
+
+class AdmissionController(object):
+    """ Admits the requests of each lane, within its limits and within the overall capacity """
+
+    def __init__(self, lanes, capacity):
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.capacity = capacity
+        # requests holding a thread in any lane, either running or waiting
+        self.used = 0
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def _reject(self, lane, message, status, reason):
+        lane.stats["rejected-" + reason] += 1
+        log.warning("Rejecting %s request (%s): %s", lane.name, reason, message)
+        raise Rejected(message, status, reason, lane.retry_after())
+
+    def _admit(self, lane):
+        lane.in_flight += 1
+        self.used += 1
+        lane.stats["admitted"] += 1
+        return Ticket(self, lane)
+
+    def acquire(self, name):
+        """ Waits for a slot in a lane
+
+        :param name: name of the lane
+        :returns Ticket, to be released when the request is done
+        :raises Rejected
+        """
+        lane = self.lanes[name]
+        with self._lock:
+            if lane.in_flight < lane.limit and self.used < self.capacity:
+                return self._admit(lane)
+
+            if lane.waiting >= lane.queue:
+                self._reject(lane, "Too many {} requests. Try again later".format(name), 429, "queue-full")
+            if self.used >= self.capacity:
+                self._reject(lane, "The server is busy. Try again later", 503, "busy")
+
+            lane.waiting += 1
+            # a waiting request holds a thread too
+            self.used += 1
+            lane.stats["queued"] += 1
+            deadline = time.monotonic() + lane.timeout
+            try:
+                while lane.in_flight >= lane.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(lane, "Timed out waiting for other {} requests to finish. Try again later"
+                                     .format(name), 503, "timeout")
+                    self._released.wait(remaining)
+            finally:
+                lane.waiting -= 1
+                self.used -= 1
+
+            return self._admit(lane)
+
+    def release(self, ticket):
+        duration = time.perf_counter() - ticket.started
+        with self._lock:
+            lane = ticket.lane
+            lane.in_flight -= 1
+            self.used -= 1
+            lane.duration = duration if lane.duration is None else 0.8 * lane.duration + 0.2 * duration
+            self._released.notify_all()
+
+    def get_stats(self):
+        with self._lock:
+            return {"capacity": self.capacity,
+                    "used": self.used,
+                    "lanes": {name: lane.to_dict() for name, lane in self.lanes.items()}}
+
+
+controller = AdmissionController([Lane.from_environment(name, *limits) for name, limits in default_lanes.items()],
+                                int(os.getenv("ADMISSION_CAPACITY", 0)) or default_capacity())
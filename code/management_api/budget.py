@@ -0,0 +1,345 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" CPU and memory budget of the MJPG streamers, and load-adaptive video settings
+
+All the streamers together get a fixed share of the box (by default, half of the CPUs and a quarter of the
+memory), split evenly between them as cgroup limits. The limits of the running streamers are updated in
+place whenever a streamer is started or stopped, without re-creating them.
+
+The host load is sampled from /proc. While the box is overloaded, the video settings of all the streamers
+are stepped down, one notch at a time (alternately fps and resolution), down to the operator's minimum.
+When the load goes back down, they are stepped back up, up to what was requested. The reconciler re-creates
+the streamers whose settings no longer match the current step, so nothing is re-created unless it has to.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from management_api import docker_client, metrics, video_devices
+
+log = logging.getLogger(__name__)
+
+
+def parse_size(value):
+    """ Parses a size like 512m or 1g into bytes
+
+    :param value: size, with an optional k, m or g suffix
+    :returns int, or None if there's no value
+    """
+    if not value:
+        return None
+
+    value = str(value).strip().lower().rstrip("b")
+    multiplier = {"k": 2 ** 10, "m": 2 ** 20, "g": 2 ** 30}.get(value[-1:], 1)
+    return int(float(value.rstrip("kmg")) * multiplier)
+
+
+def host_memory():
+    """ Total memory of the host, in bytes, or None if unknown """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+cpu_budget = float(os.getenv("STREAMING_CPU_BUDGET", 0)) or multiprocessing.cpu_count() * 0.5
+memory_budget = parse_size(os.getenv("STREAMING_MEMORY_BUDGET")) or int((host_memory() or 2 ** 30) * 0.25)
+min_memory = parse_size(os.getenv("STREAMER_MIN_MEMORY", "32m"))
+max_memory = parse_size(os.getenv("STREAMER_MAX_MEMORY", "256m"))
+cpu_period = 100000
+
+adaptive = os.getenv("STREAMING_ADAPTIVE", "true").strip().lower() in ("1", "true", "yes", "on")
+sample_interval = float(os.getenv("STREAMING_LOAD_INTERVAL", 15))
+# host CPU usage (0 to 1) above which the settings are stepped down, and below which they are stepped up
+high_cpu = float(os.getenv("STREAMING_HIGH_CPU", 0.85))
+low_cpu = float(os.getenv("STREAMING_LOW_CPU", 0.5))
+# share of memory available, below which the settings are stepped down
+low_memory = float(os.getenv("STREAMING_LOW_MEMORY", 0.1))
+# consecutive samples needed before stepping down, or up
+samples_down = int(os.getenv("STREAMING_STEP_DOWN_SAMPLES", 2))
+samples_up = int(os.getenv("STREAMING_STEP_UP_SAMPLES", 4))
+
+min_resolution = os.getenv("STREAMING_MIN_RESOLUTION", "320x240")
+min_fps = int(os.getenv("STREAMING_MIN_FPS", 5))
+
+# whether the effective settings are reported to Nuvla, with the peripheral updates.
+# Off until the Nuvla peripheral schema has a data-gateway-settings attribute
+report_settings = os.getenv("STREAMING_REPORT_SETTINGS", "false").strip().lower() in ("1", "true", "yes", "on")
+
+resolution_steps = ["1920x1080", "1280x720", "960x540", "640x480", "320x240"]
+fps_steps = [30, 25, 20, 15, 10, 5]
+
+
+def pixels(resolution):
+    try:
+        width, height = video_devices.normalize_resolution(resolution).split("x")
+        return int(width) * int(height)
+    except (AttributeError, ValueError):
+        return 0
+
+
+def lower_resolution(resolution, supported=None):
+    """ The next resolution below resolution, or None if it's already at the minimum
+
+    :param resolution: current resolution, like WxH
+    :param supported: resolutions the camera supports. The standard steps if None
+    """
+    floor = min(pixels(min_resolution), pixels(resolution))
+    for step in sorted(supported or resolution_steps, key=pixels, reverse=True):
+        if floor <= pixels(step) < pixels(resolution):
+            return step
+
+    return None
+
+
+def lower_fps(fps):
+    """ The next standard fps below fps, or None if it's already at the minimum """
+    for step in fps_steps:
+        if min(min_fps, fps) <= step < fps:
+            return step
+
+    return None
+
+
+def step_down(resolution, fps, level, supported=None):
+    """ Video settings, stepped down level notches from the requested ones. Fps goes first
+
+    :param resolution: requested resolution, like WxH
+    :param fps: requested fps
+    :param level: how many notches down
+    :param supported: resolutions the camera supports, if known
+    :returns (resolution, fps)
+    """
+    fps = int(fps)
+    for notch in range(level):
+        lowered = (None, lower_fps(fps)) if notch % 2 == 0 else (lower_resolution(resolution, supported), None)
+        if lowered == (None, None):
+            lowered = (lower_resolution(resolution, supported), None) if notch % 2 == 0 else (None, lower_fps(fps))
+
+        if lowered == (None, None):
+            # can't go any lower
+            break
+
+        resolution = lowered[0] or resolution
+        fps = lowered[1] or fps
+
+    return resolution, fps
+
+
+max_level = len(resolution_steps) + len(fps_steps)
+
+
+class LoadSampler(object):
+    """ Host CPU usage, from the deltas between two readings of /proc/stat, and available memory """
+
+    def __init__(self):
+        self._previous = None
+
+    @staticmethod
+    def _cpu_times():
+        with open("/proc/stat") as stat:
+            fields = [int(v) for v in stat.readline().split()[1:]]
+        # idle and iowait
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+        return sum(fields), idle
+
+    @staticmethod
+    def _memory_available():
+        values = {}
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                key, value = line.split(":", 1)
+                values[key] = int(value.split()[0])
+        return values.get("MemAvailable", values.get("MemFree", 0)) / float(values["MemTotal"])
+
+    def sample(self):
+        """ Current load
+
+        :returns {"cpu": usage since the previous sample, from 0 to 1, "memory-available": from 0 to 1}
+        """
+        total, idle = self._cpu_times()
+        previous, self._previous = self._previous, (total, idle)
+
+        cpu = None
+        if previous and total > previous[0]:
+            cpu = 1 - (idle - previous[1]) / float(total - previous[0])
+
+        return {"cpu": cpu, "memory-available": self._memory_available()}
+
+
+class AdaptivePolicy(object):
+    """ Steps the video settings of all the streamers down when the host is overloaded, and back up when it's not """
+
+    def __init__(self, sampler=None):
+        self.level = 0
+        self.load = {}
+        self.sampler = sampler or LoadSampler()
+        self._overloaded = 0
+        self._underloaded = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"samples": 0, "steps-down": 0, "steps-up": 0}
+
+    def effective(self, resolution, fps, supported=None):
+        """ The video settings to use for a streamer, given what was requested
+
+        :param supported: resolutions the camera supports, if known. Only those are stepped down to
+        :returns (resolution, fps)
+        """
+        if not adaptive:
+            return resolution, int(fps)
+
+        return step_down(resolution, fps, self.level, supported)
+
+    def observe(self, load):
+        """ Takes a load sample into account
+
+        :param load: from LoadSampler.sample()
+        :returns True if the level has changed
+        """
+        with self._lock:
+            self.load = load
+            self.stats["samples"] += 1
+            cpu = load.get("cpu")
+            if cpu is None:
+                return False
+
+            if cpu >= high_cpu or load.get("memory-available", 1) < low_memory:
+                self._overloaded += 1
+                self._underloaded = 0
+            elif cpu <= low_cpu:
+                self._underloaded += 1
+                self._overloaded = 0
+            else:
+                self._overloaded = self._underloaded = 0
+
+            if self._overloaded >= samples_down and self.level < max_level and docker_client.registry.names():
+                self.level += 1
+                self.stats["steps-down"] += 1
+            elif self._underloaded >= samples_up and self.level > 0:
+                self.level -= 1
+                self.stats["steps-up"] += 1
+            else:
+                return False
+
+            self._overloaded = self._underloaded = 0
+
+        log.info("Host CPU at %d%%. Video settings of the MJPG streamers now %d notch(es) below the requested ones",
+                 100 * cpu, self.level)
+        return True
+
+    def start(self):
+        """ Starts sampling the host load, if not yet started """
+        if not adaptive:
+            return
+
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="load-sampler")
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(sample_interval):
+            try:
+                self.observe(self.sampler.sample())
+            except Exception:
+                log.exception("Could not sample the host load")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, level=self.level, **{"cpu": self.load.get("cpu"),
+                                                         "memory-available": self.load.get("memory-available")})
+
+
+policy = AdaptivePolicy()
+
+
+def container_limits(streamers_count):
+    """ cgroup limits for each streamer, when there are streamers_count of them
+
+    :returns keyword arguments for containers.run() and container.update()
+    """
+    count = max(streamers_count, 1)
+    memory = int(min(max(memory_budget / count, min_memory), max_memory))
+
+    return {"cpu_period": cpu_period,
+            "cpu_quota": max(int(cpu_budget / count * cpu_period), 1000),
+            "mem_limit": memory,
+            # memory and swap together: no swap on top of the memory limit. Updated along with mem_limit, so
+            # Docker doesn't refuse a lower memory limit later on
+            "memswap_limit": memory}
+
+
+_rebalance_lock = threading.Lock()
+# limits last set by rebalance(), by container id. The container attributes lag behind, until the update event
+_applied = {}
+
+
+def rebalance():
+    """ Splits the budget again between the current streamers, updating their limits in place """
+    from docker.errors import APIError, NotFound
+
+    with _rebalance_lock:
+        names = docker_client.registry.names()
+        limits = container_limits(len(names))
+        wanted = (limits["cpu_quota"], limits["mem_limit"])
+        for name in names:
+            container = docker_client.registry.get(name)
+            if container is None:
+                continue
+
+            host_config = container.attrs.get("HostConfig") or {}
+            if _applied.get(container.id, (host_config.get("CpuQuota"), host_config.get("Memory"))) == wanted:
+                continue
+
+            try:
+                with metrics.timed_call("docker", "update"):
+                    container.update(**limits)
+                _applied[container.id] = wanted
+            except (APIError, NotFound) as e:
+                log.warning("Could not update the resource limits of %s: %s", name, e)
+
+        current = set(docker_client.registry.get(name).id for name in names if docker_client.registry.get(name))
+        for container_id in set(_applied) - current:
+            del _applied[container_id]
+
+
+def settings(container):
+    """ Effective settings of a streamer container
+
+    :param container: docker Container object
+    :returns dict
+    """
+    attrs = container.attrs or {}
+    env = dict(var.split("=", 1) for var in (attrs.get("Config") or {}).get("Env") or [] if "=" in var)
+    host_config = attrs.get("HostConfig") or {}
+
+    effective = {"resolution": env.get("RESOLUTION"),
+                 "fps": int(env["FPS"]) if env.get("FPS", "").isdigit() else None,
+                 "requested-resolution": env.get("REQUESTED_RESOLUTION", env.get("RESOLUTION")),
+                 "requested-fps": int(env.get("REQUESTED_FPS", env.get("FPS", 0)) or 0) or None}
+    if host_config.get("CpuQuota") and host_config.get("CpuPeriod"):
+        effective["cpus"] = round(host_config["CpuQuota"] / float(host_config["CpuPeriod"]), 3)
+    if host_config.get("Memory"):
+        effective["memory-limit"] = host_config["Memory"]
+
+    return effective
+
+
+def nuvla_update(container):
+    """ Extra arguments for the peripheral update in Nuvla, with the effective settings of a streamer """
+    return {"data_gateway_settings": settings(container)} if report_settings else {}
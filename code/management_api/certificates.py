@@ -0,0 +1,142 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Event-driven readiness and rotation of the TLS credentials re-used from the compute-api
+
+The certificates folder is watched with inotify (or polled, when inotify is not available).
+The credentials are only considered ready once the certificate and key pair can actually be loaded.
+"""
+
+import logging
+import os
+import ssl
+import threading
+import time
+from management_api.common import inotify, utils
+
+log = logging.getLogger(__name__)
+
+poll_interval = float(os.getenv("CERTIFICATES_POLL_INTERVAL", 1))
+
+watch_mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE | \
+             inotify.IN_ATTRIB
+
+
+class CertificateWatcher(object):
+    """ Waits for, validates and follows the changes of the API TLS credentials """
+
+    def __init__(self, folder=utils.nuvlabox_api_certs_folder, cert_file=utils.server_cert_file,
+                 key_file=utils.server_key_file, ca_file=utils.ca_file):
+        self.folder = folder
+        self.cert = "{}/{}".format(folder, cert_file)
+        self.key = "{}/{}".format(folder, key_file)
+        self.ca = "{}/{}".format(folder, ca_file)
+
+        self._signature = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def files(self):
+        return self.cert, self.key, self.ca
+
+    def signature(self):
+        """ mtime and inode of each of the credential files, or None if any is missing """
+        signature = []
+        for path in self.files:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return None
+            signature.append((st.st_mtime_ns, st.st_ino, st.st_size))
+
+        return tuple(signature)
+
+    def validate(self):
+        """ Checks that the certificate and key match and can be loaded, together with the CA
+
+        :returns True if the credentials are usable
+        """
+        if not all(os.path.exists(f) for f in self.files):
+            return False
+
+        try:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.cert, self.key)
+            context.load_verify_locations(self.ca)
+        except (ssl.SSLError, OSError, ValueError) as e:
+            log.warning("TLS credentials in %s are not usable yet: %s", self.folder, e)
+            return False
+
+        return True
+
+    def _wait_for_events(self, timeout, known_signature):
+        """ Blocks until something changes in the certificates folder, or timeout
+
+        :param timeout: max seconds to wait
+        :param known_signature: files signature already seen by the caller
+        """
+        if not inotify.available() or not os.path.isdir(self.folder):
+            time.sleep(min(poll_interval, timeout) if timeout is not None else poll_interval)
+            return
+
+        with inotify.Inotify() as notifier:
+            notifier.add_watch(self.folder, watch_mask | inotify.IN_ONLYDIR)
+            # the files might have changed in between
+            if self.signature() != known_signature:
+                return
+            notifier.read(timeout)
+
+    def wait_until_ready(self, timeout=None):
+        """ Blocks until the credentials exist and are valid
+
+        :param timeout: max seconds to wait. None waits forever
+        :returns True if ready, False on timeout
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            signature = self.signature()
+            if signature and self.validate():
+                self._signature = signature
+                return True
+
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+
+            self._wait_for_events(remaining, signature)
+
+    def watch(self, on_rotation):
+        """ Follows the credentials in the background, and calls on_rotation() every time
+        they change and the new ones are valid
+
+        :param on_rotation: callback function
+        """
+        def follow():
+            seen = self._signature
+            while not self._stop.is_set():
+                self._wait_for_events(None, seen)
+                seen = self.signature()
+                if seen == self._signature or not seen:
+                    continue
+
+                # give the writer a chance to finish writing all the files
+                time.sleep(0.5)
+                if self.signature() != seen or not self.validate():
+                    continue
+
+                self._signature = seen
+                log.info("TLS credentials in %s have been rotated", self.folder)
+                try:
+                    on_rotation()
+                except Exception:
+                    log.exception("Failed to reload the rotated TLS credentials")
+
+        self._thread = threading.Thread(target=follow, daemon=True, name="certificate-watcher")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+watcher = CertificateWatcher()
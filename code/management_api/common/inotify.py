@@ -0,0 +1,104 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Minimal inotify bindings, through ctypes, so we don't need any extra dependency
+
+Use available() to check whether inotify can be used, and fallback to polling otherwise.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+_event_header = struct.Struct("iIII")
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError):
+    _libc = None
+
+
+class Inotify(object):
+    """ An inotify instance. Events are read with read() """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError("inotify is not available in this system")
+
+        self.fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """ Watches path for the events in mask
+
+        :param path: file or folder to watch
+        :param mask: inotify event mask
+        :returns watch descriptor
+        """
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+        return wd
+
+    def read(self, timeout=None):
+        """ Waits for events
+
+        :param timeout: seconds to wait for events. None waits forever
+        :returns list of (wd, mask, cookie, name) tuples. Empty on timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def available():
+    """ Whether inotify can be used in this system """
+    try:
+        Inotify().close()
+        return True
+    except OSError:
+        return False
@@ -5,6 +5,7 @@
  the different management api classes """
 
 import os
+import tempfile
 
 # nuvla_endpoint_raw = os.environ["NUVLA_ENDPOINT"] if "NUVLA_ENDPOINT" in os.environ else "nuvla.io"
 # while nuvla_endpoint_raw[-1] == "/":
@@ -23,7 +24,7 @@ import os
 #
 # nuvla_endpoint = nuvla_endpoint_raw.replace("https://", "")
 
-data_volume = "/srv/nuvlabox/shared"
+data_volume = os.getenv("NUVLABOX_DATA_VOLUME", "/srv/nuvlabox/shared")
 log_filename = "management-api.log"
 
 activation_flag = "{}/.activated".format(data_volume)
@@ -38,29 +39,78 @@ ca_file = "ca.pem"
 nuvlabox_api_certs_folder = data_volume
 
 provided_pubkey = os.getenv("NUVLABOX_SSH_PUB_KEY")
-host_ssh_folder = "/hostfs/.ssh"
+host_ssh_folder = os.getenv("HOST_SSH_FOLDER", "/hostfs/.ssh")
 
 host_home_user = os.getenv("HOST_USER", os.getenv('HOME'))
 ssh_user = host_home_user if host_home_user else "root"
 
+# how many data source containers can be started/stopped concurrently in a batch request
+batch_parallelism = int(os.getenv("DATA_SOURCE_MJPG_BATCH_PARALLELISM", 4))
+batch_max_parallelism = int(os.getenv("DATA_SOURCE_MJPG_BATCH_MAX_PARALLELISM", 16))
+
 return_404 = {"status": 404,
               "message": "undefined"}
 
 return_405 = {"status": 405,
               "message": "undefined"}
 
+return_409 = {"status": 409,
+              "message": "undefined"}
+
+return_429 = {"status": 429,
+              "message": "undefined"}
+
 return_200 = {"status": 200,
               "message": "undefined"}
 
 return_201 = {"status": 201,
               "message": "undefined"}
 
+return_202 = {"status": 202,
+              "message": "undefined"}
+
 return_400 = {"status": 400,
               "message": "undefined"}
 
 return_500 = {"status": 500,
               "message": "undefined"}
 
+return_502 = {"status": 502,
+              "message": "undefined"}
+
+return_503 = {"status": 503,
+              "message": "undefined"}
+
 return_generic = {"status": "placeholder",
                   "message": "undefined"}
 
+
+def atomic_write(path, content):
+    """ Replaces the content of path, through a temporary file in the same folder and an atomic rename """
+    folder = os.path.dirname(path) or "."
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+
+    fd, tmp_path = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(path)), dir=folder)
+    try:
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(content)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+        if st:
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
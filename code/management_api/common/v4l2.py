@@ -0,0 +1,132 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Minimal V4L2 bindings, through ioctl, so we don't need any extra dependency
+
+Only what's needed to tell what a video device can capture: its capabilities, pixel formats,
+frame sizes and frame intervals.
+"""
+
+import errno
+import fcntl
+import os
+import struct
+
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_VIDEO_CAPTURE_MPLANE = 0x00001000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+V4L2_FRMIVAL_TYPE_DISCRETE = 1
+
+# struct v4l2_capability, v4l2_fmtdesc, v4l2_frmsizeenum and v4l2_frmivalenum
+_capability = struct.Struct("=16s32s32sIII12x")
+_fmtdesc = struct.Struct("=III32sII12x")
+_frmsizeenum = struct.Struct("=III6I8x")
+_frmivalenum = struct.Struct("=IIIII6I8x")
+
+
+def _ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord("V") << 8) | number
+
+
+_READ = 2
+_READ_WRITE = 3
+
+VIDIOC_QUERYCAP = _ioc(_READ, 0, _capability.size)
+VIDIOC_ENUM_FMT = _ioc(_READ_WRITE, 2, _fmtdesc.size)
+VIDIOC_ENUM_FRAMESIZES = _ioc(_READ_WRITE, 74, _frmsizeenum.size)
+VIDIOC_ENUM_FRAMEINTERVALS = _ioc(_READ_WRITE, 75, _frmivalenum.size)
+
+
+def fourcc(code):
+    """ Pixel format code, as its four characters, i.e. MJPG or YUYV """
+    return struct.pack("<I", code).decode("ascii", errors="replace").strip()
+
+
+def _text(raw):
+    return raw.split(b"\0", 1)[0].decode(errors="replace")
+
+
+class VideoDevice(object):
+    """ An open V4L2 device """
+
+    def __init__(self, path):
+        self.path = path
+        # querying needs no write access, so /dev can be mounted read-only
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+
+    def _ioctl(self, request, layout, *fields):
+        buffer = bytearray(layout.pack(*fields))
+        fcntl.ioctl(self.fd, request, buffer, True)
+        return layout.unpack(bytes(buffer))
+
+    def _enumerate(self, request, layout, *fields):
+        """ Calls an enumeration ioctl with index 0, 1, 2... until the driver says there are no more """
+        results = []
+        while True:
+            try:
+                results.append(self._ioctl(request, layout, len(results), *fields))
+            except OSError as e:
+                if e.errno == errno.EINVAL:
+                    return results
+                raise
+
+    def capability(self):
+        """ :returns dict with driver, card, bus-info and whether the device can capture video """
+        driver, card, bus_info, version, capabilities, device_caps = self._ioctl(VIDIOC_QUERYCAP, _capability,
+                                                                                 b"", b"", b"", 0, 0, 0)
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            # the capabilities of this very node, rather than of the whole physical device
+            capabilities = device_caps
+
+        return {"driver": _text(driver),
+                "card": _text(card),
+                "bus-info": _text(bus_info),
+                "capture": bool(capabilities & (V4L2_CAP_VIDEO_CAPTURE | V4L2_CAP_VIDEO_CAPTURE_MPLANE))}
+
+    def formats(self):
+        """ :returns list of (pixel format code, description) """
+        return [(entry[4], _text(entry[3]))
+                for entry in self._enumerate(VIDIOC_ENUM_FMT, _fmtdesc, V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0)]
+
+    def frame_sizes(self, pixel_format):
+        """ :returns list of (width, height) for discrete sizes, or a single
+        (min width, max width, min height, max height) tuple for a range """
+        sizes = []
+        for _, _, size_type, *values in self._enumerate(VIDIOC_ENUM_FRAMESIZES, _frmsizeenum, pixel_format, 0,
+                                                        0, 0, 0, 0, 0, 0):
+            if size_type != V4L2_FRMSIZE_TYPE_DISCRETE:
+                min_width, max_width, _, min_height, max_height, _ = values
+                return [(min_width, max_width, min_height, max_height)]
+            sizes.append((values[0], values[1]))
+
+        return sizes
+
+    def frame_rates(self, pixel_format, width, height):
+        """ :returns list of frames per second, highest first. A range is given by its max and min """
+        rates = set()
+        for entry in self._enumerate(VIDIOC_ENUM_FRAMEINTERVALS, _frmivalenum, pixel_format, width, height, 0,
+                                     0, 0, 0, 0, 0, 0):
+            interval_type, values = entry[4], entry[5:]
+            intervals = [values[0:2]] if interval_type == V4L2_FRMIVAL_TYPE_DISCRETE else [values[0:2], values[2:4]]
+            for numerator, denominator in intervals:
+                if numerator:
+                    rates.add(round(denominator / float(numerator), 2))
+            if interval_type != V4L2_FRMIVAL_TYPE_DISCRETE:
+                break
+
+        return sorted(rates, reverse=True)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
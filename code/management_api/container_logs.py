@@ -0,0 +1,128 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Bounded and streamed access to the logs of the data source containers
+
+Container logs can grow without limit (i.e. a crash-looping streamer with an "always" restart policy),
+so they are never read in full: error reports only carry the tail of the logs, capped in bytes,
+and the logs endpoint forwards them chunk by chunk, as they are read from Docker.
+"""
+
+import logging
+import os
+from management_api import metrics
+
+log = logging.getLogger(__name__)
+
+# number of lines, and max size in bytes, of the logs included in error reports
+tail_lines = int(os.getenv("CONTAINER_LOGS_TAIL", 100))
+max_bytes = int(os.getenv("CONTAINER_LOGS_MAX_BYTES", 16 * 1024))
+
+# max size of a single line in the SSE stream. Longer lines are split
+sse_max_line = int(os.getenv("CONTAINER_LOGS_SSE_MAX_LINE", 8 * 1024))
+
+
+def bounded_logs(container, tail=None, limit=None):
+    """ Fetches the last lines of the logs of a container, keeping at most limit bytes
+
+    :param container: docker Container object
+    :param tail: number of lines from the end of the logs
+    :param limit: max number of bytes to keep. The oldest bytes are dropped first
+    :returns logs, as a string
+    """
+    tail = tail_lines if tail is None else tail
+    limit = max_bytes if limit is None else limit
+
+    buffer = bytearray()
+    truncated = False
+    with metrics.timed_call("docker", "logs"):
+        # docker-py follows the logs whenever they are streamed, unless told otherwise
+        stream = container.logs(stream=True, follow=False, tail=tail)
+        try:
+            for chunk in stream:
+                buffer += chunk
+                if len(buffer) > limit:
+                    del buffer[:len(buffer) - limit]
+                    truncated = True
+        finally:
+            close_stream(stream)
+
+    logs = buffer.decode('utf-8', errors='replace')
+    if truncated:
+        # don't start in the middle of a line
+        logs = "[...]\n" + logs.split("\n", 1)[-1]
+
+    return logs
+
+
+def close_stream(stream):
+    """ Releases the Docker connection behind a logs stream, if any """
+    close = getattr(stream, "close", None)
+    if close:
+        try:
+            close()
+        except Exception:
+            log.debug("Could not close logs stream", exc_info=True)
+
+
+class LogStream(object):
+    """ Raw log chunks of a container, read from Docker as they are iterated.
+    Only one chunk is held in memory at a time """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __iter__(self):
+        try:
+            for chunk in self.stream:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        # also to be called when the client goes away before the first chunk
+        close_stream(self.stream)
+
+
+def stream_logs(container, since=None, follow=False, tail="all", timestamps=False):
+    """ Opens the logs of a container. The request to Docker is made right away, so Docker errors are
+    raised here, before any response is sent
+
+    :param container: docker Container object
+    :param since: only logs after this UNIX timestamp, in seconds
+    :param follow: keep streaming new logs until the container stops or the client goes away
+    :param tail: number of lines from the end of the logs, or "all"
+    :param timestamps: prefix every line with its timestamp
+    :returns LogStream
+    :raises docker.errors.APIError
+    """
+    kwargs = {"stream": True, "follow": follow, "tail": tail, "timestamps": timestamps}
+    if since is not None:
+        kwargs["since"] = since
+
+    with metrics.timed_call("docker", "logs"):
+        return LogStream(container.logs(**kwargs))
+
+
+def server_sent_events(chunks):
+    """ Converts raw log chunks into Server-Sent Events, one event per log line
+
+    :param chunks: iterable of bytes
+    :returns generator of bytes
+    """
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        # a line without end can't be held forever
+        while len(pending) > sse_max_line:
+            lines.append(pending[:sse_max_line])
+            pending = pending[sse_max_line:]
+
+        if lines:
+            yield b"".join(b"data: " + line.rstrip(b"\r") + b"\n\n" for line in lines)
+
+    if pending:
+        yield b"data: " + pending.rstrip(b"\r") + b"\n\n"
+
+    yield b"event: end\ndata: \n\n"
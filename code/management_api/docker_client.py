@@ -0,0 +1,183 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Process-wide Docker client and in-memory registry of the data source containers managed by this service
+
+The Docker client (and its connection pool to the Docker socket) is created once and shared by all the
+request threads. The registry keeps a handle for every data source container, indexed by name, and is
+kept up to date by listening to the Docker events stream, so the request path doesn't need to look
+containers up again.
+"""
+
+import logging
+import threading
+import time
+from management_api import metrics
+
+log = logging.getLogger(__name__)
+
+data_source_label = "nuvlabox.data-source-container"
+
+# container events that can change what we know about a container
+tracked_events = ("create", "start", "restart", "die", "stop", "kill", "pause", "unpause",
+                  "update", "rename", "destroy", "health_status")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ Gives back the shared Docker client, creating it on first use
+
+    :returns docker.DockerClient
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # the Docker SDK is only imported when it's first needed, to keep the startup fast
+                import docker
+                _client = docker.from_env()
+
+    return _client
+
+
+class ContainerRegistry(object):
+    """ Name-indexed handles of the data source containers, kept fresh by the Docker events stream """
+
+    def __init__(self, label=data_source_label):
+        self.label = label
+        self.synced = False
+
+        self._containers = {}
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._thread = None
+
+    def start(self):
+        """ Loads the current containers and starts following the Docker events, if not yet started """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._follow_events, daemon=True,
+                                            name="docker-events-listener")
+            self._thread.start()
+
+    def add_listener(self, callback):
+        """ Registers a callback(action, name, container) to be called on every registry change.
+        container is None when the container has been removed, and both name and container are None
+        once the whole registry has been re-loaded from Docker ("refreshed")
+
+        :param callback: function to be called
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, action, name, container):
+        for callback in self._listeners:
+            try:
+                callback(action, name, container)
+            except Exception:
+                log.exception("Container registry listener failed on %s for %s", action, name)
+
+    def refresh(self):
+        """ Re-loads all the data source containers from Docker """
+        containers = get_client().containers.list(all=True, filters={"label": "{}=True".format(self.label)})
+
+        with self._lock:
+            gone = set(self._containers) - set(c.name for c in containers)
+            self._containers = {c.name: c for c in containers}
+            self.synced = True
+
+        for name in gone:
+            self._notify("destroy", name, None)
+        for container in containers:
+            self._notify("sync", container.name, container)
+        self._notify("refreshed", None, None)
+
+    def _handle_event(self, event):
+        from docker.errors import NotFound
+
+        action = event.get("Action", event.get("status", "")).split(":")[0]
+        if action not in tracked_events:
+            return
+
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        name = attributes.get("name")
+        container_id = event.get("Actor", {}).get("ID", event.get("id"))
+
+        if action == "destroy":
+            with self._lock:
+                current = self._containers.get(name)
+                # the container might have already been replaced by a new one with the same name
+                if current is not None and current.id == container_id:
+                    self._containers.pop(name, None)
+                else:
+                    return
+            self._notify(action, name, None)
+            return
+
+        try:
+            with metrics.timed_call("docker", "containers.get"):
+                container = get_client().containers.get(container_id)
+        except NotFound:
+            return
+
+        self.put(container, action=action)
+
+    def _follow_events(self):
+        backoff = 1
+        while True:
+            try:
+                since = int(time.time())
+                self.refresh()
+                events = get_client().events(since=since, decode=True,
+                                             filters={"type": "container",
+                                                      "label": "{}=True".format(self.label)})
+                backoff = 1
+                for event in events:
+                    self._handle_event(event)
+            except Exception:
+                log.exception("Lost connection to the Docker events stream. Reconnecting in %ss", backoff)
+
+            with self._lock:
+                self.synced = False
+
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def get(self, name):
+        """ Gives back the container handle for name, or None if it is not known """
+        with self._lock:
+            return self._containers.get(name)
+
+    def put(self, container, action="update"):
+        """ Adds or replaces a container handle
+
+        :param container: docker Container object
+        :param action: what caused the change
+        """
+        with self._lock:
+            self._containers[container.name] = container
+        self._notify(action, container.name, container)
+
+    def discard(self, name):
+        """ Forgets about a container """
+        with self._lock:
+            removed = self._containers.pop(name, None)
+        if removed is not None:
+            self._notify("destroy", name, None)
+
+    def names(self):
+        with self._lock:
+            return list(self._containers)
+
+    def may_exist(self, name):
+        """ Whether a container with this name might exist in Docker.
+        Only a synced registry can tell for sure that a container does not exist """
+        with self._lock:
+            return name in self._containers or not self.synced
+
+
+registry = ContainerRegistry()
@@ -0,0 +1,77 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Gunicorn server hooks, loaded with --config python:management_api.gunicorn_hooks
+
+The app is preloaded once, in the gunicorn master, and inherited by the workers when they are forked.
+Threads don't survive a fork, so the background services are only started in the workers, right after it.
+Evented (gevent) workers patch threading, sockets and locks once they are forked, and only then load the app,
+so their background services are started after that, once the app is loaded.
+
+The TLS context is built once, in the master, so that the workers inherit it, with its session ticket keys.
+"""
+
+import logging
+import time
+from management_api import logs, server, startup, tls
+
+log = logging.getLogger(__name__)
+
+# this module is loaded by the gunicorn master, before the app
+startup.set_role("master")
+master_started = time.perf_counter()
+
+
+def evented(cfg):
+    return cfg.worker_class_str in server.evented_worker_classes
+
+
+def post_fork(arbiter, worker):
+    # the worker hasn't patched the standard library yet. Threads started now wouldn't be patched
+    if not evented(worker.cfg):
+        start_worker()
+
+
+def post_worker_init(worker):
+    if evented(worker.cfg):
+        start_worker()
+
+
+def start_worker():
+    startup.set_role("worker")
+    # the log listener thread of the master is gone in the worker
+    logs.after_fork()
+
+    import app
+    app.start_background_services()
+
+
+def when_ready(server):
+    prepare_ssl_context(server)
+    # forked workers inherit the phases recorded so far
+    startup.record("gunicorn-master", time.perf_counter() - master_started)
+
+
+def on_reload(server):
+    # i.e. after a SIGHUP, because the TLS credentials have been rotated
+    prepare_ssl_context(server)
+
+
+def ssl_context(config, default_ssl_context_factory):
+    # called for every connection. One context per process, so that TLS sessions can be resumed
+    return tls.server_context(config, default_ssl_context_factory)
+
+
+def prepare_ssl_context(server):
+    """ Builds the TLS context in the master, before the workers are forked """
+    if not server.cfg.is_ssl:
+        return
+
+    try:
+        from gunicorn import sock
+        sock.ssl_context(server.cfg)
+    except (AttributeError, ImportError):
+        # gunicorn < 21 has no ssl_context hook
+        pass
+    except (OSError, ValueError) as e:
+        log.warning("Could not prepare the TLS context: %s", e)
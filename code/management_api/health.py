@@ -0,0 +1,244 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Health of the management API and of the services it depends on
+
+The dependency checks are cached for a short TTL, and only one refresh runs at a time: health probes
+that come in while a refresh is running get the previous report, so they never pile up.
+
+Besides the /api/health endpoint, the report is served in plain HTTP on a local UNIX socket, so that the
+container health check can get it without a TLS handshake (and without client certificates). The health
+check only restarts the container when /api/live fails there. The dependency health is for reporting.
+
+The UNIX socket is served by a side thread of a worker, not by the gunicorn request threads, so it would
+keep answering if all of them were stuck. /api/live on the socket therefore also checks that the worker
+serves requests: it fails when all the request threads have been busy for HEALTH_CHECK_STALL_TIMEOUT
+without any request completing. With several workers, only the one serving the socket is checked.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from management_api.common import utils
+from management_api import certificates, docker_client, jobs, server, startup
+
+log = logging.getLogger(__name__)
+
+ttl = float(os.getenv("HEALTH_CHECK_TTL", 5))
+docker_timeout = float(os.getenv("HEALTH_CHECK_DOCKER_TIMEOUT", 2))
+unix_socket = os.getenv("MANAGEMENT_API_HEALTH_SOCKET", "/var/run/management-api.sock")
+stall_timeout = float(os.getenv("HEALTH_CHECK_STALL_TIMEOUT", 120))
+
+
+# last validation of the TLS credentials, and the files signature it was made for
+_certificates_state = {}
+
+
+def check_certificates():
+    """ The TLS credentials exist and can be loaded. They are only re-validated when they change """
+    signature = certificates.watcher.signature()
+    if signature is None:
+        return False, "missing TLS credentials in {}".format(certificates.watcher.folder)
+
+    if _certificates_state.get("signature") != signature:
+        _certificates_state.update(signature=signature, valid=certificates.watcher.validate())
+
+    return _certificates_state["valid"], "loaded" if _certificates_state["valid"] else "invalid TLS credentials"
+
+
+def check_docker():
+    """ The Docker daemon answers on its socket """
+    client = docker_client.get_client()
+    # same as client.ping(), but without the client's long default timeout
+    client.api._result(client.api._get(client.api._url("/_ping"), timeout=docker_timeout))
+
+    return True, "reachable, {} data source containers".format(len(docker_client.registry.names())) \
+        if docker_client.registry.synced else "reachable, containers not loaded yet"
+
+
+def check_nuvla_configuration():
+    """ The NuvlaBox has been activated, and knows how to reach Nuvla """
+    missing = [f for f in (utils.nuvla_configuration, utils.activation_flag) if not os.path.exists(f)]
+    if missing:
+        return False, "missing {}".format(", ".join(missing))
+
+    return True, "present"
+
+
+def check_job_queue():
+    """ The job queue is not full """
+    depth = jobs.queue.depth()
+    return depth < jobs.queue.max_pending, "{} of {} jobs pending".format(depth, jobs.queue.max_pending)
+
+
+class HealthChecker(object):
+    """ Runs the dependency checks, and caches their results for ttl seconds """
+
+    def __init__(self, ttl=ttl):
+        self.ttl = ttl
+        # name: (check function, whether the API is unhealthy when it fails)
+        self.checks = {"certificates": (check_certificates, True),
+                       "docker": (check_docker, True),
+                       "nuvla-configuration": (check_nuvla_configuration, False),
+                       "job-queue": (check_job_queue, False)}
+
+        self._report = None
+        self._refresh_lock = threading.Lock()
+
+    def _run_checks(self):
+        results = {}
+        for name, (check, critical) in self.checks.items():
+            start = time.perf_counter()
+            try:
+                ok, detail = check()
+            except Exception as e:
+                ok, detail = False, str(e) or e.__class__.__name__
+            results[name] = {"ok": bool(ok),
+                             "critical": critical,
+                             "detail": detail,
+                             "duration": round(time.perf_counter() - start, 4)}
+
+        healthy = all(r["ok"] for r in results.values() if r["critical"])
+        return {"status": "healthy" if healthy else "unhealthy",
+                "healthy": healthy,
+                "checked": time.time(),
+                "checks": results}
+
+    def report(self):
+        """ Health report, refreshed if older than the TTL
+
+        :returns dict
+        """
+        report = self._report
+        if report is None or time.time() - report["checked"] >= self.ttl:
+            # the first caller refreshes. The others get the previous report, if there's one
+            if self._refresh_lock.acquire(blocking=report is None):
+                try:
+                    if self._report is report:
+                        self._report = self._run_checks()
+                finally:
+                    self._refresh_lock.release()
+            report = self._report
+
+        return dict(report,
+                    ready=startup.is_ready(),
+                    age=round(time.time() - report["checked"], 3))
+
+
+checker = HealthChecker()
+
+
+class WorkerPool(object):
+    """ Progress of the requests served by the request threads of this worker """
+
+    def __init__(self, capacity, stall_timeout=stall_timeout):
+        self.capacity = capacity
+        self.stall_timeout = stall_timeout
+        self.in_flight = 0
+        self._last_progress = time.monotonic()
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            if not self.in_flight:
+                # nothing was expected to complete while idle
+                self._last_progress = time.monotonic()
+            self.in_flight += 1
+
+    def finished(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._last_progress = time.monotonic()
+
+    def stalled(self):
+        """ Whether all the request threads are busy, and no request has completed for stall_timeout
+
+        :returns seconds since the last request completed if stalled, else None
+        """
+        with self._lock:
+            waiting = time.monotonic() - self._last_progress
+            if self.in_flight >= self.capacity and waiting >= self.stall_timeout:
+                return waiting
+
+        return None
+
+
+worker_pool = WorkerPool(server.concurrency(server.load_settings()))
+
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """ Plain HTTP handler for the local health socket """
+
+    protocol_version = "HTTP/1.0"
+
+    def address_string(self):
+        return "local"
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/api/health":
+            report = checker.report()
+            status = 200 if report["healthy"] else 503
+        elif self.path.split("?")[0] == "/api/live":
+            stalled = worker_pool.stalled()
+            if stalled is None:
+                report = dict(utils.return_200, message="alive")
+            else:
+                report = dict(utils.return_503, message="all {} request threads busy, no request completed for "
+                                                        "{:.0f}s".format(worker_pool.capacity, stalled))
+            status = report["status"]
+        else:
+            report = dict(utils.return_404, message="{} not found".format(self.path))
+            status = 404
+
+        body = json.dumps(report).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixHealthServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHealthServer, self).get_request()
+        return request, ("local", 0)
+
+
+def serve(path=unix_socket):
+    """ Serves the health report on a UNIX socket, in a background thread.
+    With several workers, the first one to start serves it
+
+    :param path: path of the UNIX socket
+    :returns the server, or None if the socket is already being served
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            # another worker serves it already
+            return None
+        except OSError:
+            # left over by a previous run
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    try:
+        server = UnixHealthServer(path, HealthRequestHandler)
+    except OSError as e:
+        log.warning("Cannot serve the health report on %s: %s", path, e)
+        return None
+
+    threading.Thread(target=server.serve_forever, daemon=True, name="health-listener").start()
+    log.info("Serving the health report on %s", path)
+    return server
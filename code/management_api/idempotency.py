@@ -0,0 +1,94 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Cache of the responses to requests carrying an Idempotency-Key header
+
+When Nuvla times out waiting for a response, it sends the same request again. If the request carries an
+idempotency key, the retry gets the response of the original request back, instead of triggering the
+same action all over again.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+ttl = float(os.getenv("IDEMPOTENCY_KEY_TTL", 24 * 3600))
+max_keys = int(os.getenv("IDEMPOTENCY_MAX_KEYS", 1024))
+
+header = "Idempotency-Key"
+
+
+class KeyReused(Exception):
+    """ Raised when an idempotency key is re-used for a different request """
+    pass
+
+
+def fingerprint(method, path, body):
+    """ Identifies a request, to tell retries from different requests with the same key """
+    return hashlib.sha256(b"\0".join([method.encode(), path.encode(), body or b""])).hexdigest()
+
+
+class IdempotencyCache(object):
+    """ Bounded, expiring cache of responses, indexed by idempotency key """
+
+    def __init__(self, ttl=ttl, max_keys=max_keys):
+        self.ttl = ttl
+        self.max_keys = max_keys
+
+        self._responses = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._responses:
+            key, entry = next(iter(self._responses.items()))
+            if entry["expires"] > now and len(self._responses) <= self.max_keys:
+                break
+            self._responses.popitem(last=False)
+
+    def run(self, key, request_fingerprint, func):
+        """ Gives back the cached response for key, or computes it with func.
+        Concurrent requests with the same key wait for the first one to finish
+
+        :param key: idempotency key
+        :param request_fingerprint: fingerprint of the request
+        :param func: function computing the response, as (body, status, mimetype)
+        :returns ((body, status, mimetype), whether it comes from the cache)
+        :raises KeyReused
+        """
+        with self._lock:
+            key_lock = self._in_flight.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+
+        try:
+            with key_lock[0]:
+                with self._lock:
+                    now = time.time()
+                    self._expire(now)
+                    entry = self._responses.get(key)
+                    if entry:
+                        if entry["fingerprint"] != request_fingerprint:
+                            raise KeyReused("{} {} was already used for a different request".format(header, key))
+                        return entry["response"], True
+
+                response = func()
+
+                # server side errors are worth a retry
+                if response[1] < 500:
+                    with self._lock:
+                        self._responses[key] = {"fingerprint": request_fingerprint,
+                                                "response": response,
+                                                "expires": time.time() + self.ttl}
+                        self._expire(time.time())
+
+                return response, False
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    self._in_flight.pop(key, None)
+
+
+cache = IdempotencyCache()
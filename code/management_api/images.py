@@ -0,0 +1,230 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Background pulling of the data gateway images
+
+The images are pulled once, in the background, right after startup, so that the first enable request
+doesn't have to wait for a pull (which, on slow links, can take longer than Nuvla is willing to wait).
+There's at most one pull per image at any time: whoever needs an image that is still being pulled
+waits for that pull to finish, instead of starting a new one.
+"""
+
+import logging
+import os
+import threading
+import time
+from management_api import docker_client, metrics
+
+log = logging.getLogger(__name__)
+
+# how long an action waits for an image that is being pulled
+pull_wait_timeout = float(os.getenv("IMAGE_PULL_WAIT_TIMEOUT", 600))
+
+pull_retry_base = float(os.getenv("IMAGE_PULL_RETRY_BASE", 30))
+pull_retry_max = float(os.getenv("IMAGE_PULL_RETRY_MAX", 600))
+
+PENDING = "pending"
+PULLING = "pulling"
+READY = "ready"
+FAILED = "failed"
+
+
+class ImageNotReady(Exception):
+    """ Raised when an image is not available locally, and could not be pulled """
+    pass
+
+
+def split_reference(image):
+    """ Splits an image reference into repository and tag
+
+    :param image: i.e. nuvlabox/data-source-mjpg:0.0.2
+    :returns (repository, tag)
+    """
+    repository, _, tag = image.rpartition(":")
+    if not repository or "/" in tag:
+        # no tag, and maybe a registry with a port
+        return image, "latest"
+
+    return repository, tag
+
+
+class ImageStatus(object):
+    """ What we know about a single image """
+
+    def __init__(self, image):
+        self.image = image
+        self.state = PENDING
+        self.digest = None
+        self.image_id = None
+        self.layers = {}
+        self.error = None
+        self.attempts = 0
+        self.started = None
+        self.finished = None
+        self.ready = threading.Event()
+        self.done = threading.Event()
+
+    @property
+    def progress(self):
+        """ Pull progress, in percentage of the bytes of the layers we know about """
+        if self.state == READY:
+            return 100
+
+        total = sum(layer.get("total") or 0 for layer in self.layers.values())
+        current = sum(min(layer.get("current") or 0, layer.get("total") or 0) for layer in self.layers.values())
+        return int(100 * current / total) if total else 0
+
+    def to_dict(self):
+        return {"image": self.image,
+                "state": self.state,
+                "ready": self.ready.is_set(),
+                "digest": self.digest,
+                "image-id": self.image_id,
+                "progress": self.progress,
+                "layers": len(self.layers),
+                "error": self.error,
+                "started": self.started,
+                "finished": self.finished}
+
+
+class ImageWarmer(object):
+    """ Pulls images in the background, and tracks their readiness """
+
+    def __init__(self):
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def _status(self, image):
+        with self._lock:
+            return self._images.setdefault(image, ImageStatus(image))
+
+    def start(self, images):
+        """ Starts pulling images in the background, unless they are already being (or have been) pulled
+
+        :param images: image references
+        """
+        for image in images:
+            self._start_pull(image, retry=True)
+
+    def _start_pull(self, image, retry=False):
+        """ Starts a background pull of image, if there's none yet
+
+        :returns ImageStatus
+        """
+        status = self._status(image)
+        with self._lock:
+            if status.state == PULLING or (retry and status.started is not None):
+                return status
+
+            status.state = PULLING
+            status.done.clear()
+
+        threading.Thread(target=self._pull_loop if retry else self._pull, args=(status,), daemon=True,
+                         name="image-pull").start()
+        return status
+
+    def _inspect(self, status):
+        """ Looks the image up locally. If it's there, the image is ready to use """
+        from docker.errors import ImageNotFound
+
+        try:
+            with metrics.timed_call("docker", "images.get"):
+                image = docker_client.get_client().images.get(status.image)
+        except ImageNotFound:
+            return False
+
+        status.image_id = image.id
+        repository = split_reference(status.image)[0]
+        for repo_digest in image.attrs.get("RepoDigests") or []:
+            if repo_digest.split("@")[0] == repository or status.digest is None:
+                status.digest = repo_digest.split("@")[-1]
+
+        status.ready.set()
+        return True
+
+    def _pull(self, status):
+        """ Pulls an image, following its progress """
+        status.started = time.time()
+        status.finished = None
+        status.error = None
+        status.layers = {}
+        status.attempts += 1
+        repository, tag = split_reference(status.image)
+
+        try:
+            if not status.ready.is_set():
+                # already there from a previous run? Then it can be used right away, while we check for updates
+                self._inspect(status)
+
+            log.info("Pulling image %s", status.image)
+            with metrics.timed_call("docker", "pull"):
+                for event in docker_client.get_client().api.pull(repository, tag=tag, stream=True, decode=True):
+                    if "error" in event:
+                        raise ImageNotReady(event["error"])
+
+                    message = event.get("status", "")
+                    if message.startswith("Digest: "):
+                        status.digest = message.split(" ", 1)[-1]
+                    elif event.get("id") and event.get("progressDetail") is not None:
+                        status.layers.setdefault(event["id"], {}).update(event["progressDetail"])
+
+            self._inspect(status)
+            status.state = READY
+            log.info("Image %s is ready (%s)", status.image, status.digest)
+        except Exception as e:
+            log.warning("Could not pull image %s: %s", status.image, e)
+            status.error = str(e)
+            status.state = READY if status.ready.is_set() else FAILED
+        finally:
+            status.finished = time.time()
+            status.done.set()
+
+    def _pull_loop(self, status):
+        """ Pulls an image, retrying with an exponential backoff until it succeeds """
+        while True:
+            self._pull(status)
+            if status.error is None:
+                return
+
+            time.sleep(min(pull_retry_base * 2 ** (status.attempts - 1), pull_retry_max))
+            with self._lock:
+                if status.state == PULLING:
+                    # someone else is pulling it already
+                    return
+                status.state = PULLING
+                status.done.clear()
+
+    def ensure(self, image, timeout=pull_wait_timeout):
+        """ Makes sure an image is available locally, waiting for its pull if needed
+
+        :param image: image reference
+        :param timeout: max seconds to wait for the pull
+        :raises ImageNotReady
+        """
+        status = self._status(image)
+        if status.ready.is_set():
+            return
+
+        if status.state != PULLING:
+            status = self._start_pull(image)
+
+        log.info("Waiting for image %s to be pulled", image)
+        if not status.done.wait(timeout) and not status.ready.is_set():
+            raise ImageNotReady("Image {} is still being pulled. Try again later".format(image))
+
+        if not status.ready.is_set():
+            raise ImageNotReady("Image {} is not available: {}".format(image, status.error))
+
+    def status(self):
+        """ Pull status of all the images """
+        with self._lock:
+            images = list(self._images.values())
+
+        return [i.to_dict() for i in images]
+
+    def all_ready(self):
+        with self._lock:
+            return all(i.ready.is_set() for i in self._images.values())
+
+
+warmer = ImageWarmer()
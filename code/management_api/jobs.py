@@ -0,0 +1,196 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Asynchronous jobs for the long running management actions
+
+Jobs run on a bounded pool of worker threads. Jobs sharing the same key (i.e. the same streamer
+container) are serialized: they run one after the other, in submission order, while jobs with
+different keys run in parallel. A job can hold several keys at once (i.e. a batch over many streamers).
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from management_api import logs
+
+log = logging.getLogger(__name__)
+
+job_workers = int(os.getenv("MANAGEMENT_API_JOB_WORKERS", 4))
+max_pending_jobs = int(os.getenv("MANAGEMENT_API_MAX_PENDING_JOBS", 64))
+max_finished_jobs = int(os.getenv("MANAGEMENT_API_MAX_FINISHED_JOBS", 256))
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+
+class QueueFull(Exception):
+    """ Raised when there are too many jobs waiting to be executed """
+    pass
+
+
+class Job(object):
+    """ A management action running in the background """
+
+    def __init__(self, action, key, func, args, kwargs):
+        self.id = str(uuid.uuid4())
+        self.action = action
+        self.key = key
+        self.keys = {key} if isinstance(key, str) else set(key)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # the job's logs carry the id of the request that submitted it
+        self.log_context = logs.current_context()
+
+        self.state = QUEUED
+        self.progress = 0
+        self.status_message = "queued"
+        self.result = None
+        self.logs = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def set_progress(self, progress, message):
+        """ Updates the job progress
+
+        :param progress: percentage, from 0 to 100
+        :param message: short description of the current step
+        """
+        self.progress = progress
+        self.status_message = message
+
+    def run(self):
+        self.state = RUNNING
+        self.started = time.time()
+        with logs.bound(**dict(self.log_context, job_id=self.id)):
+            try:
+                self.result = self.func(self, *self.args, **self.kwargs)
+                self.state = SUCCESS
+                self.set_progress(100, "done")
+            except Exception as e:
+                log.exception("Job %s (%s on %s) failed: %s", self.id, self.action, self.key, e)
+                self.state = FAILED
+                self.error = {"message": str(e), "status": getattr(e, 'status_code', None)}
+                self.set_progress(100, "failed")
+            finally:
+                self.finished = time.time()
+                log.info("Job %s (%s on %s) %s", self.id, self.action, self.key, self.state.lower(),
+                         extra={"duration": round(self.finished - self.started, 4)})
+
+    def to_dict(self):
+        return {"id": self.id,
+                "action": self.action,
+                "key": self.key if isinstance(self.key, str) else sorted(self.keys),
+                "state": self.state,
+                "progress": self.progress,
+                "status-message": self.status_message,
+                "result": self.result,
+                "error": self.error,
+                "logs": self.logs,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished}
+
+
+class JobQueue(object):
+    """ Bounded worker pool that serializes the jobs with the same key """
+
+    def __init__(self, workers=job_workers, max_pending=max_pending_jobs, max_finished=max_finished_jobs):
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job-worker")
+        self._lock = threading.Lock()
+        # jobs waiting for a previous job with the same key to finish, in submission order
+        self._waiting = deque()
+        self._active_keys = set()
+        self._jobs = {}
+        self._finished = OrderedDict()
+        self._pending = 0
+
+    def submit(self, action, key, func, *args, **kwargs):
+        """ Schedules func(job, *args, **kwargs) for execution
+
+        :param action: name of the action, for reporting
+        :param key: serialization key, or list of keys. Jobs sharing a key never run concurrently
+        :param func: function to run. Gets the Job object as the first argument
+        :returns the Job object
+        """
+        job = Job(action, key, func, args, kwargs)
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull("Too many jobs pending execution ({}). Try again later".format(self._pending))
+
+            self._pending += 1
+            self._jobs[job.id] = job
+            if job.keys & self._active_keys or any(job.keys & waiting.keys for waiting in self._waiting):
+                self._waiting.append(job)
+                return job
+
+            self._active_keys |= job.keys
+
+        self._executor.submit(self._run, job)
+        return job
+
+    def _pop_runnable(self):
+        """ Takes out of the waiting list all the jobs that can now run, without overtaking
+        an earlier job that shares a key with them. Must be called with the lock held
+
+        :returns list of jobs
+        """
+        runnable = []
+        blocked = set(self._active_keys)
+        for waiting in list(self._waiting):
+            if waiting.keys & blocked:
+                blocked |= waiting.keys
+                continue
+
+            self._waiting.remove(waiting)
+            self._active_keys |= waiting.keys
+            blocked |= waiting.keys
+            runnable.append(waiting)
+
+        return runnable
+
+    def _run(self, job):
+        job.run()
+
+        with self._lock:
+            self._pending -= 1
+            self._finished[job.id] = job
+            while len(self._finished) > self.max_finished:
+                old_id, _ = self._finished.popitem(last=False)
+                self._jobs.pop(old_id, None)
+
+            self._active_keys -= job.keys
+            runnable = self._pop_runnable()
+
+        for next_job in runnable:
+            self._executor.submit(self._run, next_job)
+
+    def get(self, job_id):
+        """ Gives back the job with job_id, or None if unknown or already forgotten """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        """ Number of jobs queued or running """
+        with self._lock:
+            return self._pending
+
+    def busy(self, key):
+        """ Whether there's a job queued or running for key """
+        with self._lock:
+            return key in self._active_keys or any(key in waiting.keys for waiting in self._waiting)
+
+
+queue = JobQueue()
@@ -0,0 +1,243 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Non-blocking, structured logging
+
+The threads that serve requests (and run jobs) never write logs themselves: their records are put in a
+bounded in-memory queue, and written by a single listener thread, to stderr and to a size-rotated file
+in the data volume. If the queue is full, records are dropped (and counted) rather than blocking the caller.
+
+Records carry the id of the request (or job) they were emitted for, and are written to the file as
+JSON lines. Payloads should be logged with truncated() or fingerprint(), and lazily, with %-style
+arguments, so nothing is formatted for records below the log level.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from management_api.common import utils
+
+log = logging.getLogger(__name__)
+
+level = os.getenv("LOG_LEVEL", "INFO").upper()
+# text or json, for stderr. The log file is always JSON
+console_format = os.getenv("LOG_FORMAT", "text").lower()
+log_file = os.getenv("LOG_FILE", "{}/{}".format(utils.data_volume, utils.log_filename))
+log_file_max_bytes = int(os.getenv("LOG_FILE_MAX_BYTES", 1024 * 1024))
+log_file_backups = int(os.getenv("LOG_FILE_BACKUPS", 3))
+queue_size = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+payload_max_length = int(os.getenv("LOG_PAYLOAD_MAX_LENGTH", 256))
+
+text_format = '%(levelname)s - %(funcName)s - %(message)s'
+
+_context = threading.local()
+_standard_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+dropped = 0
+_handler = None
+_listener = None
+
+
+def current_context():
+    """ Context of the current thread (i.e. request id), added to its log records """
+    return dict(getattr(_context, "fields", {}))
+
+
+@contextmanager
+def bound(**fields):
+    """ Adds fields to the log records of the current thread, i.e. request_id, for the duration of the block """
+    previous = getattr(_context, "fields", {})
+    _context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+def bind(**fields):
+    """ Adds fields to the log records of the current thread, until clear() """
+    _context.fields = dict(getattr(_context, "fields", {}), **fields)
+
+
+def clear():
+    _context.fields = {}
+
+
+def fingerprint(value):
+    """ Short, stable digest of a value, to tell payloads apart in the logs without logging them """
+    if not isinstance(value, (str, bytes)):
+        value = json.dumps(value, sort_keys=True, default=str)
+    if isinstance(value, str):
+        value = value.encode()
+
+    return "sha256:" + hashlib.sha256(value).hexdigest()[:16]
+
+
+def truncate(value, limit=payload_max_length):
+    """ String representation of value, cut to limit characters """
+    text = value if isinstance(value, str) else json.dumps(value, sort_keys=True, default=str)
+    if len(text) <= limit:
+        return text
+
+    return "{}... ({} chars, {})".format(text[:limit], len(text), fingerprint(text))
+
+
+class Lazy(object):
+    """ Log argument that is only computed if the record is actually emitted """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+def truncated(value, limit=payload_max_length):
+    """ Lazy version of truncate(), for log arguments """
+    return Lazy(truncate, value, limit)
+
+
+class ContextFilter(logging.Filter):
+    """ Adds the context of the emitting thread to its records """
+
+    def filter(self, record):
+        for name, value in getattr(_context, "fields", {}).items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats records as single line JSON objects """
+
+    def format(self, record):
+        entry = {"time": "{}.{:03d}Z".format(time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)),
+                                             int(record.msecs)),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "function": record.funcName,
+                 "pid": record.process,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+
+        # extra fields: request_id, job_id, duration...
+        for name, value in vars(record).items():
+            if name not in _standard_attributes and not name.startswith("_"):
+                entry[name.replace("_", "-")] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that drops records when the queue is full, instead of blocking """
+
+    def prepare(self, record):
+        # the message is merged with its arguments here, while they can't change anymore.
+        # Serializing and writing the record is left to the listener thread
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """ Size-rotated log file, shared by all the processes of the API.
+    The file is re-opened when another process has rotated it """
+
+    def emit(self, record):
+        if self.stream is not None:
+            try:
+                changed = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+            except OSError:
+                changed = True
+            if changed:
+                self.stream.close()
+                self.stream = None
+
+        super(SharedRotatingFileHandler, self).emit(record)
+
+
+def _sinks():
+    """ Handlers that do the actual writing, in the listener thread """
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(JsonFormatter() if console_format == "json" else logging.Formatter(text_format))
+    sinks = [console]
+
+    if log_file and os.path.isdir(os.path.dirname(log_file) or "."):
+        file_handler = SharedRotatingFileHandler(log_file, maxBytes=log_file_max_bytes,
+                                                 backupCount=log_file_backups, delay=True)
+        file_handler.setFormatter(JsonFormatter())
+        sinks.append(file_handler)
+
+    return sinks
+
+
+def _start_listener():
+    global _listener
+    _handler.queue = queue.Queue(queue_size)
+    _listener = logging.handlers.QueueListener(_handler.queue, *_sinks(), respect_handler_level=True)
+    _listener.start()
+
+
+def setup():
+    """ Routes all the logs through the queue. Safe to call more than once """
+    global _handler
+    if _handler is not None:
+        return
+
+    _handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    _handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    _start_listener()
+    atexit.register(stop)
+
+
+def after_fork():
+    """ The listener thread doesn't survive a fork. Starts a new one, with a new queue, in the child """
+    if _handler is None:
+        return
+
+    _start_listener()
+
+
+def stop():
+    """ Writes the queued records, and stops the listener """
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def get_stats():
+    return {"dropped": dropped,
+            "queued": _handler.queue.qsize() if _handler else 0}
@@ -0,0 +1,254 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" In-process metrics, exposed in the Prometheus text format
+
+Minimal, thread-safe counters, gauges and histograms, plus an instrumentation layer that times
+every public management function in a module, and the calls made to external services (Docker, Nuvla).
+"""
+
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """ Base class for a metric family, with one value per label set """
+
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} expects labels {}, got {}".format(self.name, self.labelnames, tuple(labels)))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """ :returns list of (name suffix, labels, value) """
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        for suffix, labels, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(labels), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """ Mirrors a counter that is kept elsewhere. Only meant for collectors """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key + (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", key, total))
+            samples.append(("_count", key, cumulative))
+
+        return samples
+
+
+class Registry(object):
+    """ Holds all the metrics, plus collectors that are called at rendering time """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def add_collector(self, collector):
+        """ Registers a function to be called right before rendering, to refresh gauges that are
+        computed on demand (i.e. queue depths)
+
+        :param collector: function without arguments
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """ All metrics, in the Prometheus text exposition format """
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics)
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception:
+                log.exception("Metrics collector %s failed", collector)
+
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter("management_api_http_requests_total",
+                                 "HTTP requests handled, by route, method and status code",
+                                 ("route", "method", "status"))
+http_request_duration = registry.histogram("management_api_http_request_duration_seconds",
+                                           "HTTP request latency, by route, method and status code",
+                                           ("route", "method", "status"))
+http_requests_in_flight = registry.gauge("management_api_http_requests_in_flight",
+                                         "HTTP requests currently being handled, by route",
+                                         ("route",))
+action_duration = registry.histogram("management_api_action_duration_seconds",
+                                     "Duration of the management actions, by action and outcome",
+                                     ("action", "outcome"))
+external_call_duration = registry.histogram("management_api_external_call_duration_seconds",
+                                            "Duration of the calls to external services, by service, call "
+                                            "and outcome",
+                                            ("service", "call", "outcome"))
+
+
+@contextmanager
+def timed_call(service, call):
+    """ Times a call to an external service
+
+    :param service: i.e. docker or nuvla
+    :param call: name of the call, i.e. containers.run
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        external_call_duration.observe(time.perf_counter() - start, service=service, call=call, outcome=outcome)
+
+
+def instrumented(action):
+    """ Decorator that times a management action
+
+    :param action: name of the action
+    """
+    def decorator(func):
+        if getattr(func, "__instrumented__", False):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                outcome = "success"
+                return result
+            finally:
+                action_duration.observe(time.perf_counter() - start, action=action, outcome=outcome)
+
+        wrapper.__instrumented__ = True
+        return wrapper
+
+    return decorator
+
+
+def instrument_module(module):
+    """ Wraps every public function defined in module, so that all its management actions
+    (including the ones added in the future) are timed
+
+    :param module: module object, i.e. management_api.Manage
+    """
+    for name, func in inspect.getmembers(module, inspect.isfunction):
+        if name.startswith("_") or func.__module__ != module.__name__:
+            continue
+        setattr(module, name, instrumented(name)(func))
@@ -0,0 +1,182 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Long-lived, thread-safe Nuvla session shared by all the management actions
+
+The Nuvla API instance (and its pooled HTTP connections) is kept for the lifetime of the process.
+We only log in again when the session cookie has expired, when Nuvla answers with 401/403,
+or when the NuvlaBox configuration files have changed on disk.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from management_api.common import utils
+from management_api import metrics
+
+log = logging.getLogger(__name__)
+
+# re-login a bit before the session cookie actually expires, to avoid racing with Nuvla
+session_expiry_margin = 60
+
+reauthentication_status_codes = (401, 403)
+
+
+class NuvlaSession(object):
+    """ Keeps one authenticated nuvla.api.Api instance, and re-creates it only when needed """
+
+    def __init__(self, nuvla_configuration=utils.nuvla_configuration, activation_flag=utils.activation_flag):
+        self.nuvla_configuration = nuvla_configuration
+        self.activation_flag = activation_flag
+
+        self._lock = threading.RLock()
+        self._api = None
+        self._config_signature = None
+        self._credentials = None
+        self._logged_in_at = None
+
+        self.stats = {"sessions-created": 0,
+                      "session-reuses": 0,
+                      "logins": 0,
+                      "re-logins": 0,
+                      "config-reloads": 0,
+                      "auth-failures": 0}
+
+    @staticmethod
+    def _file_signature(path):
+        """ mtime and inode of a file, or None if it does not exist """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return st.st_mtime_ns, st.st_ino
+
+    def _read_configuration(self):
+        """ Parses the NuvlaBox configuration and activation files
+
+        :returns (nuvla_endpoint, nuvla_endpoint_insecure, credentials)
+        """
+        if not os.path.exists(self.nuvla_configuration):
+            raise Exception("NuvlaBox is not yet ready to be operated. Missing Nuvla configuration parameters")
+
+        nuvla_endpoint_raw = nuvla_endpoint_insecure_raw = None
+        with open(self.nuvla_configuration) as nuvla_conf:
+            for line in nuvla_conf.read().split():
+                try:
+                    if line and 'NUVLA_ENDPOINT=' in line:
+                        nuvla_endpoint_raw = line.split('=')[-1]
+                    if line and 'NUVLA_ENDPOINT_INSECURE=' in line:
+                        nuvla_endpoint_insecure_raw = bool(line.split('=')[-1])
+                except IndexError:
+                    pass
+
+        if not nuvla_endpoint_raw or not nuvla_endpoint_insecure_raw:
+            raise Exception(f'Misconfigured Nuvla parameters in {self.nuvla_configuration}. Cannot perform operation')
+
+        try:
+            with open(self.activation_flag) as a:
+                user_info = json.loads(a.read())
+        except FileNotFoundError:
+            raise Exception("Cannot authenticate back with Nuvla")
+
+        return nuvla_endpoint_raw, nuvla_endpoint_insecure_raw, (user_info['api-key'], user_info['secret-key'])
+
+    def _current_config_signature(self):
+        return self._file_signature(self.nuvla_configuration), self._file_signature(self.activation_flag)
+
+    def _session_expired(self):
+        """ Checks whether the Nuvla session cookie is missing or about to expire """
+        if not self._api or not self._logged_in_at:
+            return True
+
+        cookies = list(self._api.session.cookies)
+        if not cookies:
+            return True
+
+        now = time.time()
+        for cookie in cookies:
+            if cookie.expires and cookie.expires <= now + session_expiry_margin:
+                return True
+
+        return False
+
+    def _login(self):
+        """ Authenticates the current API instance with the NuvlaBox API key """
+        key, secret = self._credentials
+        with metrics.timed_call("nuvla", "login_apikey"):
+            response = self._api.login_apikey(key, secret)
+        if response is not None and response.status_code != 201:
+            self.stats["auth-failures"] += 1
+            self._logged_in_at = None
+            raise Exception("Cannot authenticate back with Nuvla: {}".format(response.status_code))
+
+        self._logged_in_at = time.time()
+        self.stats["logins"] += 1
+
+    def get(self):
+        """ Gives back an authenticated Nuvla API instance, re-using the existing one whenever possible
+
+        :returns nuvla.api.Api instance
+        """
+        with self._lock:
+            signature = self._current_config_signature()
+            if self._api is None or signature != self._config_signature:
+                if self._api is not None:
+                    log.info("Nuvla configuration has changed. Re-creating Nuvla session")
+                    self.stats["config-reloads"] += 1
+
+                endpoint, insecure, self._credentials = self._read_configuration()
+                # the Nuvla SDK is only imported when it's first needed, to keep the startup fast
+                from nuvla.api import Api
+                # cookies are kept in memory: the cookie file is not safe to share between threads
+                self._api = Api(endpoint='https://{}'.format(endpoint), insecure=insecure,
+                                persist_cookie=False, reauthenticate=True)
+                self._config_signature = signature
+                self._logged_in_at = None
+                self.stats["sessions-created"] += 1
+                self._login()
+            elif self._session_expired():
+                self.stats["re-logins"] += 1
+                self._login()
+            else:
+                self.stats["session-reuses"] += 1
+
+            return self._api
+
+    def invalidate(self):
+        """ Forces a new login on the next call to get() """
+        with self._lock:
+            self._logged_in_at = None
+
+    def call(self, func, *args, **kwargs):
+        """ Runs func(api, *args, **kwargs) with an authenticated API instance,
+        re-authenticating and retrying once if Nuvla rejects the session
+
+        :param func: callable whose first argument is the nuvla.api.Api instance
+        :returns whatever func returns
+        """
+        from nuvla.api.api import NuvlaError
+
+        api = self.get()
+        try:
+            return func(api, *args, **kwargs)
+        except NuvlaError as e:
+            if e.response is None or e.response.status_code not in reauthentication_status_codes:
+                raise
+
+            log.warning("Nuvla session rejected with %s. Re-authenticating", e.response.status_code)
+            self.invalidate()
+
+            return func(self.get(), *args, **kwargs)
+
+    def get_stats(self):
+        """ Snapshot of the session counters """
+        with self._lock:
+            return dict(self.stats)
+
+
+# process-wide session, shared by the gthread workers
+session = NuvlaSession()
@@ -0,0 +1,241 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Write-behind buffer for the Nuvla peripheral updates
+
+Peripheral updates are not sent to Nuvla from the request path. They are buffered, persisted in the
+data volume, and delivered in the background by a flusher thread:
+ - pending updates are merged per peripheral, so only the last state is sent (i.e. the disable and enable
+   of a restart become a single update)
+ - an update is delivered after a short debounce interval, or right away when the buffer is full
+ - an update that can't be delivered because of Nuvla or the network stays in the buffer, and is retried with
+   an exponential backoff. An update that Nuvla rejects (4xx) is dropped, as it would be rejected again
+ - the buffer is reloaded from disk on startup, so no update is lost across restarts
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from management_api.common import utils
+from management_api import Manage
+
+log = logging.getLogger(__name__)
+
+outbox_file = os.getenv("NUVLA_OUTBOX_FILE", "{}/.nuvla-outbox.json".format(utils.data_volume))
+
+debounce = float(os.getenv("NUVLA_UPDATE_DEBOUNCE", 1))
+max_buffered = int(os.getenv("NUVLA_UPDATE_BUFFER_SIZE", 32))
+
+backoff_base = float(os.getenv("NUVLA_OUTBOX_BACKOFF_BASE", 5))
+backoff_max = float(os.getenv("NUVLA_OUTBOX_BACKOFF_MAX", 600))
+
+# client errors that are not about the update itself, and might go away
+retryable_status_codes = (401, 408, 429)
+
+
+def retryable(status_code):
+    """ Whether a failed update is worth retrying
+
+    :param status_code: HTTP status Nuvla replied with, or None if there was no reply (i.e. connection error)
+    :returns bool
+    """
+    return status_code is None or status_code >= 500 or status_code in retryable_status_codes
+
+
+class Outbox(object):
+    """ Peripheral updates waiting to be delivered to Nuvla, indexed by peripheral id """
+
+    def __init__(self, path=outbox_file, debounce=debounce, max_buffered=max_buffered):
+        self.path = path
+        self.debounce = debounce
+        self.max_buffered = max_buffered
+
+        self._entries = None
+        self._version = 0
+        self._full = False
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.stats = {"delivered": 0, "queued": 0, "coalesced": 0, "retries": 0, "rejected": 0}
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as entries:
+                    self._entries = {e["id"]: e for e in json.load(entries)}
+            except FileNotFoundError:
+                self._entries = {}
+            except (ValueError, KeyError, TypeError):
+                log.exception("Discarding corrupted Nuvla outbox %s", self.path)
+                self._entries = {}
+
+            self._version = max([e.get("version", 0) for e in self._entries.values()] + [self._version])
+
+        return self._entries
+
+    def _save(self):
+        try:
+            utils.atomic_write(self.path, json.dumps(list(self._entries.values())))
+        except OSError:
+            log.exception("Could not persist the Nuvla outbox to %s", self.path)
+
+    def start(self):
+        """ Starts the flusher thread, if not yet started """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._run, daemon=True, name="nuvla-outbox-flusher")
+            self._thread.start()
+
+    @staticmethod
+    def _deliver(peripheral_id, update):
+        """ Sends one update to Nuvla
+
+        :returns "delivered", "rejected" if Nuvla won't ever take it, or "retry"
+        """
+        from nuvla.api.api import NuvlaError
+        from requests import RequestException
+
+        try:
+            Manage.update_peripheral_resource(peripheral_id, **update)
+        except NuvlaError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code == 404:
+                # the peripheral has been deleted, so there's nothing left to update
+                log.warning("Peripheral %s does not exist in Nuvla anymore. Discarding update", peripheral_id)
+                return "rejected"
+            if not retryable(status_code):
+                log.error("Nuvla rejected the update of %s with %s. Discarding update: %s", peripheral_id,
+                          status_code, e)
+                return "rejected"
+            log.warning("Could not update %s in Nuvla: %s", peripheral_id, e)
+            return "retry"
+        except (RequestException, OSError) as e:
+            log.warning("Could not update %s in Nuvla: %s", peripheral_id, e)
+            return "retry"
+        except Exception:
+            log.exception("Cannot update %s in Nuvla. Discarding update", peripheral_id)
+            return "rejected"
+
+        return "delivered"
+
+    def send(self, peripheral_id, **update):
+        """ Queues a peripheral update for delivery to Nuvla, replacing any update still pending for it
+
+        :param peripheral_id: Nuvla id of the peripheral
+        :param update: keyword arguments for Manage.update_peripheral_resource
+        """
+        with self._lock:
+            entries = self._load()
+            current = entries.get(peripheral_id)
+            now = time.time()
+
+            self._version += 1
+            if current:
+                # each update carries the whole peripheral state, so the last one wins.
+                # The delivery time is kept, so a stream of updates can't postpone it forever
+                self.stats["coalesced"] += 1
+                entry = dict(current, update=update, version=self._version)
+            else:
+                entry = {"id": peripheral_id,
+                         "update": update,
+                         "attempts": 0,
+                         "next-attempt": now + self.debounce,
+                         "created": now,
+                         "version": self._version}
+
+            entries[peripheral_id] = entry
+            self._save()
+            self.stats["queued"] += 1
+
+            if len(entries) >= self.max_buffered:
+                self._full = True
+            self._wakeup.notify()
+
+        self.start()
+
+    def _next_wait(self):
+        """ Seconds until the next update is due, or None if there's nothing to deliver.
+        Must be called with the lock held """
+        if self._full:
+            return 0
+
+        entries = self._load()
+        if not entries:
+            return None
+
+        return max(min(e["next-attempt"] for e in entries.values()) - time.time(), 0)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                wait = self._next_wait()
+                if wait is None or wait > 0:
+                    self._wakeup.wait(wait)
+                    continue
+
+                full, self._full = self._full, False
+
+            try:
+                self.flush(full=full)
+            except Exception:
+                log.exception("Could not flush the Nuvla outbox")
+                time.sleep(1)
+
+    def flush(self, full=False, force=False):
+        """ Delivers the updates that are due
+
+        :param full: the buffer is full. Deliver the debounced updates right away, but respect the backoff
+        :param force: deliver all the buffered updates, regardless of their debounce or backoff
+        :returns number of updates delivered
+        """
+        delivered = 0
+        with self._flush_lock:
+            now = time.time()
+            with self._lock:
+                due = [dict(e) for e in self._load().values()
+                       if force or e["next-attempt"] <= now or (full and not e["attempts"])]
+
+            for entry in sorted(due, key=lambda e: e["created"]):
+                peripheral_id = entry["id"]
+                outcome = self._deliver(peripheral_id, entry["update"])
+
+                with self._lock:
+                    entries = self._load()
+                    current = entries.get(peripheral_id)
+                    if entry["attempts"]:
+                        self.stats["retries"] += 1
+
+                    if outcome != "retry":
+                        self.stats[outcome] += 1
+                        delivered += outcome == "delivered"
+                        if current is not None and current["version"] == entry["version"]:
+                            entries.pop(peripheral_id)
+                        # otherwise, a newer update came in meanwhile, and is still to be delivered
+                    elif current is not None:
+                        current["attempts"] += 1
+                        current["next-attempt"] = time.time() + min(backoff_base * 2 ** (current["attempts"] - 1),
+                                                                    backoff_max)
+                    self._save()
+
+        return delivered
+
+    def pending(self):
+        """ Copy of the buffered updates """
+        with self._lock:
+            return [dict(e) for e in self._load().values()]
+
+    def depth(self):
+        with self._lock:
+            return len(self._load())
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+outbox = Outbox()
@@ -0,0 +1,228 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Background reconciliation of the MJPG streamers with Docker and Nuvla
+
+Periodically, the reconciler compares the streamers that should be running (the streamer state store) with the
+data source containers that actually exist (the container registry), and re-creates the missing ones, as well as
+the ones whose video settings don't match what the host load currently allows.
+The matching Nuvla peripheral updates go through the outbox, like any other.
+
+Each round only looks at a slice of the streamers, so a round stays cheap no matter how many there are.
+Repairs go through the job queue, so they never race with a user action on the same streamer.
+
+Data source containers that the store knows too little about to re-create (i.e. created before an upgrade, or
+before the state file was lost, so with no Nuvla peripheral id) are orphans. They are reported, once, and
+counted, but left alone on purpose: they might still stream for a peripheral, and the next enable request
+for it adopts them.
+"""
+
+import logging
+import os
+import threading
+import time
+from management_api import Manage, budget, docker_client, jobs, outbox, streamers, video_devices
+
+log = logging.getLogger(__name__)
+
+interval = float(os.getenv("RECONCILE_INTERVAL", 30))
+batch_size = int(os.getenv("RECONCILE_BATCH_SIZE", 10))
+
+repair_backoff_base = float(os.getenv("RECONCILE_REPAIR_BACKOFF_BASE", 30))
+repair_backoff_max = float(os.getenv("RECONCILE_REPAIR_BACKOFF_MAX", 1800))
+
+# attributes needed to re-create a streamer
+required_attributes = ("id", "video-device", "resolution", "fps")
+
+
+def needs_new_settings(container, streamer):
+    """ Whether a streamer runs with other video settings than what the host load currently allows
+
+    :param container: docker Container object of the streamer
+    :param streamer: streamer record, with the requested settings
+    """
+    current = streamers.record_from_container(container)
+    if "effective-resolution" not in current or "effective-fps" not in current:
+        # not created by this service
+        return False
+
+    return (current["effective-resolution"], current["effective-fps"]) != \
+        budget.policy.effective(streamer["resolution"], streamer["fps"],
+                                video_devices.inventory.resolutions(streamer["video-device"]))
+
+
+def repair_data_source_mjpg_job(job, name):
+    """ Job for re-creating a streamer whose container has disappeared, or has outdated video settings
+
+    :param job: the Job object running this function
+    :param name: name of the streamer
+    :returns job result message
+    """
+    streamer = streamers.store.get(name)
+    container = docker_client.registry.get(name)
+    if streamer is None or not docker_client.registry.synced or \
+            (container is not None and not needs_new_settings(container, streamer)):
+        # disabled or fixed in the meantime
+        return "nothing to repair for {}".format(name)
+
+    job.set_progress(10, "re-creating MJPG streamer container")
+    endpoint, container = Manage.start_container_data_source_mjpg(name,
+                                                                  streamer["video-device"],
+                                                                  streamer["resolution"],
+                                                                  streamer["fps"])
+    streamers.store.update(name, endpoint=endpoint, status=container.status)
+
+    job.set_progress(70, "updating {} in Nuvla".format(streamer["id"]))
+    outbox.outbox.send(streamer["id"], local_data_gateway_endpoint=endpoint, **budget.nuvla_update(container))
+
+    return "MJPG streamer {} re-created".format(name)
+
+
+class Reconciler(object):
+    """ Periodic, incremental repair of the drift between the desired and the actual streamers """
+
+    def __init__(self, interval=interval, batch_size=batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._cursor = ""
+        self._failures = {}
+        self._repairing = set()
+        self._orphans = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.stats = {"rounds": 0, "repairs": 0, "repair-failures": 0, "orphans-found": 0}
+
+    def start(self):
+        """ Starts the reconciliation loop, if not yet started """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="reconciler")
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("Reconciliation round failed")
+
+    def _next_slice(self, names):
+        """ The next batch_size names after the cursor, wrapping around """
+        names = sorted(names)
+        following = [n for n in names if n > self._cursor]
+        batch = (following + [n for n in names if n <= self._cursor])[:self.batch_size]
+        self._cursor = batch[-1] if batch else ""
+        return batch
+
+    def _backing_off(self, name, now):
+        """ Must be called with the lock held """
+        return self._failures.get(name, (0, 0))[1] > now
+
+    def _repair(self, job, name):
+        """ Runs the repair job for name, and keeps track of its failures. Runs in a job thread """
+        try:
+            result = repair_data_source_mjpg_job(job, name)
+        except Exception:
+            with self._lock:
+                attempts = self._failures.get(name, (0, 0))[0] + 1
+                self._failures[name] = (attempts, time.time() + min(repair_backoff_base * 2 ** (attempts - 1),
+                                                                    repair_backoff_max))
+                self.stats["repair-failures"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._repairing.discard(name)
+
+        with self._lock:
+            self._failures.pop(name, None)
+            self.stats["repairs"] += 1
+        return result
+
+    def _report_orphans(self, records):
+        """ Logs the data source containers that can't be re-created, the first time they are seen """
+        orphans = {}
+        for name, streamer in records.items():
+            missing = [a for a in required_attributes if streamer.get(a) is None]
+            if missing and docker_client.registry.get(name) is not None:
+                orphans[name] = missing
+
+        with self._lock:
+            found = set(orphans) - self._orphans
+            self._orphans = set(orphans)
+            self.stats["orphans-found"] += len(found)
+
+        for name in sorted(found):
+            log.warning("Data source container %s is not managed by this service (no %s). Leaving it alone",
+                        name, ", ".join(orphans[name]))
+
+    def run_once(self):
+        """ One reconciliation round
+
+        :returns list of the repair jobs submitted in this round
+        """
+        with self._lock:
+            self.stats["rounds"] += 1
+
+        docker_client.registry.start()
+        if not docker_client.registry.synced:
+            # we can't tell which containers are missing
+            return []
+
+        records = {r["name"]: r for r in streamers.store.list()}
+        self._report_orphans(records)
+        now = time.time()
+
+        submitted = []
+        for name in self._next_slice(records):
+            streamer = records[name]
+            with self._lock:
+                if name in self._repairing or self._backing_off(name, now):
+                    continue
+
+            if any(streamer.get(a) is None for a in required_attributes):
+                # an orphan, reported above
+                continue
+
+            container = docker_client.registry.get(name)
+            if container is None:
+                log.info("MJPG streamer %s should be running but its container is gone. Re-creating it", name)
+            elif needs_new_settings(container, streamer):
+                log.info("MJPG streamer %s runs with outdated video settings. Re-creating it", name)
+            else:
+                continue
+
+            # before submitting, as the job might be done before submit() returns
+            with self._lock:
+                self._repairing.add(name)
+            try:
+                job = jobs.queue.submit("repair-data-source-mjpg", name, self._repair, name)
+            except jobs.QueueFull:
+                with self._lock:
+                    self._repairing.discard(name)
+                log.warning("Job queue is full. Postponing the repair of %s", name)
+                break
+
+            submitted.append(job)
+
+        return submitted
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def orphans(self):
+        """ :returns sorted names of the data source containers that can't be re-created """
+        with self._lock:
+            return sorted(self._orphans)
+
+
+reconciler = Reconciler()
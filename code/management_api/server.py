@@ -0,0 +1,204 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Configurable gunicorn launcher for the NuvlaBox Management API
+
+The server settings are resolved from, in increasing order of precedence:
+ - per-architecture defaults
+ - the config file (KEY=VALUE lines) at MANAGEMENT_API_CONFIG
+ - environment variables
+
+using the same MANAGEMENT_API_* names in both the config file and the environment.
+
+MANAGEMENT_API_WORKER_CLASS is one of gthread (the default), sync or gevent. With gevent, the slow
+Docker and Nuvla calls don't pin a thread each, and MANAGEMENT_API_WORKER_CONNECTIONS bounds the
+concurrent requests instead of MANAGEMENT_API_THREADS. gevent must patch the standard library before
+anything else is imported, so the app is then loaded by each worker rather than preloaded in the master.
+"""
+
+import importlib.util
+import logging
+import multiprocessing
+import os
+import platform
+from management_api.common import utils
+
+log = logging.getLogger(__name__)
+
+config_file = os.getenv("MANAGEMENT_API_CONFIG", "{}/.management-api.conf".format(utils.data_volume))
+
+# setting name: (environment variable, type)
+settings_spec = {
+    "bind": ("MANAGEMENT_API_BIND", str),
+    "workers": ("MANAGEMENT_API_WORKERS", int),
+    "threads": ("MANAGEMENT_API_THREADS", int),
+    "worker_class": ("MANAGEMENT_API_WORKER_CLASS", str),
+    "worker_connections": ("MANAGEMENT_API_WORKER_CONNECTIONS", int),
+    "keepalive": ("MANAGEMENT_API_KEEPALIVE", int),
+    "backlog": ("MANAGEMENT_API_BACKLOG", int),
+    "timeout": ("MANAGEMENT_API_TIMEOUT", int),
+    "graceful_timeout": ("MANAGEMENT_API_GRACEFUL_TIMEOUT", int),
+    "reload": ("MANAGEMENT_API_RELOAD", bool),
+    "ciphers": ("MANAGEMENT_API_TLS_CIPHERS", str),
+    "ecdh_curves": ("MANAGEMENT_API_TLS_ECDH_CURVES", str),
+}
+
+# evented worker classes, and the module they need. gevent is in requirements.txt
+evented_worker_classes = {"gevent": "gevent"}
+worker_classes = ("gthread", "sync") + tuple(evented_worker_classes)
+
+
+def to_bool(value):
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def default_settings():
+    """ Sensible defaults for the architecture we are running on
+
+    The job queue, container registry and Nuvla session live in the worker process, so we default
+    to a single worker and scale with threads instead
+
+    :returns dict of settings
+    """
+    machine = platform.machine().lower()
+    cpus = multiprocessing.cpu_count()
+    low_power = machine.startswith("arm") or machine in ("aarch64", "arm64")
+
+    # forward secrecy with ECDHE only. Boards without AES instructions are much faster with ChaCha20
+    ciphers = ["ECDHE+AESGCM", "ECDHE+CHACHA20"]
+    if low_power:
+        ciphers.reverse()
+
+    return {
+        "bind": "0.0.0.0:5001",
+        "workers": 1,
+        "threads": 4 if low_power else min(max(4, 2 * cpus), 16),
+        "worker_class": "gthread",
+        "worker_connections": 100 if low_power else 500,
+        # idle connections wait in the worker's poller, not in a thread, so they're cheap to keep around,
+        # while a new connection costs a TLS handshake
+        "keepalive": 30,
+        "backlog": 64 if low_power else 2048,
+        "timeout": 60,
+        "graceful_timeout": 30,
+        "reload": False,
+        "ciphers": ":".join(ciphers + ["!aNULL", "!eNULL", "!MD5", "!DSS"]),
+        # the cheapest key exchanges, everywhere. The first one that OpenSSL accepts is used (older
+        # versions only take prime curves). Empty to keep the OpenSSL defaults
+        "ecdh_curves": "X25519:prime256v1",
+    }
+
+
+def read_config_file(path):
+    """ Parses a KEY=VALUE config file
+
+    :param path: path to the config file
+    :returns dict of raw values, by variable name
+    """
+    values = {}
+    try:
+        with open(path) as conf:
+            for line in conf.read().splitlines():
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                values[key.strip()] = value.strip().strip('"').strip("'")
+    except FileNotFoundError:
+        pass
+
+    return values
+
+
+def load_settings(path=config_file, environ=os.environ):
+    """ Resolves the server settings
+
+    :param path: path to the config file
+    :param environ: environment variables
+    :returns dict of settings
+    """
+    settings = default_settings()
+    sources = [read_config_file(path), environ]
+
+    for source in sources:
+        for name, (var, cast) in settings_spec.items():
+            if var not in source:
+                continue
+            try:
+                settings[name] = to_bool(source[var]) if cast is bool else cast(source[var])
+            except ValueError:
+                log.warning("Invalid value %s for %s. Using %s", source[var], var, settings[name])
+
+    if settings["worker_class"] not in worker_classes:
+        log.warning("Unsupported worker class %s. Use one of %s. Falling back to gthread",
+                    settings["worker_class"], ", ".join(worker_classes))
+        settings["worker_class"] = "gthread"
+
+    module = evented_worker_classes.get(settings["worker_class"])
+    if module and importlib.util.find_spec(module) is None:
+        log.warning("Worker class %s needs %s to be installed. Falling back to gthread",
+                    settings["worker_class"], module)
+        settings["worker_class"] = "gthread"
+
+    return settings
+
+
+def concurrency(settings):
+    """ Number of requests a worker process serves at once
+
+    :param settings: server settings, from load_settings()
+    :returns int
+    """
+    if settings["worker_class"] in evented_worker_classes:
+        return settings["worker_connections"]
+
+    return settings["threads"]
+
+
+def gunicorn_command(settings, keyfile, certfile, ca_certs, app="wsgi:app"):
+    """ Builds the gunicorn command line
+
+    :param settings: server settings, from load_settings()
+    :param keyfile: TLS key
+    :param certfile: TLS certificate
+    :param ca_certs: CA for validating the client certificates
+    :param app: WSGI app to serve
+    :returns list with the command and its arguments
+    """
+    cmd = ["gunicorn",
+           "--bind={}".format(settings["bind"]),
+           "--workers={}".format(settings["workers"]),
+           "--worker-class={}".format(settings["worker_class"]),
+           "--keep-alive={}".format(settings["keepalive"]),
+           "--backlog={}".format(settings["backlog"]),
+           "--timeout={}".format(settings["timeout"]),
+           "--graceful-timeout={}".format(settings["graceful_timeout"])]
+
+    if settings["worker_class"] in evented_worker_classes:
+        cmd.append("--worker-connections={}".format(settings["worker_connections"]))
+    else:
+        cmd.append("--threads={}".format(settings["threads"]))
+
+    if settings["reload"]:
+        # development only: gunicorn polls all the source files for changes
+        cmd.append("--reload")
+    elif settings["worker_class"] not in evented_worker_classes:
+        # import the app once, in the master, instead of once per worker. Evented workers must import it
+        # themselves, after patching the standard library
+        cmd.append("--preload")
+
+    # starts the background services in the workers, after the fork (or after patching, for evented
+    # workers), and keeps a single TLS context
+    cmd += ["--config", "python:management_api.gunicorn_hooks"]
+
+    cmd += ["--keyfile", keyfile,
+            "--certfile", certfile,
+            "--ca-certs", ca_certs,
+            "--cert-reqs", "2", "--no-sendfile"]
+
+    if settings["ciphers"]:
+        cmd.append("--ciphers={}".format(settings["ciphers"]))
+
+    cmd.append(app)
+
+    return cmd
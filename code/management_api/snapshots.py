@@ -0,0 +1,279 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Cached snapshots of the MJPG streamers, and the raw data samples of their peripherals in Nuvla
+
+A snapshot is a single JPEG frame, grabbed from a streamer through the data gateway, instead of pulling
+its whole stream. The last frame of each streamer is kept in memory for a few seconds, in a small cache
+where the least recently used streamers are evicted first. Concurrent requests for the same streamer are
+served by a single grab.
+
+At most once every SNAPSHOT_SAMPLE_INTERVAL per streamer, a grabbed frame is also sent to Nuvla as the
+raw-data-sample of the peripheral, downscaled with Pillow first. Without Pillow, only frames that are
+already small enough are sent.
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from management_api import budget, docker_client, jobs, metrics, outbox, streamers
+
+log = logging.getLogger(__name__)
+
+ttl = float(os.getenv("SNAPSHOT_TTL", 2))
+cache_size = int(os.getenv("SNAPSHOT_CACHE_SIZE", 16))
+timeout = float(os.getenv("SNAPSHOT_TIMEOUT", 5))
+max_bytes = int(os.getenv("SNAPSHOT_MAX_BYTES", 4 * 1024 * 1024))
+# mjpg-streamer serves single frames with action=snapshot, behind the same data gateway route as the stream
+url_template = os.getenv("SNAPSHOT_URL", "http://data-gateway/video/{name}?action=snapshot")
+
+push_samples = os.getenv("SNAPSHOT_PUSH_SAMPLES", "true").strip().lower() in ("1", "true", "yes", "on")
+sample_interval = float(os.getenv("SNAPSHOT_SAMPLE_INTERVAL", 300))
+sample_size = os.getenv("SNAPSHOT_SAMPLE_SIZE", "320x240")
+sample_max_bytes = int(os.getenv("SNAPSHOT_SAMPLE_MAX_BYTES", 64 * 1024))
+
+
+class SnapshotError(Exception):
+    """ Raised when a frame can't be grabbed from a streamer """
+
+
+class Snapshot(object):
+    """ A JPEG frame of a streamer """
+
+    def __init__(self, name, image):
+        self.name = name
+        self.image = image
+        self.etag = hashlib.sha256(image).hexdigest()[:32]
+        self.grabbed = time.time()
+
+    @property
+    def age(self):
+        return time.time() - self.grabbed
+
+
+def grab(name):
+    """ Grabs a single frame from a streamer
+
+    :param name: name of the streamer container
+    :returns JPEG bytes
+    :raises SnapshotError
+    """
+    import requests
+
+    try:
+        with metrics.timed_call("data-gateway", "snapshot"):
+            response = requests.get(url_template.format(name=name), timeout=timeout, stream=True)
+            try:
+                if response.status_code != 200:
+                    raise SnapshotError("MJPG streamer {} replied {} to the snapshot request"
+                                        .format(name, response.status_code))
+                image = response.raw.read(max_bytes + 1, decode_content=True)
+            finally:
+                response.close()
+    except requests.RequestException as e:
+        raise SnapshotError("Cannot grab a frame from MJPG streamer {}: {}".format(name, e))
+
+    if len(image) > max_bytes:
+        raise SnapshotError("Frame from MJPG streamer {} is bigger than {} bytes".format(name, max_bytes))
+    if not image.startswith(b"\xff\xd8"):
+        raise SnapshotError("MJPG streamer {} did not send a JPEG frame".format(name))
+
+    return image
+
+
+class _Grab(object):
+    """ A grab in progress, shared by all the requests for the same streamer """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.snapshot = None
+        self.error = None
+
+
+class SnapshotCache(object):
+    """ Last frame of each streamer, for ttl seconds, and for at most size streamers """
+
+    def __init__(self, size=cache_size, ttl=ttl, grabber=grab):
+        self.size = max(size, 1)
+        self.ttl = ttl
+        self.grabber = grabber
+        self._entries = OrderedDict()
+        self._grabs = {}
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def get(self, name):
+        """ A frame of the streamer, no older than ttl
+
+        :param name: name of the streamer container
+        :returns Snapshot
+        :raises SnapshotError
+        """
+        with self._lock:
+            snapshot = self._entries.get(name)
+            if snapshot is not None and snapshot.age < self.ttl:
+                self._entries.move_to_end(name)
+                self.stats["hits"] += 1
+                return snapshot
+
+            in_progress = self._grabs.get(name)
+            leader = in_progress is None
+            if leader:
+                in_progress = self._grabs[name] = _Grab()
+                self.stats["grabs"] += 1
+            else:
+                self.stats["shared"] += 1
+
+        if not leader:
+            if not in_progress.done.wait(timeout + 1):
+                raise SnapshotError("Timed out waiting for a frame from MJPG streamer {}".format(name))
+            if in_progress.error is not None:
+                raise in_progress.error
+            return in_progress.snapshot
+
+        try:
+            in_progress.snapshot = Snapshot(name, self.grabber(name))
+        except Exception as e:
+            in_progress.error = e if isinstance(e, SnapshotError) else SnapshotError(str(e))
+            self.stats["errors"] += 1
+            raise in_progress.error
+        finally:
+            with self._lock:
+                del self._grabs[name]
+                if in_progress.snapshot is not None:
+                    self._entries[name] = in_progress.snapshot
+                    self._entries.move_to_end(name)
+                    while len(self._entries) > self.size:
+                        self._entries.popitem(last=False)
+                        self.stats["evictions"] += 1
+            in_progress.done.set()
+
+        return in_progress.snapshot
+
+    def discard(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, cached=len(self._entries), size=self.size, ttl=self.ttl)
+
+
+def sample(image):
+    """ Raw data sample for Nuvla, from a JPEG frame
+
+    :param image: JPEG bytes
+    :returns data URI, or None if the frame is too big to be sent
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+
+    if Image is not None:
+        try:
+            size = tuple(int(v) for v in sample_size.lower().split("x"))
+            with Image.open(io.BytesIO(image)) as frame:
+                # lets the JPEG decoder skip the detail that would be thrown away anyway
+                frame.draft("RGB", size)
+                frame = frame.convert("RGB")
+                frame.thumbnail(size)
+                downscaled = io.BytesIO()
+                frame.save(downscaled, "JPEG", quality=75)
+                image = downscaled.getvalue()
+        except (OSError, ValueError) as e:
+            log.warning("Cannot downscale the raw data sample: %s", e)
+
+    if len(image) > sample_max_bytes:
+        log.debug("Raw data sample of %d bytes is over the %d bytes limit. Not sent", len(image), sample_max_bytes)
+        return None
+
+    return "data:image/jpeg;base64," + base64.b64encode(image).decode()
+
+
+class SamplePusher(object):
+    """ Sends frames to Nuvla as raw data samples, at most once every interval per streamer """
+
+    def __init__(self, interval=sample_interval):
+        self.interval = interval
+        self._pushed = {}
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def push(self, snapshot):
+        """ Queues the frame as the peripheral's raw data sample, unless one was sent less than interval ago.
+        It's sent by a job on the streamer's key, so it can't overtake an enable or disable of the streamer
+
+        :param snapshot: Snapshot
+        :returns True if queued
+        """
+        if not push_samples:
+            return False
+
+        with self._lock:
+            previous = self._pushed.get(snapshot.name, 0)
+            if snapshot.grabbed - previous < self.interval:
+                return False
+            self._pushed[snapshot.name] = snapshot.grabbed
+
+        try:
+            jobs.queue.submit("push-raw-sample", snapshot.name, self._send, snapshot)
+        except jobs.QueueFull:
+            # not worth waiting for. The next snapshot will do
+            with self._lock:
+                if self._pushed.get(snapshot.name) == snapshot.grabbed:
+                    self._pushed[snapshot.name] = previous
+                self.stats["queue-full"] += 1
+            return False
+
+        return True
+
+    def _send(self, job, snapshot):
+        """ Job sending a frame to Nuvla, if the streamer is still enabled
+
+        :returns job result message
+        """
+        # the streamer might have been disabled, or re-created, since the frame was grabbed
+        streamer = streamers.store.get(snapshot.name)
+        container = docker_client.registry.get(snapshot.name)
+        if not streamer or not streamer.get("id") or not streamer.get("endpoint") or container is None:
+            with self._lock:
+                self.stats["skipped"] += 1
+            return "MJPG streamer {} is not enabled".format(snapshot.name)
+
+        raw_sample = sample(snapshot.image)
+        if raw_sample is None:
+            with self._lock:
+                self.stats["too-big"] += 1
+            return "Raw data sample too big"
+
+        # outbox entries carry the whole peripheral state, so the endpoint and settings go along
+        outbox.outbox.send(streamer["id"], local_data_gateway_endpoint=streamer["endpoint"], raw_sample=raw_sample,
+                           **budget.nuvla_update(container))
+        with self._lock:
+            self.stats["pushed"] += 1
+        return "Raw data sample queued for {}".format(streamer["id"])
+
+    def forget(self, name):
+        with self._lock:
+            self._pushed.pop(name, None)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, interval=self.interval)
+
+
+cache = SnapshotCache()
+pusher = SamplePusher()
+
+
+def on_container_event(action, name, container):
+    """ Registry listener. Frames of a streamer that's gone or re-created are outdated """
+    if name is not None and action in ("create", "destroy", "die"):
+        cache.discard(name)
+        pusher.forget(name)
@@ -0,0 +1,328 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Indexed, atomic store for the host's SSH authorized keys
+
+The authorized_keys file is parsed into an in-memory index, keyed by key type and key blob, and only
+re-parsed when the file changes on disk. Writers are serialized with a file lock, and every write
+goes through a temporary file and an atomic rename, so readers never see a truncated file.
+
+The keys added through the API are recorded as "managed", so that a declarative sync only ever
+removes keys that this service has added itself.
+"""
+
+import base64
+import binascii
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shlex
+import threading
+from contextlib import contextmanager
+from management_api.common import utils
+from management_api import logs
+
+log = logging.getLogger(__name__)
+
+key_type_prefixes = ("ssh-", "ecdsa-sha2-", "sk-ssh-", "sk-ecdsa-sha2-")
+
+
+class AuthorizedKey(object):
+    """ A single public key entry from an authorized_keys file """
+
+    def __init__(self, key_type, blob, options=None, comment=None):
+        self.key_type = key_type
+        self.blob = blob
+        self.options = options
+        self.comment = comment
+
+    @property
+    def index(self):
+        return self.key_type, self.blob
+
+    @property
+    def fingerprint(self):
+        """ SHA256 fingerprint of the key, as shown by ssh-keygen -l """
+        try:
+            blob = base64.b64decode(self.blob)
+        except (binascii.Error, ValueError):
+            blob = self.blob.encode()
+
+        return "SHA256:" + base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip("=")
+
+    def describe(self):
+        """ Short description of the key, without the key itself. For the logs """
+        return " ".join(filter(None, [self.key_type, self.fingerprint, self.comment]))
+
+    def __str__(self):
+        return " ".join(filter(None, [self.options, self.key_type, self.blob, self.comment]))
+
+
+def is_key_type(token):
+    return token.startswith(key_type_prefixes)
+
+
+def parse_key(line):
+    """ Parses an authorized_keys line, which looks like [options] key-type base64-blob [comment]
+
+    :param line: line to be parsed
+    :returns AuthorizedKey, or None if the line is not a public key (i.e. a comment or a blank line)
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+
+    lexer = shlex.shlex(line, posix=False)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        # unbalanced quotes
+        return None
+
+    for i, token in enumerate(tokens[:-1]):
+        if is_key_type(token):
+            options = " ".join(tokens[:i]) or None
+            comment = line.split(tokens[i + 1], 1)[1].strip() or None
+            return AuthorizedKey(token, tokens[i + 1], options=options, comment=comment)
+
+    return None
+
+
+def describe(pubkeys):
+    """ Describes a raw payload with one or more public keys, without the keys themselves. For the logs """
+    descriptions = []
+    for line in split_keys(pubkeys):
+        key = parse_key(line)
+        descriptions.append(key.describe() if key else "invalid key {}".format(logs.fingerprint(line)))
+
+    return ", ".join(descriptions) or "no keys"
+
+
+def split_keys(pubkeys):
+    """ Splits a raw payload with one or more public keys (possibly with escaped new lines) into lines """
+    return [k for k in pubkeys.replace('\\n', '\n').splitlines() if k.strip()]
+
+
+class AuthorizedKeysStore(object):
+    """ In-memory index of an authorized_keys file, with atomic and serialized writes """
+
+    def __init__(self, path, lock_path, managed_path):
+        self.path = path
+        self.lock_path = lock_path
+        self.managed_path = managed_path
+        self._managed = None
+
+        self._lock = threading.RLock()
+        self._signature = None
+        self._lines = []
+        self._index = {}
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        return st.st_mtime_ns, st.st_ino, st.st_size
+
+    def _reload_if_changed(self):
+        """ Re-parses the file if it has changed since the last time it was read """
+        signature = self._file_signature()
+        if signature == self._signature and signature is not None:
+            return
+
+        lines = []
+        if signature is not None:
+            with open(self.path) as ak:
+                lines = ak.read().splitlines()
+
+        index = {}
+        for pos, line in enumerate(lines):
+            key = parse_key(line)
+            if key:
+                index.setdefault(key.index, pos)
+
+        self._lines = lines
+        self._index = index
+        self._signature = signature
+
+    @contextmanager
+    def _write_lock(self):
+        """ Serializes writers, both across threads and across processes """
+        with self._lock:
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._reload_if_changed()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, lines):
+        """ Atomically replaces the authorized keys file with lines """
+        utils.atomic_write(self.path, "\n".join(lines) + "\n" if lines else "")
+
+        self._lines = list(lines)
+        self._signature = self._file_signature()
+
+    def _load_managed(self):
+        """ Loads the set of keys added by this service, as (key type, blob) tuples """
+        if self._managed is None:
+            try:
+                with open(self.managed_path) as m:
+                    self._managed = set(tuple(k.split(" ", 1)) for k in json.load(m))
+            except FileNotFoundError:
+                self._managed = set()
+
+        return self._managed
+
+    def _save_managed(self, managed):
+        utils.atomic_write(self.managed_path, json.dumps(sorted(" ".join(k) for k in managed)))
+        self._managed = managed
+
+    def keys(self):
+        """ Gives back all the public keys currently authorized
+
+        :returns list of AuthorizedKey
+        """
+        with self._lock:
+            self._reload_if_changed()
+            return [parse_key(self._lines[pos]) for pos in sorted(self._index.values())]
+
+    def __contains__(self, pubkey):
+        key = parse_key(pubkey)
+        if not key:
+            return False
+
+        with self._lock:
+            self._reload_if_changed()
+            return key.index in self._index
+
+    @staticmethod
+    def _parse_keys(pubkeys, strict):
+        keys = []
+        for pubkey in pubkeys or []:
+            key = parse_key(pubkey)
+            if key:
+                keys.append(key)
+            elif strict:
+                raise ValueError("Not a valid public SSH key: {}".format(pubkey))
+            else:
+                log.warning("Ignoring invalid public SSH key: %s", logs.truncated(pubkey))
+
+        return keys
+
+    def _apply(self, to_add, revoke):
+        """ Computes and writes the new authorized keys file. Must be called with the write lock held
+
+        :param to_add: list of AuthorizedKey to add, if not yet present
+        :param revoke: set of key indexes to remove
+        :returns (added, removed) lists of AuthorizedKey
+        """
+        removed = []
+        if revoke & set(self._index):
+            lines = []
+            index = {}
+            for line in self._lines:
+                key = parse_key(line)
+                if key and key.index in revoke:
+                    removed.append(key)
+                    continue
+                if key:
+                    index.setdefault(key.index, len(lines))
+                lines.append(line)
+        else:
+            lines = list(self._lines)
+            index = dict(self._index)
+
+        added = []
+        for key in to_add:
+            if key.index in index:
+                continue
+            index[key.index] = len(lines)
+            lines.append(str(key))
+            added.append(key)
+
+        if added or removed:
+            self._write(lines)
+        self._index = index
+
+        return added, removed
+
+    def update(self, add=None, remove=None, managed=True):
+        """ Adds and removes public keys in a single atomic write
+
+        :param add: list of public keys (strings) to add. Keys already present are skipped
+        :param remove: list of public keys (strings) to remove
+        :param managed: whether the added keys should be recorded as managed by this service
+        :returns (added, removed) lists of AuthorizedKey
+        """
+        to_add = self._parse_keys(add, strict=True)
+        revoke = set(k.index for k in self._parse_keys(remove, strict=False))
+
+        with self._write_lock():
+            added, removed = self._apply(to_add, revoke)
+
+            current = self._load_managed()
+            new_managed = (current | set(k.index for k in added)) if managed else set(current)
+            new_managed -= revoke
+            if new_managed != current:
+                self._save_managed(new_managed)
+
+        return added, removed
+
+    def sync(self, desired):
+        """ Makes the managed keys match the desired ones, in a single atomic write.
+        Keys that are not managed by this service are never removed
+
+        :param desired: list of public keys (strings) that should be authorized
+        :returns (added, removed, unchanged) lists of AuthorizedKey
+        """
+        desired_keys = self._parse_keys(desired, strict=True)
+        desired_indexes = set(k.index for k in desired_keys)
+
+        with self._write_lock():
+            current = self._load_managed()
+            revoke = current - desired_indexes
+            added, removed = self._apply(desired_keys, revoke)
+
+            added_indexes = set(k.index for k in added)
+            unchanged = [k for k in desired_keys if k.index not in added_indexes]
+
+            new_managed = (current - revoke) | added_indexes
+            if new_managed != current:
+                self._save_managed(new_managed)
+
+        return added, removed, unchanged
+
+    def add(self, pubkeys, managed=True):
+        """ Adds one or more public keys
+
+        :param pubkeys: raw string with one or more public keys
+        :param managed: whether the keys should be recorded as managed by this service
+        :returns (added, skipped) lists of AuthorizedKey
+        """
+        keys = split_keys(pubkeys)
+        added, _ = self.update(add=keys, managed=managed)
+        added_indexes = set(k.index for k in added)
+
+        return added, [parse_key(k) for k in keys if parse_key(k).index not in added_indexes]
+
+    def remove(self, pubkeys):
+        """ Removes one or more public keys
+
+        :param pubkeys: raw string with one or more public keys
+        :returns list of removed AuthorizedKey
+        """
+        _, removed = self.update(remove=split_keys(pubkeys))
+
+        return removed
+
+
+store = AuthorizedKeysStore("{}/authorized_keys".format(utils.host_ssh_folder),
+                            "{}/.authorized_keys.lock".format(utils.data_volume),
+                            "{}/.managed-ssh-keys".format(utils.data_volume))
@@ -0,0 +1,126 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Startup phases and readiness of the management API
+
+The startup is split between the launcher (app.py), the gunicorn master and the worker(s). Each of them
+records how long its startup phases took. The launcher hands its phases over to gunicorn through the
+environment, so that the worker can report on the whole startup, from the moment the container started.
+
+Liveness and readiness are kept apart: the process is alive as soon as it serves requests, but it's only
+ready once the background services are up and the Docker state has been loaded.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+environment_variable = "MANAGEMENT_API_STARTUP"
+
+
+def process_start_time():
+    """ When the current process was started, according to the kernel. Falls back to now """
+    try:
+        with open("/proc/self/stat") as stat:
+            # the process name can contain spaces, so fields are counted from its end
+            ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            seconds_since_boot = float(uptime.read().split()[0])
+        return time.time() - (seconds_since_boot - ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+_inherited = json.loads(os.getenv(environment_variable) or "{}")
+
+started = float(_inherited.get("started") or process_start_time())
+ready_at = None
+role = "launcher" if not _inherited else "worker"
+
+_phases = list(_inherited.get("phases", []))
+_checks = {}
+_lock = threading.Lock()
+
+
+def set_role(name):
+    """ Names the process the next phases belong to, i.e. launcher, master or worker """
+    global role
+    role = name
+
+
+def record(name, duration):
+    """ Records a startup phase that has already finished
+
+    :param name: name of the phase
+    :param duration: how long it took, in seconds
+    """
+    entry = {"phase": name,
+             "process": role,
+             "pid": os.getpid(),
+             "duration": round(duration, 3),
+             "since-start": round(time.time() - started, 3)}
+    with _lock:
+        _phases.append(entry)
+
+    log.info("Startup phase %s (%s) took %.3fs, %.3fs since start", name, role, duration, entry["since-start"])
+
+
+@contextmanager
+def phase(name):
+    """ Times a startup phase
+
+    :param name: name of the phase
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def environment():
+    """ Environment to pass on to the gunicorn processes, so that they know about the launcher's phases """
+    with _lock:
+        return {environment_variable: json.dumps({"started": started, "phases": _phases})}
+
+
+def set_check(name, ok):
+    """ Sets one of the conditions for readiness. The process is ready once all of them are met
+
+    :param name: name of the condition
+    :param ok: whether it's met
+    """
+    global ready_at
+    with _lock:
+        _checks[name] = bool(ok)
+        if ready_at is None and _checks and all(_checks.values()):
+            ready_at = time.time()
+            log.info("Ready to serve, %.3fs after start", ready_at - started)
+
+
+def require(*names):
+    """ Declares conditions for readiness, not met yet """
+    with _lock:
+        for name in names:
+            _checks.setdefault(name, False)
+
+
+def is_ready():
+    with _lock:
+        return bool(_checks) and all(_checks.values())
+
+
+def report():
+    """ Startup status, for the status endpoint """
+    with _lock:
+        return {"started": started,
+                "uptime": round(time.time() - started, 3),
+                "ready": bool(_checks) and all(_checks.values()),
+                "ready-after": round(ready_at - started, 3) if ready_at else None,
+                "checks": dict(_checks),
+                "phases": list(_phases)}
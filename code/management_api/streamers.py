@@ -0,0 +1,160 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Persistent state of the MJPG streamers managed by this service
+
+Every streamer is recorded with its Nuvla peripheral id, video device, requested and effective resolution
+and fps, endpoint and last known status. The records are kept up to date by the container registry (and with it, by the Docker
+events), and persisted in the data volume, so they are available right after a restart, without
+inspecting any container.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from management_api.common import utils
+from management_api import docker_client
+
+log = logging.getLogger(__name__)
+
+state_file = os.getenv("DATA_SOURCE_MJPG_STATE_FILE", "{}/.data-source-mjpg-streamers.json".format(utils.data_volume))
+
+# attributes that are not worth a write to disk when they are the only change
+volatile_attributes = ("updated",)
+
+
+def streaming_url(name):
+    """ Local data gateway endpoint of a streamer
+
+    :param name: name of the streamer container
+    :returns URL
+    """
+    return 'http://data-gateway/video/{}?action=stream'.format(name)
+
+
+def record_from_container(container):
+    """ Extracts the streamer attributes from the container configuration
+
+    :param container: docker Container object
+    :returns dict
+    """
+    attrs = container.attrs or {}
+    env = dict(var.split("=", 1) for var in (attrs.get("Config") or {}).get("Env") or [] if "=" in var)
+    devices = (attrs.get("HostConfig") or {}).get("Devices") or []
+
+    record = {"name": container.name,
+              "endpoint": streaming_url(container.name),
+              "status": container.status}
+
+    if devices:
+        record["video-device"] = devices[0].get("PathOnHost")
+    # what was asked for, and what the streamer actually runs with, given the host load
+    video_settings = {"resolution": env.get("REQUESTED_RESOLUTION", env.get("RESOLUTION")),
+                      "fps": env.get("REQUESTED_FPS", env.get("FPS")),
+                      "effective-resolution": env.get("RESOLUTION"),
+                      "effective-fps": env.get("FPS")}
+    for key, value in video_settings.items():
+        if value is None:
+            continue
+        if key.endswith("fps"):
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+        record[key] = value
+
+    return record
+
+
+class StreamerStore(object):
+    """ Name-indexed streamer records, persisted as JSON """
+
+    def __init__(self, path=state_file):
+        self.path = path
+
+        self._records = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._records is None:
+            try:
+                with open(self.path) as state:
+                    self._records = {r["name"]: r for r in json.load(state)}
+            except FileNotFoundError:
+                self._records = {}
+            except (ValueError, KeyError, TypeError):
+                log.exception("Discarding corrupted streamer state file %s", self.path)
+                self._records = {}
+
+        return self._records
+
+    def _save(self):
+        try:
+            utils.atomic_write(self.path, json.dumps(sorted(self._records.values(), key=lambda r: r["name"])))
+        except OSError:
+            # the in-memory records are still valid, and will be persisted on the next change
+            log.exception("Could not persist the streamer state to %s", self.path)
+
+    def update(self, name, **attributes):
+        """ Creates or updates the record of a streamer. Attributes set to None are left untouched
+
+        :param name: name of the streamer container
+        :param attributes: streamer attributes (id, video-device, resolution, fps, endpoint, status)
+        :returns the updated record
+        """
+        with self._lock:
+            records = self._load()
+            current = records.get(name, {"name": name})
+            record = dict(current, **{k: v for k, v in attributes.items() if v is not None})
+            record["updated"] = int(time.time())
+
+            changed = {k: v for k, v in record.items() if k not in volatile_attributes} != \
+                      {k: v for k, v in current.items() if k not in volatile_attributes}
+
+            records[name] = record
+            if changed:
+                self._save()
+
+            return dict(record)
+
+    def remove(self, name):
+        """ Forgets about a streamer, i.e. once it has been disabled """
+        with self._lock:
+            if self._load().pop(name, None) is not None:
+                self._save()
+
+    def get(self, name):
+        """ Gives back a copy of the record of a streamer, or None """
+        with self._lock:
+            record = self._load().get(name)
+            return dict(record) if record else None
+
+    def list(self):
+        with self._lock:
+            return [dict(r) for r in sorted(self._load().values(), key=lambda r: r["name"])]
+
+    def on_container_change(self, action, name, container):
+        """ Container registry listener """
+        if action == "refreshed":
+            # the registry has just been (re-)loaded from Docker: whatever it does not know about, is gone
+            known = set(docker_client.registry.names())
+            with self._lock:
+                for missing in set(self._load()) - known:
+                    self.update(missing, status="removed")
+            return
+
+        if container is None:
+            with self._lock:
+                if name in self._load():
+                    self.update(name, status="removed")
+            return
+
+        record = record_from_container(container)
+        record.pop("name")
+        self.update(name, **record)
+
+
+store = StreamerStore()
+docker_client.registry.add_listener(store.on_container_change)
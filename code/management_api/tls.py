@@ -0,0 +1,125 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" TLS context of the mutual TLS listener, with session resumption
+
+Gunicorn builds a new SSL context for every connection it accepts. Each context has its own session cache
+and session ticket keys, so no client can ever resume a TLS session, and every request on a new
+connection pays for a full handshake (with client certificate verification).
+
+Through the gunicorn ssl_context hook, a single context is kept per process instead, and only rebuilt when
+the TLS credentials change on disk. The context is built in the gunicorn master, before the workers are
+forked, so that all the workers share the same session ticket keys.
+"""
+
+import logging
+import os
+import ssl
+import threading
+from collections import Counter
+from management_api import server
+
+log = logging.getLogger(__name__)
+
+# TLS 1.3 session tickets sent after each full handshake. Only supported from Python 3.8
+session_tickets = int(os.getenv("MANAGEMENT_API_TLS_SESSION_TICKETS", 2))
+
+# OpenSSL session statistics, and how they are reported
+session_stats_names = {"accept": "handshakes",
+                       "accept_good": "handshakes-completed",
+                       "hits": "resumed",
+                       "misses": "not-resumed",
+                       "timeouts": "expired",
+                       "cache_full": "cache-full"}
+
+_lock = threading.Lock()
+_context = None
+_signature = None
+# statistics of the contexts replaced after a change of credentials
+_retired_stats = Counter()
+
+
+def credentials_signature(config):
+    """ Identifies the current version of the TLS credentials on disk
+
+    :param config: gunicorn config, with certfile, keyfile and ca_certs
+    :returns tuple
+    """
+    signature = []
+    for path in (config.certfile, config.keyfile, config.ca_certs):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except (OSError, TypeError):
+            signature.append(None)
+
+    return tuple(signature)
+
+
+def set_ecdh_curve(context, curves):
+    """ Restricts the ECDHE key exchange to a single curve, the first of curves that OpenSSL accepts
+
+    :param context: ssl.SSLContext
+    :param curves: colon separated curve names, in order of preference, i.e. X25519:prime256v1
+    :returns the curve, or None if OpenSSL defaults are kept
+    """
+    for curve in filter(None, (c.strip() for c in (curves or "").split(":"))):
+        try:
+            context.set_ecdh_curve(curve)
+            return curve
+        except (ValueError, ssl.SSLError) as e:
+            log.debug("ECDH curve %s not available: %s", curve, e)
+
+    if curves:
+        log.warning("None of the ECDH curves %s is available. Keeping the OpenSSL defaults", curves)
+    return None
+
+
+def tune(context, curves=None):
+    """ Enables session resumption on a server context, and sets its ECDH curve
+
+    :param context: ssl.SSLContext
+    :param curves: ECDH curves, in order of preference. See set_ecdh_curve()
+    :returns the same context
+    """
+    context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(context, "num_tickets"):
+        context.num_tickets = session_tickets
+
+    set_ecdh_curve(context, curves)
+
+    return context
+
+
+def server_context(config, default_ssl_context_factory):
+    """ SSL context for the listener. Built once, and re-built when the credentials change
+
+    :param config: gunicorn config
+    :param default_ssl_context_factory: gunicorn's context factory
+    :returns ssl.SSLContext
+    """
+    global _context, _signature
+
+    signature = credentials_signature(config)
+    if _context is not None and signature == _signature:
+        return _context
+
+    with _lock:
+        if _context is None or signature != _signature:
+            context = tune(default_ssl_context_factory(), server.load_settings()["ecdh_curves"])
+            if _context is not None:
+                log.info("TLS credentials changed. Previous TLS sessions can't be resumed")
+                _retired_stats.update(_context.session_stats())
+            _context, _signature = context, signature
+
+        return _context
+
+
+def get_stats():
+    """ Handshakes and session resumptions, since the process started """
+    with _lock:
+        stats = Counter(_retired_stats)
+        if _context is not None:
+            stats.update(_context.session_stats())
+
+    return {name: stats[key] for key, name in session_stats_names.items()}
@@ -0,0 +1,302 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Inventory of the video devices of the host, and their capabilities
+
+The video devices (/dev/video*) are enumerated once, with the pixel formats, resolutions and frame rates
+each of them can capture. From then on, the devices folder is watched with inotify (or polled, when inotify
+is not available), and only the devices that appear, change or disappear are queried again.
+
+MJPG streamer requests are validated against the inventory, so that a request for a device that does not
+exist, can't capture video, or doesn't support the resolution is turned down before any Docker work.
+If no video device is visible at all (i.e. /dev is not mounted in the container), requests are not checked.
+
+The host's /dev is mounted somewhere else than the container's own /dev (VIDEO_DEVICES_FOLDER, i.e.
+/hostfs/dev), so the devices are read from there. They are still reported, and requested, by their
+path on the host, which is what the MJPG streamers are given.
+"""
+
+import logging
+import os
+import re
+import threading
+from management_api.common import inotify, v4l2
+
+log = logging.getLogger(__name__)
+
+devices_folder = os.getenv("VIDEO_DEVICES_FOLDER", "/dev")
+# where the devices are on the host
+host_devices_folder = "/dev"
+poll_interval = float(os.getenv("VIDEO_DEVICES_POLL_INTERVAL", 10))
+# whether the MJPG streamer requests are checked against the inventory
+validation = os.getenv("VIDEO_DEVICE_VALIDATION", "true").strip().lower() in ("1", "true", "yes", "on")
+
+device_name = re.compile(r"^video\d+$")
+
+# named resolutions, as input_uvc (mjpg-streamer) defines them
+named_resolutions = {"QSIF": "160x120",
+                     "QCIF": "176x144",
+                     "CGA": "320x200",
+                     "QVGA": "320x240",
+                     "CIF": "352x288",
+                     "PAL": "720x576",
+                     "VGA": "640x480",
+                     "SVGA": "800x600",
+                     "XGA": "1024x768",
+                     "HD": "1280x720",
+                     "SXGA": "1280x1024",
+                     "UXGA": "1600x1200",
+                     "FHD": "1920x1280"}
+
+# udev creates the node first, and then sets its owner and permissions
+watch_mask = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_ATTRIB | inotify.IN_MOVED_TO | \
+             inotify.IN_MOVED_FROM
+
+
+class InvalidVideoDevice(Exception):
+    """ Raised when a video device can't be used for the requested stream """
+
+
+def normalize_resolution(resolution):
+    """ Resolution as WxH, also when given by name, like VGA
+
+    :param resolution: WxH, or a resolution name known to input_uvc
+    :returns str, or resolution as is, if it's not recognized
+    """
+    if not resolution:
+        return resolution
+
+    return named_resolutions.get(resolution.strip().upper(), resolution.strip().lower())
+
+
+def probe(path):
+    """ Queries the capabilities of a video device
+
+    :param path: device node
+    :returns dict with the device, its driver, card, bus-info, whether it can capture video, and the formats
+    it supports, with their resolutions and frame rates. If the device can't be queried, the reason is in error
+    """
+    device = {"video-device": path, "capture": None, "formats": [], "error": None}
+    try:
+        with v4l2.VideoDevice(path) as video:
+            device.update(video.capability())
+            if not device["capture"]:
+                return device
+
+            for pixel_format, description in video.formats():
+                resolutions = {}
+                ranges = []
+                for size in video.frame_sizes(pixel_format):
+                    if len(size) == 2:
+                        resolutions["{}x{}".format(*size)] = video.frame_rates(pixel_format, *size)
+                    else:
+                        ranges.append({"min-width": size[0], "max-width": size[1],
+                                       "min-height": size[2], "max-height": size[3]})
+
+                device["formats"].append({"format": v4l2.fourcc(pixel_format),
+                                          "description": description,
+                                          "resolutions": resolutions,
+                                          "ranges": ranges})
+    except OSError as e:
+        device["error"] = e.strerror or str(e)
+
+    return device
+
+
+def _device_id(path):
+    """ Identifies one instance of a device node, to tell whether it has been replaced """
+    try:
+        st = os.stat(path)
+        return st.st_rdev, st.st_ino, st.st_mode, st.st_uid, st.st_gid
+    except OSError:
+        return None
+
+
+class VideoDeviceInventory(object):
+    """ Video devices of the host, kept up to date incrementally """
+
+    def __init__(self, folder=devices_folder):
+        self.folder = folder
+        self.mode = None
+        self._devices = {}
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"scans": 0, "probes": 0}
+
+    def _names(self):
+        try:
+            return set(name for name in os.listdir(self.folder) if device_name.match(name))
+        except OSError:
+            return set()
+
+    def refresh(self, name):
+        """ Queries one device again, or drops it if it's gone
+
+        :param name: device name, like video0
+        """
+        path = os.path.join(self.folder, name)
+        device_id = _device_id(path)
+        if device_id is None:
+            with self._lock:
+                if self._devices.pop(path, None) is not None:
+                    log.info("Video device %s removed", path)
+                self._ids.pop(path, None)
+            return
+
+        with self._lock:
+            if self._ids.get(path) == device_id:
+                return
+
+        device = dict(probe(path), **{"video-device": os.path.join(host_devices_folder, name)})
+        with self._lock:
+            added = path not in self._devices
+            self._devices[path] = device
+            self._ids[path] = device_id
+            self.stats["probes"] += 1
+
+        if added:
+            log.info("Video device %s added: %s", path, device.get("card") or device["error"])
+
+    def scan(self):
+        """ Brings the whole inventory up to date. Only the new and changed devices are queried """
+        names = self._names()
+        with self._lock:
+            known = set(os.path.basename(path) for path in self._devices)
+            self.stats["scans"] += 1
+
+        for name in names | known:
+            self.refresh(name)
+
+        self._synced.set()
+
+    def _watch(self):
+        with inotify.Inotify() as notifier:
+            notifier.add_watch(self.folder, watch_mask | inotify.IN_ONLYDIR)
+            self.mode = "inotify"
+            # after adding the watch, so that nothing is missed in between
+            self.scan()
+            while not self._stop.is_set():
+                names = set(name for _, _, _, name in notifier.read(poll_interval) if device_name.match(name))
+                for name in names:
+                    self.refresh(name)
+
+    def _run(self):
+        if inotify.available() and os.path.isdir(self.folder):
+            try:
+                self._watch()
+                return
+            except OSError as e:
+                log.warning("Cannot watch %s for video devices (%s). Polling instead", self.folder, e)
+
+        self.mode = "polling"
+        while True:
+            try:
+                self.scan()
+            except Exception:
+                log.exception("Could not scan the video devices")
+            if self._stop.wait(poll_interval):
+                return
+
+    def start(self):
+        """ Starts following the video devices, if not yet started """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="video-devices")
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def list(self):
+        """ :returns list of devices, sorted by path """
+        if not self._synced.is_set():
+            self.scan()
+
+        with self._lock:
+            return [self._devices[path] for path in sorted(self._devices)]
+
+    def _local_path(self, path):
+        """ Where a device of the host, given by its path on the host, is found in the container """
+        relative = os.path.relpath(path, host_devices_folder)
+        if relative.startswith(os.pardir):
+            return path
+
+        return os.path.join(self.folder, relative)
+
+    def get(self, path):
+        """ The device at path, following symlinks like /dev/v4l/by-id/...
+
+        :param path: path of the device on the host
+        :returns device dict, or None if there's no such video device
+        """
+        if not self._synced.is_set():
+            self.scan()
+
+        name = os.path.basename(os.path.realpath(self._local_path(path)))
+        path = os.path.join(self.folder, name)
+        with self._lock:
+            device = self._devices.get(path)
+
+        if device is None and device_name.match(name):
+            # it might have just been plugged in, and the event not processed yet
+            self.refresh(name)
+            with self._lock:
+                device = self._devices.get(path)
+
+        return device
+
+    def resolutions(self, path):
+        """ Resolutions the device can capture, in any format
+
+        :returns list of WxH, largest first, or None if unknown (device can't be queried, or supports ranges)
+        """
+        device = self.get(path)
+        if not device or device["error"] or not device["formats"] or any(f["ranges"] for f in device["formats"]):
+            return None
+
+        resolutions = set(resolution for f in device["formats"] for resolution in f["resolutions"])
+        return sorted(resolutions, key=lambda r: [int(v) for v in r.split("x")], reverse=True)
+
+    def validate(self, path, resolution=None):
+        """ Checks that a video device can be streamed at resolution
+
+        :param path: device node
+        :param resolution: requested resolution, like WxH. Not checked if None
+        :raises InvalidVideoDevice
+        """
+        if not validation:
+            return
+
+        device = self.get(path)
+        if device is None:
+            if not self._names():
+                # the video devices are not visible from here. Docker will tell, when starting the streamer
+                log.debug("No video devices in %s. Not checking %s", self.folder, path)
+                return
+            raise InvalidVideoDevice("Video device {} does not exist".format(path))
+
+        if device["error"]:
+            # i.e. busy or not accessible to us. Docker might still manage to use it
+            log.debug("Cannot check video device %s: %s", path, device["error"])
+            return
+
+        if not device["capture"]:
+            raise InvalidVideoDevice("Video device {} ({}) cannot capture video".format(path, device.get("card")))
+
+        supported = self.resolutions(path)
+        if resolution and supported and normalize_resolution(resolution) not in supported:
+            raise InvalidVideoDevice("Video device {} does not support resolution {}. Supported resolutions: {}"
+                                     .format(path, resolution, ", ".join(supported)))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, devices=len(self._devices), mode=self.mode)
+
+
+inventory = VideoDeviceInventory()
@@ -1,4 +1,6 @@
-from app import app
+from app import app, start_background_services
 
 if __name__ == "__main__":
+    # under gunicorn, the background services are started by the post_fork hook
+    start_background_services()
     app.run(host="0.0.0.0", port=5001)
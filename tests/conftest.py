@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+""" Unit tests of the pure logic of the management API. None of them needs Docker or Nuvla """
+
+import os
+import sys
+
+code_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code")
+sys.path.insert(0, code_folder)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import pytest
+from management_api import admission
+
+
+def controller(limit=1, queue=1, timeout=0.2, capacity=4):
+    return admission.AdmissionController([admission.Lane("lane", limit, queue, timeout)], capacity)
+
+
+def test_admits_up_to_the_limit_and_releases():
+    lanes = controller(limit=2)
+    tickets = [lanes.acquire("lane"), lanes.acquire("lane")]
+    assert lanes.get_stats()["lanes"]["lane"]["in-flight"] == 2
+
+    for ticket in tickets:
+        ticket.release()
+        # releasing twice is harmless
+        ticket.release()
+
+    stats = lanes.get_stats()
+    assert stats["used"] == 0
+    assert stats["lanes"]["lane"]["in-flight"] == 0
+    assert stats["lanes"]["lane"]["admitted"] == 2
+
+
+def test_queue_full_is_a_429():
+    lanes = controller(limit=1, queue=0)
+    lanes.acquire("lane")
+
+    with pytest.raises(admission.Rejected) as rejected:
+        lanes.acquire("lane")
+
+    assert rejected.value.status == 429
+    assert rejected.value.reason == "queue-full"
+    assert rejected.value.retry_after >= 1
+
+
+def test_waiting_too_long_is_a_503():
+    lanes = controller(limit=1, queue=1, timeout=0.05)
+    lanes.acquire("lane")
+
+    with pytest.raises(admission.Rejected) as rejected:
+        lanes.acquire("lane")
+
+    assert (rejected.value.status, rejected.value.reason) == (503, "timeout")
+    # the request that timed out doesn't hold a thread anymore
+    assert lanes.get_stats()["used"] == 1
+
+
+def test_no_capacity_left_is_a_503():
+    lanes = admission.AdmissionController([admission.Lane("a", 2, 2, 1), admission.Lane("b", 2, 2, 1)], 2)
+    lanes.acquire("a")
+    lanes.acquire("a")
+
+    with pytest.raises(admission.Rejected) as rejected:
+        lanes.acquire("b")
+
+    assert (rejected.value.status, rejected.value.reason) == (503, "busy")
+
+
+def test_queued_request_is_admitted_on_release():
+    lanes = controller(limit=1, queue=1, timeout=5)
+    first = lanes.acquire("lane")
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(lanes.acquire("lane")))
+    waiter.start()
+    deadline = time.time() + 5
+    while lanes.get_stats()["lanes"]["lane"]["waiting"] != 1:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    first.release()
+    waiter.join(5)
+
+    assert len(admitted) == 1
+    assert lanes.get_stats()["lanes"]["lane"]["queued"] == 1
+
+
+def test_lane_limits_from_environment(monkeypatch):
+    monkeypatch.setenv("ADMISSION_DATA_SOURCE_MJPG_LIMIT", "7")
+    lane = admission.Lane.from_environment("data-source-mjpg", 2, 4, 5)
+
+    assert (lane.limit, lane.queue, lane.timeout) == (7, 4, 5)
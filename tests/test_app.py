@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+import app as management_api
+from management_api import ssh_keys
+
+KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIKMT0uCYnPkO4fG3oJ5uWcl5ctIyl3WYa8H2kTWLs9Xi user@host"
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    store = ssh_keys.AuthorizedKeysStore(str(tmp_path / "authorized_keys"), str(tmp_path / ".lock"),
+                                         str(tmp_path / ".managed"))
+    store.add(KEY)
+    monkeypatch.setattr(ssh_keys, "store", store)
+    return store
+
+
+@pytest.fixture
+def client():
+    return management_api.app.test_client()
+
+
+@pytest.mark.parametrize("body", [b"", b"  \n", b"{}", b"[]", b"# no keys\n", b"\xff\xfe not utf-8",
+                                  b'{"keys": "ssh-ed25519 AAAA"}'])
+def test_sync_ssh_keys_rejects_payloads_without_keys(store, client, body):
+    response = client.post("/api/ssh-keys/sync", data=body)
+
+    assert response.status_code == 400
+    assert KEY in store
+
+
+def test_sync_ssh_keys_removes_all_managed_keys_only_when_explicit(store, client):
+    response = client.post("/api/ssh-keys/sync", data=json.dumps({"keys": []}))
+
+    assert response.status_code == 200
+    assert response.get_json()["removed"] == [KEY]
+    assert KEY not in store
+
+
+def test_sync_ssh_keys_from_raw_keys(store, client):
+    other = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC7 other@host"
+    response = client.post("/api/ssh-keys/sync", data=other + "\n" + KEY)
+
+    assert response.status_code == 200
+    assert response.get_json()["added"] == [other]
+    assert response.get_json()["unchanged"] == [KEY]
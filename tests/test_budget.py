@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from management_api import budget
+
+
+@pytest.fixture(autouse=True)
+def defaults(monkeypatch):
+    monkeypatch.setattr(budget, "min_resolution", "320x240")
+    monkeypatch.setattr(budget, "min_fps", 5)
+    monkeypatch.setattr(budget, "cpu_budget", 2.0)
+    monkeypatch.setattr(budget, "memory_budget", 512 * 2 ** 20)
+    monkeypatch.setattr(budget, "min_memory", 32 * 2 ** 20)
+    monkeypatch.setattr(budget, "max_memory", 256 * 2 ** 20)
+
+
+@pytest.mark.parametrize("value, size", [("512", 512), ("1k", 1024), ("32m", 32 * 2 ** 20), ("1.5g", 3 * 2 ** 29),
+                                         ("64MB", 64 * 2 ** 20), ("", None), (None, None)])
+def test_parse_size(value, size):
+    assert budget.parse_size(value) == size
+
+
+def test_pixels():
+    assert budget.pixels("1280x720") == 1280 * 720
+    # input_uvc resolution names
+    assert budget.pixels("VGA") == 640 * 480
+    assert budget.pixels("nonsense") == 0
+
+
+def test_no_step_down_at_level_0():
+    assert budget.step_down("1280x720", "30", 0) == ("1280x720", 30)
+
+
+def test_step_down_lowers_fps_first_then_alternates():
+    assert budget.step_down("1280x720", 30, 1) == ("1280x720", 25)
+    assert budget.step_down("1280x720", 30, 2) == ("960x540", 25)
+    assert budget.step_down("1280x720", 30, 3) == ("960x540", 20)
+    assert budget.step_down("1280x720", 30, 4) == ("640x480", 20)
+
+
+def test_step_down_stops_at_the_minimum():
+    assert budget.step_down("1920x1080", 30, budget.max_level) == ("320x240", 5)
+    assert budget.step_down("1920x1080", 30, budget.max_level + 10) == ("320x240", 5)
+
+
+def test_step_down_keeps_going_on_the_other_setting_at_its_minimum():
+    # fps is already at the minimum, so the resolution goes down at every notch
+    assert budget.step_down("1280x720", 5, 2) == ("640x480", 5)
+
+
+def test_settings_below_the_minimum_are_not_raised():
+    assert budget.step_down("160x120", 2, 5) == ("160x120", 2)
+
+
+def test_step_down_only_picks_supported_resolutions():
+    supported = ["1280x720", "800x600", "352x288"]
+    assert budget.step_down("1280x720", 5, 1, supported) == ("800x600", 5)
+    assert budget.step_down("1280x720", 5, 2, supported) == ("352x288", 5)
+    # nothing supported between 352x288 and the minimum
+    assert budget.step_down("1280x720", 5, 5, supported) == ("352x288", 5)
+
+
+def test_effective_is_unchanged_when_not_adaptive(monkeypatch):
+    monkeypatch.setattr(budget, "adaptive", False)
+    policy = budget.AdaptivePolicy(sampler=object())
+    policy.level = 5
+
+    assert policy.effective("1280x720", "15") == ("1280x720", 15)
+
+
+def test_container_limits_split_the_budget():
+    limits = budget.container_limits(4)
+
+    assert limits["cpu_period"] == budget.cpu_period
+    assert limits["cpu_quota"] == int(0.5 * budget.cpu_period)
+    assert limits["mem_limit"] == 128 * 2 ** 20
+    # no swap on top of the memory limit
+    assert limits["memswap_limit"] == limits["mem_limit"]
+
+
+def test_container_limits_are_bounded():
+    assert budget.container_limits(0) == budget.container_limits(1)
+    assert budget.container_limits(1)["mem_limit"] == budget.max_memory
+    assert budget.container_limits(100)["mem_limit"] == budget.min_memory
+    assert budget.container_limits(1000)["cpu_quota"] == 1000
+
+
+def test_policy_steps_down_after_consecutive_overloaded_samples(monkeypatch):
+    monkeypatch.setattr(budget, "adaptive", True)
+    monkeypatch.setattr(budget, "samples_down", 2)
+    monkeypatch.setattr(budget, "samples_up", 2)
+    monkeypatch.setattr(budget.docker_client.registry, "names", lambda: ["streamer"])
+    policy = budget.AdaptivePolicy(sampler=object())
+
+    overloaded = {"cpu": 0.95, "memory-available": 0.5}
+    idle = {"cpu": 0.1, "memory-available": 0.5}
+    assert not policy.observe(overloaded)
+    assert policy.observe(overloaded)
+    assert policy.level == 1
+    assert policy.effective("1280x720", 30) == ("1280x720", 25)
+
+    # a sample in between resets the count
+    assert not policy.observe(idle)
+    assert not policy.observe({"cpu": 0.7, "memory-available": 0.5})
+    assert not policy.observe(idle)
+    assert policy.observe(idle)
+    assert policy.level == 0
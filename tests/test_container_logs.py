@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from management_api import container_logs
+
+
+class Container(object):
+    """ Hands out its logs in chunks, and keeps the arguments Docker was asked for """
+
+    def __init__(self, *chunks):
+        self.chunks = chunks
+        self.kwargs = None
+
+    def logs(self, **kwargs):
+        self.kwargs = kwargs
+        return iter(self.chunks)
+
+
+def test_bounded_logs_are_not_followed():
+    container = Container(b"line 1\n", b"line 2\n")
+
+    assert container_logs.bounded_logs(container, tail=10) == "line 1\nline 2\n"
+    # docker-py would follow a stream until the container stops, if not told otherwise
+    assert container.kwargs == {"stream": True, "follow": False, "tail": 10}
+
+
+def test_bounded_logs_keep_the_last_bytes():
+    container = Container(b"first line\n", b"second line\n", b"third line\n")
+
+    assert container_logs.bounded_logs(container, limit=20) == "[...]\nthird line\n"
+
+
+def test_server_sent_events():
+    events = list(container_logs.server_sent_events([b"one\r\ntw", b"o\nthree"]))
+
+    assert events == [b"data: one\n\n", b"data: two\n\n", b"data: three\n\n", b"event: end\ndata: \n\n"]
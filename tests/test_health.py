@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import http.client
+import json
+import socket
+import pytest
+from management_api import health
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(UnixConnection, self).__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+@pytest.fixture
+def live(monkeypatch, tmp_path):
+    pool = health.WorkerPool(capacity=2, stall_timeout=60)
+    monkeypatch.setattr(health, "worker_pool", pool)
+    server = health.serve(str(tmp_path / "health.sock"))
+
+    def get():
+        connection = UnixConnection(server.server_address)
+        connection.request("GET", "/api/live")
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    yield pool, get
+    server.shutdown()
+    server.server_close()
+
+
+def test_live_while_requests_complete(live):
+    pool, get = live
+
+    assert get() == (200, {"status": 200, "message": "alive"})
+    pool.started()
+    pool.started()
+    # all the threads are busy, but not for long
+    assert get()[0] == 200
+
+
+def test_not_live_when_all_request_threads_are_stuck(live, monkeypatch):
+    pool, get = live
+    now = [1000.0]
+    monkeypatch.setattr(health.time, "monotonic", lambda: now[0])
+
+    pool.started()
+    pool.started()
+    now[0] += 61
+
+    status, report = get()
+    assert status == 503
+    assert report["message"] == "all 2 request threads busy, no request completed for 61s"
+
+    pool.finished()
+    assert get()[0] == 200
+
+
+def test_idle_time_does_not_count(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(health.time, "monotonic", lambda: now[0])
+    pool = health.WorkerPool(capacity=1, stall_timeout=60)
+
+    now[0] += 3600
+    pool.started()
+    assert pool.stalled() is None
+
+    now[0] += 60
+    assert pool.stalled() == 60
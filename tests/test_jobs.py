@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import pytest
+from management_api import jobs
+
+
+def wait_for(queue, timeout=5):
+    """ Waits until all the jobs are done. Their keys are released right after their state is set """
+    deadline = time.time() + timeout
+    while queue.depth():
+        assert time.time() < deadline, "jobs did not finish in time"
+        time.sleep(0.01)
+
+
+def recording_job(events, name, delay=0.05):
+    def run(job):
+        events.append(("start", name))
+        time.sleep(delay)
+        events.append(("end", name))
+        return name
+    return run
+
+
+def test_same_key_jobs_run_one_after_the_other_in_order():
+    queue = jobs.JobQueue(workers=4)
+    events = []
+    submitted = [queue.submit("action", "streamer", recording_job(events, i)) for i in range(3)]
+    wait_for(queue)
+
+    assert events == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    assert [job.state for job in submitted] == [jobs.SUCCESS] * 3
+
+
+def test_different_keys_run_in_parallel():
+    queue = jobs.JobQueue(workers=2)
+    both_running = threading.Barrier(2, timeout=5)
+
+    def run(job):
+        both_running.wait()
+
+    submitted = [queue.submit("action", key, run) for key in ("a", "b")]
+    wait_for(queue)
+
+    assert [job.state for job in submitted] == [jobs.SUCCESS] * 2
+
+
+def test_multi_key_job_waits_for_all_its_keys_and_is_not_overtaken():
+    queue = jobs.JobQueue(workers=4)
+    events = []
+    first = queue.submit("action", "a", recording_job(events, "a"))
+    batch = queue.submit("batch", ["a", "b"], recording_job(events, "batch"))
+    # shares b with the waiting batch, so it must not overtake it
+    last = queue.submit("action", "b", recording_job(events, "b"))
+
+    assert queue.busy("a") and queue.busy("b")
+    wait_for(queue)
+
+    assert events == [("start", "a"), ("end", "a"), ("start", "batch"), ("end", "batch"),
+                      ("start", "b"), ("end", "b")]
+    assert not queue.busy("a") and not queue.busy("b")
+
+
+def test_failed_job_releases_its_key():
+    queue = jobs.JobQueue(workers=1)
+
+    def fail(job):
+        raise ValueError("boom")
+
+    failed = queue.submit("action", "a", fail)
+    succeeded = queue.submit("action", "a", lambda job: "ok")
+    wait_for(queue)
+
+    assert failed.state == jobs.FAILED and failed.error["message"] == "boom"
+    assert succeeded.state == jobs.SUCCESS and succeeded.result == "ok"
+
+
+def test_queue_full():
+    queue = jobs.JobQueue(workers=1, max_pending=1)
+    release = threading.Event()
+    running = queue.submit("action", "a", lambda job: release.wait(5))
+
+    with pytest.raises(jobs.QueueFull):
+        queue.submit("action", "b", lambda job: None)
+
+    release.set()
+    wait_for(queue)
+    assert running.state == jobs.SUCCESS
+
+
+def test_finished_jobs_are_forgotten_beyond_the_limit():
+    queue = jobs.JobQueue(workers=1, max_finished=2)
+    submitted = [queue.submit("action", "a", lambda job: None) for _ in range(3)]
+    wait_for(queue)
+
+    assert queue.get(submitted[0].id) is None
+    assert queue.get(submitted[2].id) is submitted[2]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+import requests
+from nuvla.api.api import NuvlaError
+from management_api import Manage, outbox
+
+
+def nuvla_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return NuvlaError("HTTP {}".format(status_code), response)
+
+
+@pytest.fixture
+def box(tmp_path):
+    # long debounce, so the flusher thread leaves the deliveries to the tests
+    return outbox.Outbox(path=str(tmp_path / "outbox.json"), debounce=60)
+
+
+class Deliveries(list):
+    """ Updates sent to Nuvla. Those of the peripherals in failures fail with the given error """
+
+    def __init__(self):
+        super(Deliveries, self).__init__()
+        self.failures = {}
+
+
+@pytest.fixture
+def delivered(monkeypatch):
+    calls = Deliveries()
+
+    def update_peripheral_resource(peripheral_id, **update):
+        calls.append((peripheral_id, update))
+        failure = calls.failures.get(peripheral_id)
+        if failure is not None:
+            raise failure
+
+    monkeypatch.setattr(Manage, "update_peripheral_resource", update_peripheral_resource)
+    return calls
+
+
+@pytest.mark.parametrize("status_code, retry", [(None, True), (500, True), (502, True), (503, True),
+                                                (401, True), (408, True), (429, True),
+                                                (400, False), (403, False), (404, False), (409, False),
+                                                (422, False)])
+def test_retryable(status_code, retry):
+    assert outbox.retryable(status_code) is retry
+
+
+def test_updates_of_the_same_peripheral_are_coalesced(box, delivered):
+    box.send("nuvlabox-peripheral/a", data_gateway_enabled=False)
+    first = box.pending()[0]
+    box.send("nuvlabox-peripheral/a", local_data_gateway_endpoint="http://data-gateway/video/a")
+    box.send("nuvlabox-peripheral/b", data_gateway_enabled=False)
+
+    pending = {e["id"]: e for e in box.pending()}
+    assert len(pending) == 2
+    # the last update wins, and the delivery time is not postponed
+    assert pending["nuvlabox-peripheral/a"]["update"] == {"local_data_gateway_endpoint": "http://data-gateway/video/a"}
+    assert pending["nuvlabox-peripheral/a"]["next-attempt"] == first["next-attempt"]
+    assert box.get_stats()["coalesced"] == 1
+
+    assert box.flush(force=True) == 2
+    assert delivered == [("nuvlabox-peripheral/a", {"local_data_gateway_endpoint": "http://data-gateway/video/a"}),
+                         ("nuvlabox-peripheral/b", {"data_gateway_enabled": False})]
+    assert box.depth() == 0
+
+
+def test_updates_are_persisted(box, tmp_path):
+    box.send("nuvlabox-peripheral/a", data_gateway_enabled=False)
+
+    reloaded = outbox.Outbox(path=str(tmp_path / "outbox.json"), debounce=60)
+    assert [e["id"] for e in reloaded.pending()] == ["nuvlabox-peripheral/a"]
+    with open(str(tmp_path / "outbox.json")) as persisted:
+        assert json.load(persisted)[0]["update"] == {"data_gateway_enabled": False}
+
+
+def test_server_errors_are_retried_with_backoff(box, delivered):
+    delivered.failures["nuvlabox-peripheral/a"] = nuvla_error(503)
+    box.send("nuvlabox-peripheral/a", data_gateway_enabled=False)
+
+    assert box.flush(force=True) == 0
+    entry = box.pending()[0]
+    assert entry["attempts"] == 1
+    assert box.get_stats()["rejected"] == 0
+
+    del delivered.failures["nuvlabox-peripheral/a"]
+    assert box.flush(force=True) == 1
+    assert box.depth() == 0
+    assert box.get_stats()["retries"] == 1
+
+
+def test_connection_errors_are_retried(box, delivered):
+    delivered.failures["nuvlabox-peripheral/a"] = requests.ConnectionError("unreachable")
+    box.send("nuvlabox-peripheral/a", data_gateway_enabled=False)
+
+    box.flush(force=True)
+    assert box.pending()[0]["attempts"] == 1
+
+
+@pytest.mark.parametrize("status_code", [400, 404, 422])
+def test_rejected_updates_are_dropped(box, delivered, status_code):
+    delivered.failures["nuvlabox-peripheral/a"] = nuvla_error(status_code)
+    box.send("nuvlabox-peripheral/a", data_gateway_enabled=False)
+    box.send("nuvlabox-peripheral/b", data_gateway_enabled=False)
+
+    assert box.flush(force=True) == 1
+    assert box.depth() == 0
+    assert box.get_stats()["rejected"] == 1
+
+    # later updates of the same peripheral are not held back
+    del delivered.failures["nuvlabox-peripheral/a"]
+    box.send("nuvlabox-peripheral/a", data_gateway_enabled=True)
+    assert box.flush(force=True) == 1
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from management_api import docker_client, jobs, reconciler, streamers
+
+STREAMER = {"id": "nuvlabox-peripheral/camera", "video-device": "/dev/video0", "resolution": "640x480", "fps": 10}
+
+
+@pytest.fixture
+def world(monkeypatch):
+    """ Streamer records, and the containers that exist """
+    records = {}
+    containers = {}
+    monkeypatch.setattr(docker_client.registry, "start", lambda: None)
+    monkeypatch.setattr(docker_client.registry, "synced", True)
+    monkeypatch.setattr(docker_client.registry, "get", containers.get)
+    monkeypatch.setattr(streamers.store, "list", lambda: [dict(r, name=n) for n, r in sorted(records.items())])
+    monkeypatch.setattr(reconciler, "needs_new_settings", lambda container, streamer: False)
+    monkeypatch.setattr(jobs, "queue", jobs.JobQueue(workers=1))
+    return records, containers
+
+
+def test_missing_streamers_are_repaired(world, monkeypatch):
+    records, containers = world
+    records["camera"] = dict(STREAMER)
+    records["running"] = dict(STREAMER)
+    containers["running"] = object()
+    monkeypatch.setattr(reconciler, "repair_data_source_mjpg_job", lambda job, name: "repaired")
+
+    submitted = reconciler.Reconciler().run_once()
+
+    assert [job.key for job in submitted] == ["camera"]
+
+
+def test_orphans_are_reported_once_and_left_alone(world, caplog):
+    records, containers = world
+    # a container from before an upgrade: no Nuvla peripheral id
+    records["legacy"] = {k: v for k, v in STREAMER.items() if k != "id"}
+    containers["legacy"] = object()
+    # a stale record, without a container, is not an orphan
+    records["gone"] = {"video-device": "/dev/video1"}
+    r = reconciler.Reconciler()
+
+    assert r.run_once() == []
+    assert r.run_once() == []
+
+    assert r.orphans() == ["legacy"]
+    assert r.get_stats()["orphans-found"] == 1
+    assert [m for m in caplog.messages if "not managed" in m] == \
+        ["Data source container legacy is not managed by this service (no id). Leaving it alone"]
+
+    # adopted by an enable request
+    records["legacy"]["id"] = STREAMER["id"]
+    r.run_once()
+    assert r.orphans() == []
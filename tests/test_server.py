@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import types
+import pytest
+from management_api import gunicorn_hooks, server
+
+
+def command(**settings):
+    return server.gunicorn_command(dict(server.default_settings(), **settings), "key.pem", "cert.pem", "ca.pem")
+
+
+def test_settings_precedence(tmp_path):
+    config = tmp_path / "management-api.conf"
+    config.write_text("# tuned for this box\nMANAGEMENT_API_THREADS=3\nMANAGEMENT_API_KEEPALIVE='5'\n")
+
+    settings = server.load_settings(str(config), {"MANAGEMENT_API_THREADS": "6", "MANAGEMENT_API_RELOAD": "yes",
+                                                  "MANAGEMENT_API_BACKLOG": "lots"})
+
+    assert (settings["threads"], settings["keepalive"], settings["reload"]) == (6, 5, True)
+    assert settings["backlog"] == server.default_settings()["backlog"]
+
+
+@pytest.mark.parametrize("worker_class", ["eventlet", "tornado", "gevent"])
+def test_unsupported_worker_classes_fall_back_to_gthread(tmp_path, monkeypatch, worker_class):
+    # gevent is supported, but not installed here
+    monkeypatch.setattr(server.importlib.util, "find_spec", lambda name: None)
+
+    settings = server.load_settings(str(tmp_path / "none"), {"MANAGEMENT_API_WORKER_CLASS": worker_class})
+
+    assert settings["worker_class"] == "gthread"
+
+
+def test_threaded_workers_preload_the_app():
+    cmd = command(threads=8)
+
+    assert "--preload" in cmd
+    assert "--threads=8" in cmd
+    assert cmd[-1] == "wsgi:app"
+
+
+def test_evented_workers_load_the_app_after_patching():
+    cmd = command(worker_class="gevent", worker_connections=50)
+
+    assert "--preload" not in cmd
+    assert "--worker-class=gevent" in cmd
+    assert "--worker-connections=50" in cmd
+
+
+@pytest.mark.parametrize("worker_class, started_by", [("gthread", "post_fork"), ("sync", "post_fork"),
+                                                      ("gevent", "post_worker_init")])
+def test_background_services_are_started_once_the_worker_is_ready(monkeypatch, worker_class, started_by):
+    started = []
+    monkeypatch.setattr(gunicorn_hooks, "start_worker", lambda: started.append(True))
+    worker = types.SimpleNamespace(cfg=types.SimpleNamespace(worker_class_str=worker_class))
+
+    gunicorn_hooks.post_fork(None, worker)
+    assert started == ([True] if started_by == "post_fork" else [])
+
+    gunicorn_hooks.post_worker_init(worker)
+    assert started == [True]
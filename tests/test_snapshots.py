@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import io
+import threading
+import time
+import types
+import pytest
+from management_api import snapshots
+
+JPEG = b"\xff\xd8frame\xff\xd9"
+
+
+class Grabber(object):
+    """ Grabs JPEG frames without any streamer, counting the grabs. It blocks until released, if asked """
+
+    def __init__(self, block=False, error=None):
+        self.grabs = []
+        self.error = error
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, name):
+        self.grabs.append(name)
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return JPEG + name.encode()
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_concurrent_requests_share_a_single_grab():
+    grabber = Grabber(block=True)
+    cache = snapshots.SnapshotCache(size=4, ttl=60, grabber=grabber)
+    results = []
+    clients = [threading.Thread(target=lambda: results.append(cache.get("streamer"))) for _ in range(5)]
+    for client in clients:
+        client.start()
+
+    grabber.started.wait(5)
+    wait_for(lambda: cache.get_stats().get("shared") == 4)
+    grabber.release.set()
+    for client in clients:
+        client.join(5)
+
+    assert grabber.grabs == ["streamer"]
+    assert len(results) == 5
+    assert all(snapshot is results[0] for snapshot in results)
+
+
+def test_frames_are_cached_for_ttl():
+    grabber = Grabber()
+    cache = snapshots.SnapshotCache(size=4, ttl=60, grabber=grabber)
+
+    first = cache.get("streamer")
+    assert cache.get("streamer") is first
+    assert grabber.grabs == ["streamer"]
+
+    cache.ttl = 0
+    assert cache.get("streamer") is not first
+    assert grabber.grabs == ["streamer", "streamer"]
+
+
+def test_least_recently_used_streamers_are_evicted():
+    grabber = Grabber()
+    cache = snapshots.SnapshotCache(size=2, ttl=60, grabber=grabber)
+
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert cache.get_stats()["evictions"] == 1
+
+    cache.get("a")
+    cache.get("b")
+    assert grabber.grabs == ["a", "b", "c", "b"]
+
+
+def test_errors_are_shared_and_not_cached():
+    grabber = Grabber(block=True, error=ValueError("boom"))
+    cache = snapshots.SnapshotCache(size=4, ttl=60, grabber=grabber)
+    errors = []
+
+    def request():
+        try:
+            cache.get("streamer")
+        except snapshots.SnapshotError as e:
+            errors.append(e)
+
+    clients = [threading.Thread(target=request) for _ in range(3)]
+    for r in clients:
+        r.start()
+    grabber.started.wait(5)
+    wait_for(lambda: cache.get_stats().get("shared") == 2)
+    grabber.release.set()
+    for r in clients:
+        r.join(5)
+
+    assert len(errors) == 3
+    assert all(e is errors[0] for e in errors)
+    assert str(errors[0]) == "boom"
+    assert cache.get_stats()["cached"] == 0
+
+    grabber.error = None
+    assert cache.get("streamer").image == JPEG + b"streamer"
+    assert len(grabber.grabs) == 2
+
+
+def test_discard():
+    grabber = Grabber()
+    cache = snapshots.SnapshotCache(size=4, ttl=60, grabber=grabber)
+
+    cache.get("streamer")
+    cache.discard("streamer")
+    cache.get("streamer")
+    assert len(grabber.grabs) == 2
+
+
+class Outbox(list):
+    def send(self, resource_id, **attributes):
+        self.append((resource_id, attributes))
+
+
+@pytest.fixture
+def pusher(monkeypatch):
+    from management_api import budget, docker_client, jobs, outbox, streamers
+
+    monkeypatch.setattr(snapshots, "push_samples", True)
+    monkeypatch.setattr(jobs, "queue", jobs.JobQueue(workers=2))
+    monkeypatch.setattr(outbox, "outbox", Outbox())
+    monkeypatch.setattr(budget, "nuvla_update", lambda container: {})
+    monkeypatch.setattr(docker_client.registry, "get", lambda name: object())
+    store = {"streamer": {"id": "nuvlabox-peripheral/streamer", "endpoint": "data-gateway/video/streamer"}}
+    monkeypatch.setattr(streamers.store, "get", store.get)
+
+    return types.SimpleNamespace(pusher=snapshots.SamplePusher(interval=60), store=store, jobs=jobs.queue,
+                                 outbox=outbox.outbox)
+
+
+def test_samples_are_throttled(pusher):
+    assert pusher.pusher.push(snapshots.Snapshot("streamer", JPEG))
+    assert not pusher.pusher.push(snapshots.Snapshot("streamer", JPEG))
+    wait_for(lambda: pusher.jobs.depth() == 0)
+
+    assert pusher.outbox == [("nuvlabox-peripheral/streamer",
+                              {"local_data_gateway_endpoint": "data-gateway/video/streamer",
+                               "raw_sample": "data:image/jpeg;base64,/9hmcmFtZf/Z"})]
+
+
+def test_samples_dont_overtake_a_disable(pusher):
+    release = threading.Event()
+
+    def disable(job):
+        release.wait(5)
+        pusher.outbox.send("nuvlabox-peripheral/streamer", data_gateway_enabled=False)
+        del pusher.store["streamer"]
+
+    pusher.jobs.submit("disable-data-source-mjpg", "streamer", disable)
+    # grabbed before the disable is done
+    assert pusher.pusher.push(snapshots.Snapshot("streamer", JPEG))
+    release.set()
+    wait_for(lambda: pusher.jobs.depth() == 0)
+
+    assert pusher.outbox == [("nuvlabox-peripheral/streamer", {"data_gateway_enabled": False})]
+    assert pusher.pusher.get_stats()["skipped"] == 1
+
+
+def test_samples_are_downscaled():
+    Image = pytest.importorskip("PIL.Image")
+
+    frame = io.BytesIO()
+    Image.new("RGB", (1280, 720), "white").save(frame, "JPEG")
+    raw_sample = snapshots.sample(frame.getvalue())
+
+    with Image.open(io.BytesIO(base64.b64decode(raw_sample.split(",", 1)[1]))) as downscaled:
+        assert downscaled.size == (320, 180)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+from management_api import ssh_keys
+from management_api.common import utils
+
+ED25519 = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIKMT0uCYnPkO4fG3oJ5uWcl5ctIyl3WYa8H2kTWLs9Xi alice@laptop"
+RSA = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC7 bob@desktop"
+ECDSA = "ecdsa-sha2-nistp256 AAAAE2VjZHNhLXNoYTItbmlzdHAyNTYAAAAI carol"
+# added by hand, not through the API
+UNMANAGED = 'from="10.0.0.0/8",no-pty ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIOperator operator key'
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / "authorized_keys"
+    path.write_text("# keys of the host\n{}\n\n".format(UNMANAGED))
+    os.chmod(str(path), 0o600)
+    return path
+
+
+@pytest.fixture
+def store(path):
+    return make_store(path)
+
+
+def make_store(path):
+    return ssh_keys.AuthorizedKeysStore(str(path), str(path.parent / ".lock"), str(path.parent / ".managed"))
+
+
+def test_parse_key():
+    key = ssh_keys.parse_key(UNMANAGED)
+
+    assert (key.options, key.key_type, key.comment) == ('from="10.0.0.0/8",no-pty', "ssh-ed25519", "operator key")
+    assert str(key) == UNMANAGED
+    assert ssh_keys.parse_key("# ssh-rsa AAAA commented out") is None
+    assert ssh_keys.parse_key("") is None
+    assert ssh_keys.parse_key("not a key") is None
+
+
+def test_add_and_remove(store, path):
+    added, skipped = store.add(ED25519 + "\\n" + RSA)
+
+    assert [str(k) for k in added] == [ED25519, RSA]
+    assert skipped == []
+    assert path.read_text() == "# keys of the host\n{}\n\n{}\n{}\n".format(UNMANAGED, ED25519, RSA)
+
+    removed = store.remove(ED25519)
+
+    assert [str(k) for k in removed] == [ED25519]
+    assert ED25519 not in store
+    assert RSA in store
+    assert path.read_text() == "# keys of the host\n{}\n\n{}\n".format(UNMANAGED, RSA)
+
+
+def test_duplicates_are_matched_by_key_not_comment(store, path):
+    store.add(ED25519)
+    added, skipped = store.add(ED25519.replace("alice@laptop", "another comment"))
+
+    assert added == []
+    assert [k.comment for k in skipped] == ["another comment"]
+    assert path.read_text().count("AAAAIKMT0") == 1
+
+    # and removed whatever the comment
+    assert len(store.remove(ED25519.rsplit(" ", 1)[0])) == 1
+    assert ED25519 not in store
+
+
+def test_invalid_keys_are_rejected(store, path):
+    before = path.read_text()
+
+    with pytest.raises(ValueError):
+        store.add(ED25519 + "\nnot a key")
+    assert path.read_text() == before
+
+
+def test_sync_only_removes_managed_keys(store, path):
+    store.add(ED25519 + "\n" + RSA)
+
+    added, removed, unchanged = store.sync([RSA, ECDSA])
+
+    assert [str(k) for k in added] == [ECDSA]
+    assert [str(k) for k in removed] == [ED25519]
+    assert [str(k) for k in unchanged] == [RSA]
+    assert [str(k) for k in store.keys()] == [UNMANAGED, RSA, ECDSA]
+
+    added, removed, unchanged = store.sync([])
+
+    assert [str(k) for k in removed] == [RSA, ECDSA]
+    assert [str(k) for k in store.keys()] == [UNMANAGED]
+    assert "# keys of the host" in path.read_text()
+
+
+def test_unmanaged_keys_stay_unmanaged(store):
+    # a key that was already there is not taken over by a sync that lists it
+    store.sync([UNMANAGED])
+    store.sync([])
+
+    assert UNMANAGED in store
+
+
+def test_managed_keys_survive_a_restart(store, path):
+    store.add(ED25519)
+
+    _, removed, _ = make_store(path).sync([])
+
+    assert [str(k) for k in removed] == [ED25519]
+
+
+def test_changes_on_disk_are_picked_up(store, path):
+    assert RSA not in store
+
+    with open(str(path), "a") as ak:
+        ak.write(RSA + "\n")
+    # same size and mtime can't be told apart, so make sure the signature changes
+    os.utime(str(path), ns=(0, 0))
+
+    assert RSA in store
+
+
+def test_atomic_write(store, path, monkeypatch):
+    inode = os.stat(str(path)).st_ino
+    store.add(ED25519)
+
+    # a new file replaced the old one, with the same permissions, and no temporary file left behind
+    assert os.stat(str(path)).st_ino != inode
+    assert os.stat(str(path)).st_mode & 0o777 == 0o600
+    assert sorted(os.listdir(str(path.parent))) == [".lock", ".managed", "authorized_keys"]
+
+    before = path.read_text()
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(utils.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        store.add(RSA)
+
+    assert path.read_text() == before
+    assert sorted(os.listdir(str(path.parent))) == [".lock", ".managed", "authorized_keys"]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import ssl
+import pytest
+from management_api import tls
+
+
+class Context(object):
+    """ Context of an OpenSSL that only knows some curves """
+
+    def __init__(self, *known):
+        self.known = known
+        self.options = ssl.OP_NO_TICKET
+        self.curve = None
+
+    def set_ecdh_curve(self, curve):
+        if curve not in self.known:
+            raise ValueError("unknown elliptic curve name {!r}".format(curve))
+        self.curve = curve
+
+
+@pytest.mark.parametrize("known, curve", [(("X25519", "prime256v1"), "X25519"),
+                                          # OpenSSL 1.1 with Python < 3.10: prime curves only
+                                          (("prime256v1",), "prime256v1"),
+                                          ((), None)])
+def test_first_available_curve_is_used(known, curve):
+    context = Context(*known)
+
+    assert tls.set_ecdh_curve(context, "X25519:prime256v1") == curve
+    assert context.curve == curve
+
+
+def test_empty_curves_keep_the_openssl_defaults():
+    context = Context("X25519")
+
+    assert tls.set_ecdh_curve(context, "") is None
+    assert context.curve is None
+
+
+def test_tune():
+    context = tls.tune(ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER), "prime256v1")
+
+    assert not context.options & ssl.OP_NO_TICKET
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import struct
+import pytest
+from management_api import video_devices
+from management_api.common import v4l2
+
+MJPG = struct.unpack("<I", b"MJPG")[0]
+
+
+def test_struct_sizes_and_ioctl_numbers():
+    # as in linux/videodev2.h
+    assert (v4l2._capability.size, v4l2._fmtdesc.size, v4l2._frmsizeenum.size, v4l2._frmivalenum.size) == \
+        (104, 64, 44, 52)
+    assert v4l2.VIDIOC_QUERYCAP == 0x80685600
+    assert v4l2.VIDIOC_ENUM_FMT == 0xc0405602
+    assert v4l2.VIDIOC_ENUM_FRAMESIZES == 0xc02c564a
+    assert v4l2.VIDIOC_ENUM_FRAMEINTERVALS == 0xc034564b
+
+
+def test_fourcc():
+    assert v4l2.fourcc(MJPG) == "MJPG"
+
+
+class FakeCamera(object):
+    """ Answers the V4L2 ioctls like a UVC camera with MJPG at 1280x720 (30, 15 fps) and 640x480 (30 fps) """
+
+    sizes = [(1280, 720), (640, 480)]
+    rates = {(1280, 720): [(1, 30), (1, 15)], (640, 480): [(1, 30)]}
+
+    def __call__(self, fd, request, buffer, mutate):
+        if request == v4l2.VIDIOC_QUERYCAP:
+            buffer[:] = v4l2._capability.pack(b"uvcvideo", b"HD Webcam", b"usb-0000:00:14.0-1", 0,
+                                              v4l2.V4L2_CAP_DEVICE_CAPS | 0x04200001, 0x04200001)
+        elif request == v4l2.VIDIOC_ENUM_FMT:
+            index = v4l2._fmtdesc.unpack(bytes(buffer))[0]
+            self._check(index, 1)
+            buffer[:] = v4l2._fmtdesc.pack(index, 1, 1, b"Motion-JPEG", MJPG, 0)
+        elif request == v4l2.VIDIOC_ENUM_FRAMESIZES:
+            index = v4l2._frmsizeenum.unpack(bytes(buffer))[0]
+            self._check(index, len(self.sizes))
+            buffer[:] = v4l2._frmsizeenum.pack(index, MJPG, v4l2.V4L2_FRMSIZE_TYPE_DISCRETE, *self.sizes[index],
+                                               0, 0, 0, 0)
+        elif request == v4l2.VIDIOC_ENUM_FRAMEINTERVALS:
+            index, _, width, height = v4l2._frmivalenum.unpack(bytes(buffer))[:4]
+            intervals = self.rates[(width, height)]
+            self._check(index, len(intervals))
+            buffer[:] = v4l2._frmivalenum.pack(index, MJPG, width, height, v4l2.V4L2_FRMIVAL_TYPE_DISCRETE,
+                                               *intervals[index], 0, 0, 0, 0)
+        return 0
+
+    @staticmethod
+    def _check(index, count):
+        if index >= count:
+            raise OSError(errno.EINVAL, "end of enumeration")
+
+
+@pytest.fixture
+def camera(monkeypatch, tmp_path):
+    monkeypatch.setattr(v4l2.fcntl, "ioctl", FakeCamera())
+    monkeypatch.setattr(v4l2.os, "open", lambda path, flags: -1)
+    (tmp_path / "video0").write_text("")
+    return tmp_path
+
+
+def test_probe(camera):
+    device = video_devices.probe(str(camera / "video0"))
+
+    assert device["error"] is None
+    assert (device["driver"], device["card"], device["bus-info"]) == ("uvcvideo", "HD Webcam", "usb-0000:00:14.0-1")
+    assert device["capture"] is True
+    assert device["formats"] == [{"format": "MJPG",
+                                  "description": "Motion-JPEG",
+                                  "resolutions": {"1280x720": [30.0, 15.0], "640x480": [30.0]},
+                                  "ranges": []}]
+
+
+def test_probe_of_a_device_that_cant_be_queried(tmp_path):
+    (tmp_path / "video0").write_text("")
+    device = video_devices.probe(str(tmp_path / "video0"))
+
+    assert device["capture"] is None
+    assert device["error"]
+
+
+def test_validate(camera, monkeypatch):
+    monkeypatch.setattr(video_devices, "validation", True)
+    inventory = video_devices.VideoDeviceInventory(folder=str(camera))
+
+    assert inventory.resolutions("/dev/video0") == ["1280x720", "640x480"]
+    inventory.validate("/dev/video0", "1280x720")
+    inventory.validate("/dev/video0", "VGA")
+    # resolution not known yet, i.e. on restart
+    inventory.validate("/dev/video0")
+
+    with pytest.raises(video_devices.InvalidVideoDevice, match="does not support resolution 1920x1080"):
+        inventory.validate("/dev/video0", "1920x1080")
+    with pytest.raises(video_devices.InvalidVideoDevice, match="does not exist"):
+        inventory.validate("/dev/video1", "1280x720")
+
+
+def test_validation_is_skipped_when_no_video_device_is_visible(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_devices, "validation", True)
+    inventory = video_devices.VideoDeviceInventory(folder=str(tmp_path))
+
+    inventory.validate("/dev/video0", "1280x720")
+
+
+@pytest.mark.parametrize("resolution, normalized", [("VGA", "640x480"), ("qvga", "320x240"), ("HD", "1280x720"),
+                                                    ("1280X720", "1280x720"), ("", "")])
+def test_normalize_resolution(resolution, normalized):
+    assert video_devices.normalize_resolution(resolution) == normalized
+
+
+def test_devices_are_read_from_the_mount_but_given_by_their_host_path(camera):
+    by_id = camera / "v4l" / "by-id"
+    by_id.mkdir(parents=True)
+    (by_id / "usb-HD_Webcam-video-index0").symlink_to("../../video0")
+    inventory = video_devices.VideoDeviceInventory(folder=str(camera))
+
+    assert [device["video-device"] for device in inventory.list()] == ["/dev/video0"]
+    assert inventory.get("/dev/v4l/by-id/usb-HD_Webcam-video-index0")["card"] == "HD Webcam"
+    assert inventory.get("/dev/video1") is None